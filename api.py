@@ -0,0 +1,315 @@
+import io
+import os
+import time
+import base64
+
+import numpy as np
+from flask import Blueprint, request, jsonify, send_file, url_for
+
+import jobs
+from app import app
+from library import run_library_fit
+from utils import (DEFAULT_SETTINGS_CONDITIONS, DEFAULT_SETTINGS_MODELS,
+                   DEFAULT_SETTINGS_SLIT, DEFAULT_SETTINGS_SOLVER,
+                   FREE_PARAMETERS, SETTINGS_RANGES, SETTINGS_OPTIONS,
+                   synthesize_cars, run_fit)
+
+# longest time (in s) a request may wait for its results ({"wait": ...})
+# before the job id is returned instead, well below the worker timeout of
+# gunicorn.conf.py
+API_MAX_WAIT = float(os.environ.get("CARSPY_API_MAX_WAIT", 10))
+# largest number of parameter sets in one request
+API_MAX_BATCH = int(os.environ.get("CARSPY_API_MAX_BATCH", 100))
+API_FORMATS = ("json", "base64", "npz")
+# keys of a request body that are options, not parameters
+API_OPTIONS = ("wait", "format", "arrays", "report")
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+
+class ApiError(Exception):
+    pass
+
+
+@api.errorhandler(ApiError)
+def _api_error(e):
+    return jsonify({"error": str(e)}), 400
+
+
+# a single parameter set, a list of them or {"batch": [...]}, plus options
+# (API_OPTIONS, next to "batch" or to the single parameter set)
+def _read_request():
+    body = request.get_json(force=True, silent=True)
+    if body is None:
+        raise ApiError("request body must be JSON")
+    options = {}
+    if isinstance(body, dict) and "batch" in body:
+        options = {_k: _v for _k, _v in body.items() if _k != "batch"}
+        body = body["batch"]
+    elif isinstance(body, dict):
+        options = {_k: _v for _k, _v in body.items() if _k in API_OPTIONS}
+        body = {_k: _v for _k, _v in body.items() if _k not in API_OPTIONS}
+    items = body if isinstance(body, list) else [body]
+    if not items or len(items) > API_MAX_BATCH:
+        raise ApiError(f"a batch must have 1 to {API_MAX_BATCH} items")
+    if not all(isinstance(_item, dict) for _item in items):
+        raise ApiError("parameter sets must be JSON objects")
+    fmt = request.args.get("format", options.get("format", "json"))
+    if fmt not in API_FORMATS:
+        raise ApiError(f"format must be one of {', '.join(API_FORMATS)}")
+    return items, fmt, options
+
+
+# seconds to wait for the results: none by default, up to API_MAX_WAIT for
+# {"wait": true} (or ?wait=true), a number of seconds is capped by it
+def _wait_time(options):
+    wait = request.args.get("wait", options.get("wait", False))
+    if isinstance(wait, str):
+        wait = {"true": True, "false": False}.get(wait.lower(), wait)
+    if isinstance(wait, bool) or wait is None:
+        return API_MAX_WAIT if wait else 0
+    try:
+        return min(max(float(wait), 0), API_MAX_WAIT)
+    except (TypeError, ValueError):
+        raise ApiError("'wait' must be a boolean or a number of seconds")
+
+
+# arrays are accepted as lists or as {"data": base64, "dtype": ...}
+def _read_array(value, name):
+    if isinstance(value, dict):
+        try:
+            data = np.frombuffer(base64.b64decode(value["data"]),
+                                 dtype=np.dtype(value.get("dtype", "<f4")))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ApiError(f"invalid array '{name}': {e}")
+        return data.astype(float)
+    try:
+        return np.asarray(value, dtype=float)
+    except (TypeError, ValueError):
+        raise ApiError(f"invalid array '{name}'")
+
+
+def _merge(defaults, values, name):
+    values = values or {}
+    unknown = set(values) - set(defaults)
+    if unknown:
+        raise ApiError(f"unknown {name} settings: "
+                       + ", ".join(sorted(unknown)))
+    return {**defaults, **values}
+
+
+# synthesis settings must be within the ranges offered by the app
+def _check_synthesis(index, params):
+    for _name, (_min, _max, _) in SETTINGS_RANGES.items():
+        if _name == "num_sample" and params[_name] == "auto":
+            continue
+        _value = params[_name]
+        if isinstance(_value, bool) or not isinstance(_value, (int, float)) \
+                or not _min <= _value <= _max:
+            raise ApiError(f"'{_name}' of parameter set {index} must be a "
+                           f"number from {_min} to {_max}")
+    for _name, _options in SETTINGS_OPTIONS.items():
+        if params[_name] not in _options and not (
+                _name == "doppler_effect" and isinstance(params[_name], bool)):
+            raise ApiError(f"'{_name}' of parameter set {index} must be one "
+                           f"of {', '.join(_options)}")
+    if params["nu_start"] >= params["nu_end"]:
+        raise ApiError(f"'nu_start' of parameter set {index} must be below "
+                       "'nu_end'")
+    comp = params["comp"]
+    if not isinstance(comp, dict) or set(comp) - set(
+            DEFAULT_SETTINGS_CONDITIONS["comp"]) or not all(
+            isinstance(_x, (int, float)) and 0 <= _x <= 1
+            for _x in comp.values()):
+        raise ApiError(f"'comp' of parameter set {index} must map species "
+                       "of " + ", ".join(DEFAULT_SETTINGS_CONDITIONS["comp"])
+                       + " to mole fractions")
+
+
+def _encode(value, fmt):
+    if isinstance(value, np.ndarray):
+        if fmt == "base64":
+            data = np.ascontiguousarray(value, dtype="<f4")
+            return {"dtype": "<f4", "shape": list(data.shape),
+                    "data": base64.b64encode(data.tobytes()).decode()}
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+# one array per field, stacked if all parameter sets have the same length,
+# otherwise one array per parameter set ("<field>_<index>")
+def _npz(results):
+    arrays = {}
+    fields = sorted({_k for _r in results for _k in _r})
+    for _field in fields:
+        values = [_r.get(_field) for _r in results]
+        if any(isinstance(_v, np.ndarray) for _v in values):
+            shapes = {getattr(_v, "shape", None) for _v in values}
+            if len(shapes) == 1:
+                arrays[_field] = np.stack(values).astype("<f4")
+            else:
+                arrays.update({f"{_field}_{_i}": _v.astype("<f4")
+                               for _i, _v in enumerate(values)
+                               if isinstance(_v, np.ndarray)})
+        elif any(isinstance(_v, str) for _v in values):
+            arrays[_field] = np.array(["" if _v is None else str(_v)
+                                       for _v in values])
+        elif None in values:
+            arrays[_field] = np.array([np.nan if _v is None else _v
+                                       for _v in values], dtype=float)
+        else:
+            arrays[_field] = np.array(values)
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    buffer.seek(0)
+    return send_file(buffer, mimetype="application/octet-stream",
+                     as_attachment=True, attachment_filename="results.npz")
+
+
+def _respond(results, fmt, **extra):
+    if fmt == "npz":
+        return _npz(results)
+    return jsonify(dict(extra, results=[
+        {_k: _encode(_v, fmt) for _k, _v in _r.items()} for _r in results]))
+
+
+# executed in the worker process, one job per parameter set
+def _synthesize_item(index, params):
+    try:
+        nu, spect = synthesize_cars(**params)
+    except Exception as e:
+        return [{"index": index, "error": f"synthesis failed: {e}"}]
+    return [{"index": index, "nu": nu, "signal": spect}]
+
+
+# POST /api/synthesize: keyword arguments of utils.synthesize_cars (missing
+# ones take the defaults of the app), returns nu and the signal; runs as a
+# batch job like /api/fit
+@api.route("/synthesize", methods=["POST"])
+def synthesize():
+    items, fmt, options = _read_request()
+    wait = _wait_time(options)
+    defaults = {**DEFAULT_SETTINGS_CONDITIONS, **DEFAULT_SETTINGS_MODELS}
+    args_list = []
+    for _index, _item in enumerate(items):
+        params = _merge(defaults, _item, "synthesis")
+        _check_synthesis(_index, params)
+        if params["doppler_effect"] in ("enable", "disable"):
+            params["doppler_effect"] = params["doppler_effect"] == "enable"
+        args_list.append((_index, params))
+    batch_id = jobs.submit_batch(_synthesize_item, args_list, kind="api")
+    return _job_response(batch_id, fmt, options, time.monotonic() + wait)
+
+
+# executed in the worker process, one job per parameter set
+def _fit_item(index, nu_expt, spect_expt, slit_parameters, settings_models,
+              settings_conditions, settings_solver, init_temperature=None):
+    try:
+        if settings_solver["method"] == "library":
+            result = run_library_fit(nu_expt, spect_expt, slit_parameters,
+                                     settings_models, settings_conditions)
+        else:
+            result = run_fit(nu_expt, spect_expt, slit_parameters,
+                             settings_models, settings_conditions,
+                             init_temperature=init_temperature,
+                             settings_solver=settings_solver, scan_workers=1,
+                             jacobian_workers=1)
+    except jobs.JobCancelled:
+        raise
+    except Exception as e:
+        return [{"index": index, "error": str(e)}]
+    return [dict(result, index=index)]
+
+
+def _results(batch, fields):
+    results = sorted(batch["results"], key=lambda _r: _r["index"])
+    return [{_k: _v for _k, _v in _r.items() if _k in fields}
+            for _r in results]
+
+
+# POST /api/fit: {"nu", "signal", "slit", "models", "conditions", "solver",
+# "init_temperature"}, settings are merged with the defaults of the app;
+# returns the job id and its URL (202) unless {"wait": ...} is given and the
+# results are ready in time
+@api.route("/fit", methods=["POST"])
+def fit():
+    items, fmt, options = _read_request()
+    wait = _wait_time(options)
+    args_list = []
+    for _index, _item in enumerate(items):
+        if "nu" not in _item or "signal" not in _item:
+            raise ApiError(f"parameter set {_index} needs 'nu' and 'signal'")
+        nu = _read_array(_item["nu"], "nu")
+        signal = _read_array(_item["signal"], "signal")
+        if nu.ndim != 1 or nu.shape != signal.shape:
+            raise ApiError(f"'nu' and 'signal' of parameter set {_index} "
+                           "must be 1D arrays of the same length")
+        settings_solver = _merge(DEFAULT_SETTINGS_SOLVER, _item.get("solver"),
+                                 "solver")
+        unknown = set(settings_solver["free"]) - set(FREE_PARAMETERS)
+        if unknown:
+            raise ApiError("unknown free parameters: "
+                           + ", ".join(sorted(unknown)))
+        args_list.append((
+            _index, nu, signal,
+            _merge(DEFAULT_SETTINGS_SLIT, _item.get("slit"), "slit"),
+            _merge(DEFAULT_SETTINGS_MODELS, _item.get("models"), "model"),
+            _merge(DEFAULT_SETTINGS_CONDITIONS, _item.get("conditions"),
+                   "condition"),
+            settings_solver,
+            _item.get("init_temperature"),
+        ))
+    batch_id = jobs.submit_batch(_fit_item, args_list, kind="api")
+    return _job_response(batch_id, fmt, options, time.monotonic() + wait)
+
+
+def _job_response(batch_id, fmt, options, deadline=0):
+    fields = {"index", "T_fit", "dT", "error"}
+    if options.get("arrays", True):
+        fields.update({"nu", "signal", "signal_expt", "best_fit"})
+    if options.get("report", False):
+        fields.add("report")
+    while True:
+        batch = jobs.batch_status(batch_id)
+        if batch["status"] in jobs.FINISHED + ("unknown",) \
+                or time.monotonic() > deadline:
+            break
+        time.sleep(0.1)
+    if batch["status"] == "unknown":
+        return jsonify({"id": batch_id, "status": "unknown"}), 404
+    if batch["status"] not in jobs.FINISHED:
+        # the job URL answers with the format and fields of the request
+        query = {_k: str(bool(options[_k])).lower()
+                 for _k in ("arrays", "report") if _k in options}
+        if fmt != "json":
+            query["format"] = fmt
+        url = url_for("api.job", batch_id=batch_id, **query)
+        return jsonify({"id": batch_id, "status": batch["status"],
+                        "done": batch["done"], "total": batch["jobs"],
+                        "url": url}), 202, {"Location": url}
+    _, batch["results"], batch["errors"] = jobs.batch_results(batch_id)
+    return _respond(_results(batch, fields), fmt, id=batch_id,
+                    status=batch["status"])
+
+
+# GET /api/jobs/<id>: status, or results once finished, of a fit or
+# synthesis request (?wait=... as for the requests), DELETE cancels it
+@api.route("/jobs/<batch_id>", methods=["GET", "DELETE"])
+def job(batch_id):
+    if request.method == "DELETE":
+        if jobs.batch_status(batch_id)["status"] == "unknown":
+            return jsonify({"id": batch_id, "status": "unknown"}), 404
+        jobs.cancel(batch_id)
+        return jsonify({"id": batch_id, "status": "cancelling"})
+    fmt = request.args.get("format", "json")
+    if fmt not in API_FORMATS:
+        raise ApiError(f"format must be one of {', '.join(API_FORMATS)}")
+    options = {_k: request.args.get(_k, "true").lower() != "false"
+               for _k in ("arrays", "report") if _k in request.args}
+    return _job_response(batch_id, fmt, options,
+                         time.monotonic() + _wait_time({}))
+
+
+app.server.register_blueprint(api)
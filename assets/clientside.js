@@ -0,0 +1,55 @@
+// time (in ms) at which this page started polling each job
+const pollStarts = {};
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    carspy: {
+        // switch the y-axis of the synthesized spectrum between lin and log
+        set_y_scale: function(figure, y_scale) {
+            if (!figure) {
+                return window.dash_clientside.no_update;
+            }
+            const fig = JSON.parse(JSON.stringify(figure));
+            fig.layout.yaxis = fig.layout.yaxis || {};
+            if (y_scale === "Log") {
+                fig.layout.yaxis.type = "log";
+                fig.layout.yaxis.range = [-2.5, 0.2];
+                fig.layout.yaxis.dtick = 1;
+            } else {
+                fig.layout.yaxis.type = "linear";
+                delete fig.layout.yaxis.range;
+                delete fig.layout.yaxis.dtick;
+                fig.layout.yaxis.autorange = true;
+            }
+            return fig;
+        },
+
+        // change the marker style of the fit signal and show/hide the fit
+        set_fit_style: function(figure, mode, show_fit) {
+            if (!figure) {
+                return window.dash_clientside.no_update;
+            }
+            const fig = JSON.parse(JSON.stringify(figure));
+            fig.data[0].mode = mode;
+            for (let i = 1; i < fig.data.length; i++) {
+                fig.data[i].visible = Boolean(show_fit && show_fit.length);
+            }
+            return fig;
+        },
+
+        // poll the fit job until it has finished, or until its deadline if
+        // the server stops answering
+        toggle_poll: function(job, progress) {
+            if (!job) {
+                return true;
+            }
+            if (job.timeout) {
+                pollStarts[job.id] = pollStarts[job.id] || Date.now();
+                if (Date.now() - pollStarts[job.id] > 1000*job.timeout + 10000) {
+                    return true;
+                }
+            }
+            return Boolean(progress && progress.id === job.id &&
+                           ["done", "failed", "cancelled"].includes(progress.status));
+        }
+    }
+});
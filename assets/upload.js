@@ -0,0 +1,75 @@
+// upload zones (class "carspy-upload"): the selected or dropped file is posted
+// to the server as a stream, the file is never read into the page; the JSON
+// response (a handle) is written into the hidden input "<zone id>-handle"
+(function() {
+    function uploadUrl(filename) {
+        const config = document.getElementById("_dash-config");
+        const prefix = config ?
+            JSON.parse(config.textContent).requests_pathname_prefix : "/";
+        return prefix + "upload?filename=" + encodeURIComponent(filename);
+    }
+
+    function setHandle(zone, value) {
+        const input = document.getElementById(zone.id + "-handle");
+        const setter = Object.getOwnPropertyDescriptor(
+            window.HTMLInputElement.prototype, "value").set;
+        // let React (and thus Dash) see the new value
+        setter.call(input, value);
+        input.dispatchEvent(new Event("input", {bubbles: true}));
+    }
+
+    function send(zone, file) {
+        const label = zone.querySelector(".carspy-upload-label");
+        const text = label.dataset.text || label.textContent;
+        label.dataset.text = text;
+        const xhr = new XMLHttpRequest();
+        xhr.open("POST", uploadUrl(file.name));
+        xhr.setRequestHeader("Content-Type", "application/octet-stream");
+        xhr.upload.onprogress = function(e) {
+            if (e.lengthComputable) {
+                label.textContent = "Uploading " + file.name + ": " +
+                    Math.round(100*e.loaded/e.total) + "%";
+            }
+        };
+        xhr.onload = function() {
+            label.textContent = text;
+            setHandle(zone, xhr.responseText);
+        };
+        xhr.onerror = function() {
+            label.textContent = text;
+            setHandle(zone, JSON.stringify(
+                {filename: file.name, error: "Upload failed"}));
+        };
+        xhr.send(file);
+    }
+
+    document.addEventListener("click", function(e) {
+        const zone = e.target.closest(".carspy-upload");
+        if (!zone) {
+            return;
+        }
+        const input = document.createElement("input");
+        input.type = "file";
+        input.accept = zone.dataset.accept || "";
+        input.onchange = function() {
+            if (input.files.length) {
+                send(zone, input.files[0]);
+            }
+        };
+        input.click();
+    });
+
+    document.addEventListener("dragover", function(e) {
+        if (e.target.closest(".carspy-upload")) {
+            e.preventDefault();
+        }
+    });
+
+    document.addEventListener("drop", function(e) {
+        const zone = e.target.closest(".carspy-upload");
+        if (zone && e.dataTransfer.files.length) {
+            e.preventDefault();
+            send(zone, e.dataTransfer.files[0]);
+        }
+    });
+})();
@@ -0,0 +1,421 @@
+"""Benchmarks of the synthesis, convolution, fitting and figure serialization.
+
+Run all benchmarks, write the results and compare them with the baseline:
+
+    python benchmark.py
+
+Record the current results as the new baseline:
+
+    python benchmark.py --save-baseline
+
+The process exits with status 1 if a benchmark is slower than the baseline by
+more than the tolerance or a payload has grown. A warning is printed when the
+baseline was recorded with other package versions than the current ones, or
+is being recorded with other versions than those pinned in requirements.txt.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from pathlib import Path
+from itertools import product
+from importlib import metadata
+
+import numpy as np
+import plotly
+import plotly.utils
+
+from utils import (DEFAULT_SETTINGS_CONDITIONS, DEFAULT_SETTINGS_MODELS,
+                   DEFAULT_SETTINGS_SLIT, DEFAULT_SETTINGS_FIT,
+                   DEFAULT_SETTINGS_SOLVER, DEFAULT_FIT_SIGNAL,
+                   _synthesize_cars, downsample_synth, slit_profile,
+                   least_sqrt_fit, unpack_lmfit, plot_cars, plot_fitting,
+                   add_fit_result)
+from store import content_key
+
+BASELINE_PATH = Path(__file__).parent / "_data/benchmark_baseline.json"
+RESULTS_PATH = Path("benchmark_results.json")
+REQUIREMENTS_PATH = Path(__file__).parent / "requirements.txt"
+# packages whose versions are recorded with the results, timings taken with
+# other versions (or another interpreter or core count) are not comparable
+VERSIONED_PACKAGES = ("carspy", "numpy", "scipy", "lmfit", "plotly", "dash",
+                      "flask")
+COMPARED_ENVIRONMENT = ("python", "cpu_count") + VERSIONED_PACKAGES
+# relative slow-down (of the median time) reported as a regression
+TIME_TOLERANCE = 0.25
+# relative growth of a payload reported as a regression
+SIZE_TOLERANCE = 0.01
+
+SYNTH_CHI_RS = ("isolated", "G-matrix")
+SYNTH_CONVOL = ("Kataoka", "Yuratich")
+SYNTH_DOPPLER = (False, True)
+SYNTH_NUM_SAMPLE = (2500, 5000, 10000, 15000)
+# the adaptive grid does not depend much on num_sample, one size is enough
+SYNTH_ADAPTIVE_NUM_SAMPLE = (5000,)
+SLIT_SHAPES = ("sGaussian", "sVoigt")
+
+BENCHMARKS = {}
+
+
+def benchmark(name, repeat=5):
+    """Register a benchmark.
+
+    The decorated function prepares its inputs and returns the callable to
+    be timed. If the callable returns a (JSON) string, its size is recorded.
+    """
+    def _register(func):
+        BENCHMARKS[name] = (func, repeat)
+        return func
+    return _register
+
+
+def to_json(value):
+    # the encoder Dash uses for callback outputs
+    return json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+def _synth_args(chi_rs, convol, doppler_effect, num_sample, grid="uniform"):
+    models = dict(DEFAULT_SETTINGS_MODELS, chi_rs=chi_rs, convol=convol,
+                  doppler_effect=doppler_effect, num_sample=num_sample,
+                  grid=grid)
+    return dict(DEFAULT_SETTINGS_CONDITIONS, **models)
+
+
+def _default_spectrum():
+    return _synthesize_cars(**_synth_args("isolated", "Yuratich", False,
+                                          DEFAULT_SETTINGS_MODELS[
+                                              "num_sample"]))
+
+
+# the uncached synthesis, every combination of the model options
+def _add_synthesis(chi_rs, convol, doppler_effect, num_sample,
+                   grid="uniform"):
+    name = "synthesize/{}-{}-{}-{}".format(
+        chi_rs, convol, "doppler" if doppler_effect else "no_doppler",
+        num_sample)
+    if grid != "uniform":
+        name += f"-{grid}"
+
+    @benchmark(name, repeat=3)
+    def _synthesize():
+        kwargs = _synth_args(chi_rs, convol, doppler_effect, num_sample,
+                             grid)
+        return lambda: _synthesize_cars(**kwargs)
+
+
+for _options in product(SYNTH_CHI_RS, SYNTH_CONVOL, SYNTH_DOPPLER,
+                        SYNTH_NUM_SAMPLE):
+    _add_synthesis(*_options)
+for _options in product(SYNTH_CHI_RS, SYNTH_CONVOL, SYNTH_DOPPLER,
+                        SYNTH_ADAPTIVE_NUM_SAMPLE):
+    _add_synthesis(*_options, grid="adaptive")
+
+
+def _add_slit(shape):
+    @benchmark(f"slit_profile/{shape}", repeat=20)
+    def _slit():
+        nu, _ = _default_spectrum()
+        parameters = dict(DEFAULT_SETTINGS_SLIT, slit=shape)
+        return lambda: slit_profile(nu, dict(parameters))
+
+    @benchmark(f"downsample_synth/{shape}", repeat=20)
+    def _downsample():
+        nu, spect = _default_spectrum()
+        parameters = dict(DEFAULT_SETTINGS_SLIT, slit=shape)
+        fit = DEFAULT_SETTINGS_FIT
+        return lambda: downsample_synth(
+            nu, spect, DEFAULT_SETTINGS_MODELS["nu_start"],
+            DEFAULT_SETTINGS_MODELS["nu_end"], fit["sample_length"],
+            fit["noise_level"], fit["offset"], dict(parameters))
+
+
+for _shape in SLIT_SHAPES:
+    _add_slit(_shape)
+
+
+def _fit_args():
+    nu_expt, spect_expt, _ = DEFAULT_FIT_SIGNAL
+    return (np.asarray(nu_expt), np.asarray(spect_expt),
+            dict(DEFAULT_SETTINGS_SLIT), DEFAULT_SETTINGS_MODELS,
+            DEFAULT_SETTINGS_CONDITIONS)
+
+
+@benchmark("least_sqrt_fit/default", repeat=3)
+def _fit():
+    fit_args = _fit_args()
+    return lambda: least_sqrt_fit(*fit_args)
+
+
+@benchmark("serialize/plot_cars", repeat=10)
+def _serialize_synth():
+    nu, spect = _default_spectrum()
+    return lambda: to_json(plot_cars(nu, spect))
+
+
+@benchmark("serialize/plot_fitting", repeat=10)
+def _serialize_fit():
+    result = unpack_lmfit(least_sqrt_fit(*_fit_args()))
+
+    def _plot():
+        fig = plot_fitting(result["nu"], result["signal_expt"],
+                           [DEFAULT_SETTINGS_MODELS["nu_start"],
+                            DEFAULT_SETTINGS_MODELS["nu_end"]])
+        return to_json(add_fit_result(fig, result["nu"],
+                                      result["best_fit"]))
+    return _plot
+
+
+# the arrays stay on the server (store.ARRAY_STORE), the stores hold keys,
+# settings and the fit report
+@benchmark("serialize/store-fit-report", repeat=10)
+def _serialize_report():
+    result = unpack_lmfit(least_sqrt_fit(*_fit_args()))
+    arrays = {_key: result.pop(_key)
+              for _key in ('nu', 'signal_expt', 'best_fit')}
+    result["key"] = content_key(arrays)
+    return lambda: to_json(result)
+
+
+@benchmark("serialize/store-settings", repeat=10)
+def _serialize_settings():
+    settings = [DEFAULT_SETTINGS_CONDITIONS, DEFAULT_SETTINGS_MODELS,
+                DEFAULT_SETTINGS_SLIT, DEFAULT_SETTINGS_FIT,
+                DEFAULT_SETTINGS_SOLVER]
+    return lambda: "".join(to_json(_s) for _s in settings)
+
+
+def _run_python(code):
+    subprocess.run([sys.executable, "-W", "ignore", "-c", code], check=True,
+                   cwd=Path(__file__).parent, capture_output=True)
+
+
+# requests of the first page load (synthesize tab) in a fresh worker
+FIRST_PAGE = """
+import index
+from utils import DEFAULT_SETTINGS_CONDITIONS, DEFAULT_SETTINGS_MODELS
+client = index.server.test_client()
+for _path in ("/", "/_dash-layout", "/_dash-dependencies"):
+    assert client.get(_path).status_code == 200
+assert client.post("/_dash-update-component", json={
+    "output": "memory-synth-spectrum.data",
+    "outputs": {"id": "memory-synth-spectrum", "property": "data"},
+    "inputs": [
+        {"id": "memory-settings-conditions", "property": "data",
+         "value": DEFAULT_SETTINGS_CONDITIONS},
+        {"id": "memory-settings-models", "property": "data",
+         "value": DEFAULT_SETTINGS_MODELS}],
+    "state": [{"id": "session-id", "property": "data", "value": "0"*32}],
+}).status_code == 200
+"""
+
+
+# cold starts, each run in a new interpreter
+@benchmark("startup/import-index", repeat=3)
+def _import_index():
+    return lambda: _run_python("import index")
+
+
+@benchmark("startup/first-page", repeat=3)
+def _first_page():
+    return lambda: _run_python(FIRST_PAGE)
+
+
+@benchmark("startup/preload", repeat=3)
+def _preload():
+    return lambda: _run_python("import index, utils; utils.preload()")
+
+
+def import_times(module="index", top=20):
+    """Cumulative import times (in s) of the slowest modules."""
+    stderr = subprocess.run(
+        [sys.executable, "-W", "ignore", "-X", "importtime", "-c",
+         f"import {module}"], check=True, cwd=Path(__file__).parent,
+        capture_output=True, text=True).stderr
+    times = {}
+    for _line in stderr.splitlines():
+        if not _line.startswith("import time:") or "cumulative" in _line:
+            continue
+        _, cumulative, name = _line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)*1e-6
+    return sorted(times.items(), key=lambda _t: -_t[1])[:top]
+
+
+def run_benchmark(name, repeat=None):
+    func, _repeat = BENCHMARKS[name]
+    repeat = repeat or _repeat
+    timed = func()
+    # warm-up (imports, spectrum instances, caches of carspy)
+    payload = timed()
+    times = []
+    for _ in range(repeat):
+        _start = time.perf_counter()
+        timed()
+        times.append(time.perf_counter() - _start)
+    result = {"median": float(np.median(times)), "min": min(times),
+              "repeat": repeat}
+    if isinstance(payload, str):
+        result["bytes"] = len(payload.encode())
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _version(package):
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def environment():
+    env = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+    env.update({_package: _version(_package)
+                for _package in VERSIONED_PACKAGES})
+    env["commit"] = _git_commit()
+    return env
+
+
+def pinned_versions(path=REQUIREMENTS_PATH):
+    """Versions pinned in the requirements, by lower-case package name."""
+    pins = {}
+    if path.exists():
+        for _line in path.read_text().splitlines():
+            _name, _sep, _version = _line.split("#")[0].partition("==")
+            if _sep:
+                pins[_name.strip().lower()] = _version.strip()
+    return pins
+
+
+def mismatches(env, reference, keys=COMPARED_ENVIRONMENT):
+    """Entries of `env` differing from `reference`, as (current, reference).
+
+    Keys missing from `reference` (e.g. a baseline from an older version of
+    this script) are reported too, as their value is unknown.
+    """
+    return {_key: (env.get(_key), reference.get(_key)) for _key in keys
+            if str(env.get(_key)) != str(reference.get(_key))}
+
+
+def _warn_mismatches(what, differences, reference):
+    if differences:
+        print(f"WARNING {what}: " + ", ".join(
+            f"{_key} {_current} ({reference} {_reference})"
+            for _key, (_current, _reference) in differences.items()),
+            file=sys.stderr, flush=True)
+
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE,
+            size_tolerance=SIZE_TOLERANCE):
+    """Return the benchmarks that regressed with respect to the baseline."""
+    regressions = {}
+    for _name, _result in results.items():
+        _base = baseline.get(_name)
+        if _base is None:
+            continue
+        _messages = []
+        _ratio = _result["median"]/_base["median"]
+        if _ratio > 1 + time_tolerance:
+            _messages.append(f"{_ratio:.2f}x slower")
+        if "bytes" in _result and "bytes" in _base \
+                and _result["bytes"] > _base["bytes"]*(1 + size_tolerance):
+            _messages.append("{} bytes (was {})".format(
+                _result["bytes"], _base["bytes"]))
+        if _messages:
+            regressions[_name] = ", ".join(_messages)
+    return regressions
+
+
+def _row(name, result, base=None):
+    row = f"{name:<48} {result['median']*1e3:>10.2f} ms"
+    row += f" {result['bytes']:>9d} B" if "bytes" in result else " "*11
+    if base is not None:
+        row += f" {result['median']/base['median']:>7.2f}x"
+    return row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", "--filter", default="",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("-n", "--repeat", type=int, default=None,
+                        help="number of timed runs (default per benchmark)")
+    parser.add_argument("-o", "--output", type=Path, default=RESULTS_PATH,
+                        help="file the results are written to (JSON)")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH,
+                        help="baseline results to compare with")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the results to the baseline file")
+    parser.add_argument("--tolerance", type=float, default=TIME_TOLERANCE,
+                        help="relative slow-down reported as a regression")
+    parser.add_argument("--list", action="store_true",
+                        help="list the benchmarks and exit")
+    parser.add_argument("--import-times", action="store_true",
+                        help="show the slowest imports of the app and exit")
+    args = parser.parse_args(argv)
+
+    names = [_name for _name in BENCHMARKS if args.filter in _name]
+    if args.list:
+        print("\n".join(names))
+        return 0
+    if args.import_times:
+        for _module, _time in import_times():
+            print(f"{_module:<48} {_time*1e3:>10.2f} ms")
+        return 0
+
+    previous, previous_env = {}, {}
+    if args.baseline.exists():
+        with open(args.baseline) as f:
+            _saved = json.load(f)
+        previous, previous_env = _saved["results"], _saved["environment"]
+    baseline = {} if args.save_baseline else previous
+
+    env = environment()
+    if args.save_baseline:
+        pins = pinned_versions()
+        _warn_mismatches(
+            "the baseline is recorded with unpinned versions",
+            mismatches(env, pins, [_package for _package in VERSIONED_PACKAGES
+                                   if _package in pins]), "pinned")
+    elif baseline:
+        _warn_mismatches(
+            "the baseline was recorded in another environment, timings may "
+            "not be comparable", mismatches(env, previous_env), "baseline")
+
+    results = {}
+    for _name in names:
+        results[_name] = run_benchmark(_name, args.repeat)
+        print(_row(_name, results[_name], baseline.get(_name)), flush=True)
+
+    report = {"environment": env,
+              "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "results": results}
+    if args.save_baseline:
+        # benchmarks that were not run keep their baseline
+        report["results"] = {**previous, **results}
+    output = args.baseline if args.save_baseline else args.output
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    regressions = compare(results, baseline, time_tolerance=args.tolerance)
+    for _name, _message in regressions.items():
+        print(f"REGRESSION {_name}: {_message}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,586 @@
+import os
+import json
+import errno
+import mmap
+import time
+import uuid
+import struct
+import sqlite3
+import hashlib
+import tempfile
+import warnings
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# root directory for all files written by the app (jobs, caches, uploads),
+# must be on persistent storage for the disk cache to survive restarts; the
+# temporary directory is only a fallback (it may be cleared on reboot)
+CACHE_DIR = Path(os.environ.get(
+    "CARSPY_CACHE_DIR", Path(tempfile.gettempdir()) / "carspy-dash"))
+# memory budget of the in-process spectrum cache (in MB)
+CACHE_MAX_MB = float(os.environ.get("CARSPY_CACHE_MB", 256))
+# number of fit results kept for reuse and warm starts
+FIT_CACHE_ITEMS = int(os.environ.get("CARSPY_FIT_CACHE_SIZE", 128))
+# size of the cache shared by all workers on this host (in MB, 0 disables it)
+SHARED_CACHE_MB = float(os.environ.get("CARSPY_SHARED_CACHE_MB", 512))
+# in shared memory (tmpfs) if available, one directory per CACHE_DIR
+SHARED_CACHE_DIR = Path(os.environ.get(
+    "CARSPY_SHARED_CACHE_DIR",
+    Path("/dev/shm" if os.path.isdir("/dev/shm") else CACHE_DIR)
+    / ("carspy-dash-"
+       + hashlib.sha1(str(CACHE_DIR).encode()).hexdigest()[:8])))
+# size of the persistent cache of synthesized spectra (in MB, 0 disables it)
+DISK_CACHE_MB = float(os.environ.get("CARSPY_DISK_CACHE_MB", 1024))
+DISK_CACHE_DIR = CACHE_DIR / "spectra"
+
+
+def _canonical(value):
+    # turn settings into a JSON-stable structure (sorted keys, fixed floats)
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(
+            np.ascontiguousarray(value, dtype=float).tobytes()).hexdigest()
+    if isinstance(value, (bool, np.bool_)) or value is None:
+        return value
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return repr(round(float(value), 10))
+    return str(value)
+
+
+def settings_key(*args, **kwargs):
+    _payload = json.dumps(_canonical([args, kwargs]), sort_keys=True,
+                          separators=(",", ":"))
+    return hashlib.sha1(_payload.encode()).hexdigest()
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    return 64
+
+
+def _freeze(value):
+    # cached arrays are shared between callers and must not be modified
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (list, tuple)):
+        for _v in value:
+            _freeze(_v)
+    return value
+
+
+class LRUCache():
+    """Thread-safe LRU cache bounded by memory (bytes) and/or item count."""
+
+    def __init__(self, max_bytes=None, max_items=None):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return value
+        _freeze(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+        return value
+
+    def items(self):
+        with self._lock:
+            return [(_key, _value) for _key, (_value, _) in self._data.items()]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                value, size = self._data.pop(key)
+                self.nbytes -= size
+                return value
+            return default
+
+    def _evict(self):
+        while self._data and (
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)
+                or (self.max_items is not None
+                    and len(self._data) > self.max_items)):
+            _, (_, size) = self._data.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        _total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits/_total if _total else 0.0,
+            "evictions": self.evictions,
+            "items": len(self._data),
+            "nbytes": self.nbytes,
+        }
+
+
+# (nested) lists, tuples and dicts of arrays and JSON values, stored as a JSON
+# header followed by the raw arrays, each aligned to _ALIGN bytes
+_MAGIC = b"CARSPY01"
+_ALIGN = 64
+
+
+def _pack(value, arrays):
+    if isinstance(value, np.ndarray):
+        arrays.append(np.ascontiguousarray(value))
+        return {"__array__": len(arrays) - 1}
+    if isinstance(value, tuple):
+        return {"__tuple__": [_pack(_v, arrays) for _v in value]}
+    if isinstance(value, list):
+        return [_pack(_v, arrays) for _v in value]
+    if isinstance(value, dict):
+        return {"__dict__": {str(_k): _pack(_v, arrays)
+                             for _k, _v in value.items()}}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _unpack(value, arrays):
+    if isinstance(value, list):
+        return [_unpack(_v, arrays) for _v in value]
+    if isinstance(value, dict):
+        if "__array__" in value:
+            return arrays[value["__array__"]]
+        if "__tuple__" in value:
+            return tuple(_unpack(_v, arrays) for _v in value["__tuple__"])
+        return {_k: _unpack(_v, arrays)
+                for _k, _v in value["__dict__"].items()}
+    return value
+
+
+def _padded(size):
+    return -(-size//_ALIGN)*_ALIGN
+
+
+def write_mapped(path, value):
+    """Write value to a file that read_mapped() maps without copying."""
+    arrays = []
+    structure = _pack(value, arrays)
+    specs, offset = [], 0
+    for _array in arrays:
+        specs.append({"dtype": _array.dtype.str, "shape": _array.shape,
+                      "offset": offset})
+        offset += _padded(_array.nbytes)
+    header = json.dumps({"value": structure, "arrays": specs}).encode()
+    start = _padded(len(_MAGIC) + 8 + len(header))
+    with open(path, "wb") as f:
+        f.write(_MAGIC + struct.pack("<Q", len(header)) + header)
+        for _array, _spec in zip(arrays, specs):
+            f.seek(start + _spec["offset"])
+            f.write(_array.data)
+        f.truncate(start + offset)
+    return start + offset
+
+
+def read_mapped(path):
+    """Read a file written by write_mapped(), arrays are read-only views."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("empty file")
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(_MAGIC)] != _MAGIC:
+        raise ValueError("not a mapped cache file")
+    size, = struct.unpack("<Q", buffer[len(_MAGIC):len(_MAGIC) + 8])
+    header = json.loads(buffer[len(_MAGIC) + 8:len(_MAGIC) + 8 + size])
+    start = _padded(len(_MAGIC) + 8 + size)
+    arrays = []
+    for _spec in header["arrays"]:
+        dtype = np.dtype(_spec["dtype"])
+        count = int(np.prod(_spec["shape"]))
+        arrays.append(np.frombuffer(
+            buffer, dtype=dtype, count=count,
+            offset=start + _spec["offset"]).reshape(_spec["shape"]))
+    return _unpack(header["value"], arrays)
+
+
+class MappedCache():
+    """Cache of arrays in memory-mapped files, shared by all processes.
+
+    One file per key. Readers map the files without locks or copies; the
+    mapping stays valid even if the file is replaced or evicted meanwhile.
+    New entries are written to a temporary file and renamed into place
+    (atomic), after which the writer evicts the least recently used files
+    while holding an exclusive lock on the directory, so only one process
+    evicts at a time. Reads update the modification time used for LRU. The
+    size limit is reduced to the space available on the file system at
+    startup, and if a write still runs out of space, entries are evicted to
+    make room for it.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        if max_bytes > 0 and fcntl is not None:
+            self.max_bytes = min(max_bytes, self._available())
+            if self.max_bytes < max_bytes:
+                warnings.warn(
+                    f"the shared cache is limited to "
+                    f"{self.max_bytes/2**20:.0f} MB, the space available in "
+                    f"{self.directory}", RuntimeWarning)
+        self.enabled = self.max_bytes > 0 and fcntl is not None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # free space of the file system plus the entries already cached
+    def _available(self):
+        path = self.directory
+        while not path.exists() and path != path.parent:
+            path = path.parent
+        try:
+            stat = os.statvfs(path)
+        except OSError:
+            return self.max_bytes
+        available = stat.f_bavail*stat.f_frsize
+        if self.directory.exists():
+            available += sum(_e[1] for _e in self._entries())
+        return available
+
+    def _path(self, key):
+        return self.directory / f"{key}.dat"
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        path = self._path(key)
+        try:
+            value = read_mapped(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted meanwhile, the mapping is still valid
+            pass
+        return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return value
+        os.makedirs(self.directory, exist_ok=True)
+        for _attempt in range(2):
+            _tmp = self.directory / f".{key}.{uuid.uuid4().hex[:8]}.tmp"
+            try:
+                size = write_mapped(_tmp, value)
+                if size > self.max_bytes:
+                    os.remove(_tmp)
+                    return value
+                with self._locked():
+                    os.replace(_tmp, self._path(key))
+                    self._evict()
+                return value
+            except OSError as e:
+                try:
+                    os.remove(_tmp)
+                except OSError:
+                    pass
+                if e.errno != errno.ENOSPC or _attempt:
+                    # the entry is just not shared
+                    return value
+            # the file system is full (e.g. the shared memory is also used by
+            # others), make room for the entry (plus its header) and retry
+            with self._locked():
+                self._evict(needed=_nbytes(value) + 2**16)
+        return value
+
+    @contextmanager
+    def _locked(self):
+        with open(self.directory / ".lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _entries(self):
+        entries = []
+        for _entry in os.scandir(self.directory):
+            try:
+                _stat = _entry.stat()
+            except OSError:
+                continue
+            if _entry.name.endswith(".dat"):
+                entries.append((_stat.st_mtime, _stat.st_size, _entry.path))
+            elif _entry.name.endswith(".tmp") \
+                    and time.time() - _stat.st_mtime > 60:
+                # left behind by a crashed writer
+                entries.append((0, 0, _entry.path))
+        return entries
+
+    # evict down to 90% of the limit, so that not every put has to evict, and
+    # by at least `needed` bytes
+    def _evict(self, needed=0):
+        entries = self._entries()
+        total = sum(_e[1] for _e in entries)
+        if total <= self.max_bytes and not needed:
+            return
+        target = min(0.9*self.max_bytes, total - needed)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        if not self.directory.exists():
+            return
+        with self._locked():
+            for _, _, path in self._entries():
+                os.remove(path)
+
+    def stats(self):
+        entries = self._entries() if self.directory.exists() else []
+        _total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits/_total if _total else 0.0,
+            "evictions": self.evictions,
+            # these describe the whole (shared) directory
+            "items": len(entries),
+            "nbytes": sum(_e[1] for _e in entries),
+            "shared": True,
+        }
+
+
+class DiskCache():
+    """Persistent cache of arrays in memory-mapped files with an index.
+
+    Files have the same format as in MappedCache. The index (SQLite) holds
+    the size, the last access and the number of requests of every entry,
+    plus the settings it was computed from, so that the most requested
+    entries can be recomputed (warm-up) once they are lost. Entries are
+    evicted least recently used first once the size limit is exceeded.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.enabled = max_bytes > 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        return self.directory / f"{key}.dat"
+
+    def _connect(self):
+        os.makedirs(self.directory, exist_ok=True)
+        conn = sqlite3.connect(str(self.directory / "index.sqlite"),
+                               timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY "
+                     "KEY, settings TEXT, size INTEGER, created REAL, "
+                     "accessed REAL, requests INTEGER)")
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON "
+                     "entries (accessed)")
+        return conn
+
+    def get(self, key, default=None, count=True):
+        if not self.enabled:
+            return default
+        conn = self._connect()
+        try:
+            # requests are counted on misses too, so that evicted entries
+            # requested often are recomputed by the warm-up
+            if count:
+                conn.execute(
+                    "INSERT INTO entries (key, accessed, requests) VALUES "
+                    "(?, ?, 1) ON CONFLICT (key) DO UPDATE SET "
+                    "accessed=excluded.accessed, requests=requests+1",
+                    (key, time.time()))
+            row = conn.execute("SELECT size FROM entries WHERE key=?",
+                               (key,)).fetchone()
+            if row is not None and row[0] is not None:
+                try:
+                    value = read_mapped(self._path(key))
+                except (OSError, ValueError):
+                    # lost (e.g. removed by hand), recomputed when asked for
+                    conn.execute("UPDATE entries SET size=NULL WHERE key=?",
+                                 (key,))
+                else:
+                    self.hits += 1
+                    return value
+        finally:
+            conn.close()
+        self.misses += 1
+        return default
+
+    def put(self, key, value, settings=None):
+        if not self.enabled:
+            return value
+        os.makedirs(self.directory, exist_ok=True)
+        _tmp = self.directory / f".{key}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            size = write_mapped(_tmp, value)
+            os.replace(_tmp, self._path(key))
+        except OSError:
+            try:
+                os.remove(_tmp)
+            except OSError:
+                pass
+            return value
+        _now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, 1) ON CONFLICT "
+                "(key) DO UPDATE SET settings=excluded.settings, "
+                "size=excluded.size, created=excluded.created, "
+                "accessed=excluded.accessed",
+                (key, None if settings is None else json.dumps(settings), size,
+                 _now, _now))
+            self._evict(conn)
+        finally:
+            conn.close()
+        return value
+
+    # evict down to 90% of the limit, so that not every put has to evict
+    def _evict(self, conn):
+        total, = conn.execute("SELECT COALESCE(SUM(size), 0) FROM "
+                              "entries").fetchone()
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute(
+                "SELECT key, size FROM entries WHERE size IS NOT NULL "
+                "ORDER BY accessed").fetchall():
+            if total <= 0.9*self.max_bytes:
+                break
+            # the index entry is kept (without size) to count the requests
+            if conn.execute("UPDATE entries SET size=NULL WHERE key=? AND "
+                            "size=?", (key, size)).rowcount:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+                total -= size
+                self.evictions += 1
+
+    def most_requested(self, n):
+        """Keys and settings of the n most requested entries."""
+        if not self.enabled:
+            return []
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT key, settings, size IS NOT NULL FROM entries WHERE "
+                "settings IS NOT NULL ORDER BY requests DESC LIMIT ?",
+                (n,)).fetchall()
+        finally:
+            conn.close()
+        return [(_key, json.loads(_settings), bool(_stored))
+                for _key, _settings, _stored in rows]
+
+    def prune(self):
+        """Remove files without index entry (e.g. left by a crash)."""
+        if not self.enabled or not self.directory.exists():
+            return
+        conn = self._connect()
+        try:
+            # forget entries not stored and not requested for a long time
+            conn.execute("DELETE FROM entries WHERE size IS NULL AND "
+                         "accessed < ?", (time.time() - 30*86400,))
+            stored = {_key for _key, in conn.execute(
+                "SELECT key FROM entries WHERE size IS NOT NULL")}
+        finally:
+            conn.close()
+        for _entry in os.scandir(self.directory):
+            _name = _entry.name
+            if (_name.endswith(".dat") and _name[:-4] not in stored) \
+                    or _name.endswith(".tmp"):
+                try:
+                    if time.time() - _entry.stat().st_mtime > 60:
+                        os.remove(_entry.path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        items, nbytes = 0, 0
+        if self.enabled and self.directory.exists():
+            conn = self._connect()
+            try:
+                items, nbytes = conn.execute(
+                    "SELECT COUNT(size), COALESCE(SUM(size), 0) FROM "
+                    "entries").fetchone()
+            finally:
+                conn.close()
+        _total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits/_total if _total else 0.0,
+            "evictions": self.evictions,
+            "items": items,
+            "nbytes": nbytes,
+            "shared": True,
+        }
+
+
+# shared by all callbacks (and users) served by this process
+SPECTRUM_CACHE = LRUCache(max_bytes=int(CACHE_MAX_MB*2**20))
+FIT_CACHE = LRUCache(max_items=FIT_CACHE_ITEMS)
+# shared by all workers on this host
+SHARED_CACHE = MappedCache(SHARED_CACHE_DIR,
+                           max_bytes=int(SHARED_CACHE_MB*2**20))
+# kept across restarts
+DISK_CACHE = DiskCache(DISK_CACHE_DIR, max_bytes=int(DISK_CACHE_MB*2**20))
+if DISK_CACHE.enabled and "CARSPY_CACHE_DIR" not in os.environ:
+    warnings.warn(f"CARSPY_CACHE_DIR is not set, the disk cache is kept in "
+                  f"{CACHE_DIR}, which may not survive a restart",
+                  RuntimeWarning)
@@ -0,0 +1,23 @@
+import gc
+import multiprocessing
+
+# the app (and with it the default spectra, fit signal and layouts) is loaded
+# once in the master and shared copy-on-write by the forked workers; the
+# number of workers is set by WEB_CONCURRENCY
+preload_app = True
+# workers silent for longer are restarted, API requests wait at most
+# CARSPY_API_MAX_WAIT (10 s) for their results
+timeout = 30
+
+
+def when_ready(server):
+    import utils
+    utils.preload()
+    # keep the garbage collector of the workers from touching (and thus
+    # copying) the objects created by the master
+    gc.collect()
+    gc.freeze()
+    # load the most requested spectra from disk into the shared cache (or
+    # recompute them) without delaying the workers
+    if utils.WARM_UP_ITEMS:
+        multiprocessing.Process(target=utils.warm_up, daemon=True).start()
@@ -6,10 +6,19 @@ from app import app
 from navbar import navbar, navbar_tabs
 from utils import (DEFAULT_SETTINGS_CONDITIONS, DEFAULT_SETTINGS_MODELS,
                    DEFAULT_SPECTRUM, DEFAULT_SETTINGS_SLIT,
-                   DEFAULT_SETTINGS_FIT, DEFAULT_FIT_SIGNAL)
+                   DEFAULT_SETTINGS_FIT, DEFAULT_SETTINGS_SOLVER,
+                   DEFAULT_FIT_SIGNAL)
+from store import ARRAY_STORE, new_session_id
+import api  # noqa: F401 (registers the /api routes)
+from metrics import instrument_callbacks, register_metrics_route
+from profiling import register_profiling
 
 server = app.server
 
+# default arrays are kept server-side, the stores only hold their keys
+DEFAULT_SPECTRUM_KEY = ARRAY_STORE.pin(DEFAULT_SPECTRUM)
+DEFAULT_FIT_SIGNAL_KEY = ARRAY_STORE.pin(DEFAULT_FIT_SIGNAL)
+
 footer = html.Footer(
     [
         dbc.Container(
@@ -22,8 +31,15 @@ footer = html.Footer(
     className="p-3 text-center"
 )
 
-app.layout = html.Div(
+
+# a new session id is issued every time the page is loaded
+def serve_layout():
+    return html.Div(
         [
+            dcc.Store(
+                id="session-id",
+                data=new_session_id()
+            ),
             dcc.Store(
                 id="memory-settings-conditions",
                 data=DEFAULT_SETTINGS_CONDITIONS
@@ -34,15 +50,50 @@ app.layout = html.Div(
             ),
             dcc.Store(
                 id="memory-synth-spectrum",
-                data=DEFAULT_SPECTRUM
+                data=DEFAULT_SPECTRUM_KEY
             ),
             dcc.Store(
                 id="memory-fit-signal",
-                data=DEFAULT_FIT_SIGNAL
+                data=DEFAULT_FIT_SIGNAL_KEY
             ),
             dcc.Store(
                 id="memory-fit-report",
             ),
+            dcc.Store(
+                id="memory-fit-job",
+            ),
+            dcc.Store(
+                id="memory-fit-progress",
+            ),
+            dcc.Store(
+                id="memory-fit-cancel",
+            ),
+            dcc.Interval(
+                id="fit-poll",
+                interval=1000,
+                disabled=True
+            ),
+            dcc.Store(
+                id="memory-upload",
+            ),
+            dcc.Store(
+                id="memory-batch-data",
+            ),
+            dcc.Store(
+                id="memory-batch-job",
+            ),
+            dcc.Store(
+                id="memory-batch-progress",
+            ),
+            dcc.Store(
+                id="memory-batch-cancel",
+            ),
+            dcc.Store(
+                id="memory-synth-figure",
+            ),
+            dcc.Store(
+                id="memory-fit-figure",
+            ),
             dcc.Store(
                 id="memory-settings-slit",
                 data=DEFAULT_SETTINGS_SLIT
@@ -51,6 +102,10 @@ app.layout = html.Div(
                 id="memory-settings-fit",
                 data=DEFAULT_SETTINGS_FIT
             ),
+            dcc.Store(
+                id="memory-settings-solver",
+                data=DEFAULT_SETTINGS_SOLVER
+            ),
             navbar,
             navbar_tabs,
             dbc.Container(
@@ -62,5 +117,13 @@ app.layout = html.Div(
     )
 
 
+app.layout = serve_layout
+
+# all callbacks are registered at this point
+instrument_callbacks(app)
+register_metrics_route(server)
+register_profiling(app)
+
+
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import sqlite3
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from cache import CACHE_DIR
+from profiling import profile_job
+
+# job table shared by all workers on this host
+JOBS_DB = os.environ.get("CARSPY_JOBS_DB", str(CACHE_DIR / "jobs.sqlite"))
+# number of processes running fits (per web worker)
+JOB_WORKERS = int(os.environ.get("CARSPY_JOB_WORKERS",
+                                 max(1, (os.cpu_count() or 2)//2)))
+# number of processes for batch fits (per web worker)
+BATCH_WORKERS = int(os.environ.get("CARSPY_BATCH_WORKERS",
+                                   os.cpu_count() or 1))
+# finished jobs are removed after this many seconds
+JOB_MAX_AGE = float(os.environ.get("CARSPY_JOB_MAX_AGE", 24*3600))
+# minimum time (in s) between two progress updates written by a job
+PROGRESS_INTERVAL = 0.2
+# a running job writes a heartbeat every JOB_HEARTBEAT seconds, without one
+# for JOB_STALE_AFTER seconds (its process died) the job is marked failed
+JOB_HEARTBEAT = 10.
+JOB_STALE_AFTER = float(os.environ.get("CARSPY_JOB_STALE_AFTER", 60))
+# the browser stops polling a job (and cancels it) after this many seconds
+POLL_TIMEOUT = float(os.environ.get("CARSPY_POLL_TIMEOUT", 3600))
+
+FINISHED = ("done", "failed", "cancelled")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT,
+    status TEXT,
+    submitted REAL,
+    started REAL,
+    finished REAL,
+    result BLOB,
+    error TEXT,
+    progress TEXT,
+    batch TEXT,
+    owner INTEGER,
+    heartbeat REAL
+)
+"""
+# columns added after the first version of the table
+_NEW_COLUMNS = ("progress TEXT", "batch TEXT", "owner INTEGER",
+                "heartbeat REAL")
+
+_pools = {}
+_pool_lock = threading.Lock()
+# (db_path, job_id, time of last progress update) of the job running in this
+# process, if any
+_current = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _connect(db_path=JOBS_DB):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(_SCHEMA)
+    for _column in _NEW_COLUMNS:
+        try:
+            conn.execute("ALTER TABLE jobs ADD COLUMN " + _column)
+        except sqlite3.OperationalError:
+            pass
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+    return conn
+
+
+def _executor(name="jobs"):
+    with _pool_lock:
+        if name not in _pools:
+            _pools[name] = ProcessPoolExecutor(
+                max_workers=BATCH_WORKERS if name == "batch" else JOB_WORKERS)
+        return _pools[name]
+
+
+# drop a broken pool (one of its processes died), the next job starts a new
+# one
+def _reset_executor(name, pool):
+    with _pool_lock:
+        if _pools.get(name) is pool:
+            del _pools[name]
+    pool.shutdown(wait=False)
+
+
+def _submit_job(name, job_id, func, args, kwargs):
+    for _attempt in range(2):
+        _pool = _executor(name)
+        try:
+            future = _pool.submit(_run_job, JOBS_DB, job_id,
+                                  profile_job(func), args, kwargs)
+        except BrokenProcessPool:
+            _reset_executor(name, _pool)
+            continue
+        future.add_done_callback(
+            lambda _future: _job_done(name, _pool, job_id, _future,
+                                      (func, args, kwargs)))
+        return
+    _job_lost(JOBS_DB, job_id, "the job pool could not be started")
+
+
+# called in the web worker when the future of a job is resolved, _run_job
+# records the outcome itself unless its process died; jobs that were still
+# queued in a broken pool are moved to a new one
+def _job_done(name, pool, job_id, future, call):
+    if future.cancelled() or future.exception() is None:
+        return
+    if isinstance(future.exception(), BrokenProcessPool):
+        _reset_executor(name, pool)
+        if _update(JOBS_DB, job_id, where_status="queued",
+                   owner=os.getpid()):
+            _submit_job(name, job_id, *call)
+            return
+    _job_lost(JOBS_DB, job_id, repr(future.exception()))
+
+
+def _job_lost(db_path, job_id, reason):
+    conn = _connect(db_path)
+    try:
+        conn.execute("UPDATE jobs SET status='failed', finished=?, error=? "
+                     "WHERE id=? AND status NOT IN ('done', 'failed', "
+                     "'cancelled')",
+                     (time.time(), "Job lost: " + reason, job_id))
+    finally:
+        conn.close()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+# fail the jobs whose process died (no heartbeat) and the queued jobs of web
+# workers that are gone (e.g. restarted), they would never finish
+def _fail_stale(conn):
+    _now = time.time()
+    conn.execute("UPDATE jobs SET status='failed', finished=?, error=? "
+                 "WHERE status IN ('running', 'cancelling') "
+                 "AND COALESCE(heartbeat, started, submitted) < ?",
+                 (_now, "Job lost: no heartbeat from its process",
+                  _now - JOB_STALE_AFTER))
+    owners = [_owner for _owner, in conn.execute(
+        "SELECT DISTINCT owner FROM jobs WHERE status='queued' "
+        "AND owner IS NOT NULL")]
+    for _owner in owners:
+        if not _alive(_owner):
+            conn.execute("UPDATE jobs SET status='failed', finished=?, "
+                         "error=? WHERE status='queued' AND owner=?",
+                         (_now, "Job lost: the web worker that queued it "
+                          "has stopped", _owner))
+
+
+def _beat(db_path, job_id, stop):
+    while not stop.wait(JOB_HEARTBEAT):
+        _update(db_path, job_id, heartbeat=time.time())
+
+
+def _update(db_path, job_id, where_status=None, **fields):
+    conn = _connect(db_path)
+    query = ("UPDATE jobs SET " + ", ".join(f"{_k}=?" for _k in fields)
+             + " WHERE id=?")
+    values = (*fields.values(), job_id)
+    if where_status is not None:
+        query += " AND status=?"
+        values += (where_status,)
+    try:
+        return conn.execute(query, values).rowcount
+    finally:
+        conn.close()
+
+
+# executed in the worker process
+def _run_job(db_path, job_id, func, args, kwargs):
+    global _current
+    if not _update(db_path, job_id, where_status="queued", status="running",
+                   started=time.time()):
+        # cancelled before it was started
+        _update(db_path, job_id, status="cancelled", finished=time.time())
+        return
+    _current = [db_path, job_id, 0.0]
+    stop = threading.Event()
+    threading.Thread(target=_beat, args=(db_path, job_id, stop),
+                     daemon=True).start()
+    try:
+        result = func(*args, **kwargs)
+    except JobCancelled:
+        _update(db_path, job_id, status="cancelled", finished=time.time())
+    except Exception:
+        _update(db_path, job_id, status="failed", finished=time.time(),
+                error=traceback.format_exc())
+    else:
+        _update(db_path, job_id, status="done", finished=time.time(),
+                result=pickle.dumps(result))
+    finally:
+        stop.set()
+        _current = None
+
+
+# called from within a running job, returns True if the job should stop
+def report_progress(**progress):
+    if _current is None:
+        return False
+    db_path, job_id, last_update = _current
+    if time.monotonic() - last_update < PROGRESS_INTERVAL:
+        return False
+    _current[2] = time.monotonic()
+    conn = _connect(db_path)
+    try:
+        conn.execute("UPDATE jobs SET progress=? WHERE id=?",
+                     (json.dumps(progress), job_id))
+        row = conn.execute("SELECT status FROM jobs WHERE id=?",
+                           (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return row is not None and row[0] == "cancelling"
+
+
+def cancel(job_id):
+    conn = _connect()
+    try:
+        conn.execute("UPDATE jobs SET status='cancelling' WHERE "
+                     "(id=? OR batch=?) AND status IN ('queued', 'running')",
+                     (job_id, job_id))
+    finally:
+        conn.close()
+
+
+def submit(func, *args, kind="fit", **kwargs):
+    job_id = uuid.uuid4().hex
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM jobs WHERE finished < ?",
+                     (time.time() - JOB_MAX_AGE,))
+        conn.execute("INSERT INTO jobs (id, kind, status, submitted, owner) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (job_id, kind, "queued", time.time(), os.getpid()))
+    finally:
+        conn.close()
+    _submit_job("jobs", job_id, func, args, kwargs)
+    return job_id
+
+
+# submit many calls of the same function as one batch, spread across all
+# cores, returns the batch id
+def submit_batch(func, args_list, kind="batch", **kwargs):
+    batch_id = uuid.uuid4().hex
+    job_ids = [uuid.uuid4().hex for _ in args_list]
+    _now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM jobs WHERE finished < ?",
+                     (_now - JOB_MAX_AGE,))
+        conn.executemany("INSERT INTO jobs (id, kind, status, submitted, "
+                         "batch, owner) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(_id, kind, "queued", _now, batch_id, os.getpid())
+                          for _id in job_ids])
+    finally:
+        conn.close()
+    for _id, _args in zip(job_ids, args_list):
+        _submit_job("batch", _id, func, _args, kwargs)
+    return batch_id
+
+
+# state of a batch from the counts of its jobs, no result is loaded
+def batch_status(batch_id):
+    conn = _connect()
+    try:
+        _fail_stale(conn)
+        rows = conn.execute(
+            "SELECT status, COUNT(*), MIN(started), MAX(finished) FROM jobs "
+            "WHERE batch=? GROUP BY status",
+            (batch_id,)).fetchall()
+    finally:
+        conn.close()
+    counts = {_status: _count for _status, _count, _, _ in rows}
+    total = sum(counts.values())
+    # only jobs that returned a result are done
+    done = counts.get("done", 0)
+    started = [_row[2] for _row in rows if _row[2] is not None]
+    finished = [_row[3] for _row in rows if _row[3] is not None]
+    if not rows:
+        _status = "unknown"
+    elif sum(counts.get(_s, 0) for _s in FINISHED) < total:
+        _status = "cancelling" if "cancelling" in counts else "running"
+    elif "cancelled" in counts:
+        _status = "cancelled"
+    else:
+        _status = "done" if done else "failed"
+    return {
+        "id": batch_id,
+        "status": _status,
+        "jobs": total,
+        "done": done,
+        "counts": counts,
+        "started": min(started) if started else None,
+        "finished": max(finished) if finished else None,
+    }
+
+
+# each job of a batch returns a list of records, which are collected here in
+# the order the jobs finished; jobs whose ids are in `loaded` are skipped, so
+# a poller only unpickles the results that are new since its last call.
+# Returns the ids of the jobs read, their records and their errors.
+def batch_results(batch_id, loaded=()):
+    conn = _connect()
+    try:
+        new = [_id for _id, in conn.execute(
+            "SELECT id FROM jobs WHERE batch=? AND finished IS NOT NULL",
+            (batch_id,)) if _id not in loaded]
+        rows = []
+        # stay below SQLite's limit of bound parameters
+        for _start in range(0, len(new), 500):
+            _ids = new[_start:_start + 500]
+            rows.extend(conn.execute(
+                "SELECT id, finished, result, error FROM jobs WHERE id IN "
+                f"({', '.join('?'*len(_ids))})", _ids).fetchall())
+    finally:
+        conn.close()
+    rows.sort(key=lambda _row: _row[1])
+    results = []
+    errors = []
+    for _, _, result, error in rows:
+        if result is not None:
+            results.extend(pickle.loads(result))
+        if error is not None:
+            errors.append(error)
+    return [_row[0] for _row in rows], results, errors
+
+
+# record an already available result (e.g. from a cache) as a finished job
+def complete(result, kind="fit"):
+    job_id = uuid.uuid4().hex
+    _now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("INSERT INTO jobs (id, kind, status, submitted, started, "
+                     "finished, result) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (job_id, kind, "done", _now, _now, _now,
+                      pickle.dumps(result)))
+    finally:
+        conn.close()
+    return job_id
+
+
+def status(job_id):
+    conn = _connect()
+    try:
+        _fail_stale(conn)
+        row = conn.execute(
+            "SELECT status, submitted, started, finished, result, error, "
+            "progress FROM jobs WHERE id=?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return {"id": job_id, "status": "unknown"}
+    _status, submitted, started, finished, result, error, progress = row
+    return {
+        "id": job_id,
+        "status": _status,
+        "submitted": submitted,
+        "started": started,
+        "finished": finished,
+        "result": pickle.loads(result) if result is not None else None,
+        "error": error,
+        "progress": json.loads(progress) if progress else {},
+    }
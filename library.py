@@ -0,0 +1,267 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import jobs
+from cache import CACHE_DIR, LRUCache, settings_key
+from utils import setup_fit, fit_config_key, expt_synth_batch
+
+LIBRARY_DIR = CACHE_DIR / "library"
+# size of the libraries kept on disk (in MB, 0 disables it), the least
+# recently used are deleted beyond it
+LIBRARY_MAX_MB = float(os.environ.get("CARSPY_LIBRARY_MB", 512))
+# initial temperature grid of a library
+LIBRARY_TEMPERATURES = np.arange(250, 3001, 50, dtype=float)
+# grid points are added between neighbours whose (normalized) spectra differ
+# by more than this, down to a minimum spacing (in K)
+LIBRARY_TOL = 0.02
+LIBRARY_MIN_STEP = 5.
+LIBRARY_WORKERS = int(os.environ.get("CARSPY_LIBRARY_WORKERS",
+                                     os.cpu_count() or 1))
+
+# libraries loaded by this process
+_LIBRARIES = LRUCache(max_items=8)
+
+
+class SpectralLibrary():
+    """Slit-convolved, downsampled spectra on a temperature grid.
+
+    All spectra are synthesized on the spectral axis of the signal to be
+    fitted and normalized by their peak, the same way as in CarsFit.
+    """
+
+    def __init__(self, key, nu, temperatures, spectra):
+        self.key = key
+        self.nu = np.asarray(nu, dtype=float)
+        order = np.argsort(temperatures)
+        self.temperatures = np.asarray(temperatures, dtype=float)[order]
+        self.spectra = np.asarray(spectra, dtype=float)[order]
+
+    @property
+    def path(self):
+        return LIBRARY_DIR / f"{self.key}.npz"
+
+    def save(self, max_bytes=int(LIBRARY_MAX_MB*2**20)):
+        if max_bytes <= 0:
+            return
+        os.makedirs(LIBRARY_DIR, exist_ok=True)
+        _tmp = self.path.with_suffix(".tmp.npz")
+        np.savez(_tmp, nu=self.nu, temperatures=self.temperatures,
+                 spectra=self.spectra)
+        os.replace(_tmp, self.path)
+        evict_libraries(max_bytes, keep=self.path)
+
+    # the modification time of the file is its last use (for the eviction)
+    def touch(self):
+        try:
+            os.utime(self.path)
+        except OSError:
+            pass
+
+    @classmethod
+    def load(cls, key):
+        _path = LIBRARY_DIR / f"{key}.npz"
+        if not _path.exists():
+            return None
+        with np.load(_path) as data:
+            return cls(key, data["nu"], data["temperatures"], data["spectra"])
+
+    def add(self, temperatures, spectra):
+        temperatures = np.concatenate([self.temperatures, temperatures])
+        order = np.argsort(temperatures)
+        self.temperatures = temperatures[order]
+        self.spectra = np.concatenate([self.spectra, spectra])[order]
+
+    # temperatures to insert where neighbouring spectra differ too much
+    def refinement(self, tol=LIBRARY_TOL, min_step=LIBRARY_MIN_STEP):
+        diff = np.abs(np.diff(self.spectra, axis=0)).max(axis=1)
+        step = np.diff(self.temperatures)
+        idx = np.flatnonzero((diff > tol) & (step >= 2*min_step))
+        return (self.temperatures[idx] + self.temperatures[idx+1])/2
+
+    # vectorized fit of one (1d) or many (2d, one signal per row) spectra
+    def fit(self, signals):
+        signals = np.atleast_2d(np.asarray(signals, dtype=float))
+        signals = np.clip(np.nan_to_num(signals), 0, None)
+        signals = signals/signals.max(axis=1, keepdims=True)
+        # |S - s|^2 = |S|^2 - 2 S.s + |s|^2 for all shots and temperatures
+        residuals = ((self.spectra**2).sum(axis=1)[None, :]
+                     - 2*signals @ self.spectra.T
+                     + (signals**2).sum(axis=1)[:, None])
+        idx = np.clip(np.argmin(residuals, axis=1), 1,
+                      len(self.temperatures) - 2)
+        rows = np.arange(len(signals))
+        # vertex of the parabola through the best point and its neighbours
+        t_0, t_1, t_2 = (self.temperatures[idx-1], self.temperatures[idx],
+                         self.temperatures[idx+1])
+        r_0, r_1, r_2 = (residuals[rows, idx-1], residuals[rows, idx],
+                         residuals[rows, idx+1])
+        _num = (t_1 - t_0)**2*(r_1 - r_2) - (t_1 - t_2)**2*(r_1 - r_0)
+        _den = (t_1 - t_0)*(r_1 - r_2) - (t_1 - t_2)*(r_1 - r_0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            T_fit = np.where(np.abs(_den) > 0, t_1 - 0.5*_num/_den, t_1)
+        T_fit = np.clip(np.nan_to_num(T_fit, nan=t_1), t_0, t_2)
+        return T_fit, residuals[rows, idx]
+
+    # spectrum at arbitrary temperature by linear interpolation on the grid
+    def spectrum(self, temperature):
+        idx = np.clip(np.searchsorted(self.temperatures, temperature), 1,
+                      len(self.temperatures) - 1)
+        t_0, t_1 = self.temperatures[idx-1], self.temperatures[idx]
+        w = np.clip((temperature - t_0)/(t_1 - t_0), 0, 1)
+        return (1 - w)*self.spectra[idx-1] + w*self.spectra[idx]
+
+
+# delete the least recently used libraries down to 90% of the limit, so that
+# not every save has to evict
+def evict_libraries(max_bytes, keep=None):
+    files = []
+    for _path in LIBRARY_DIR.glob("*.npz"):
+        # files being written by a save
+        if _path.name.endswith(".tmp.npz"):
+            continue
+        try:
+            _stat = _path.stat()
+        except OSError:
+            continue
+        files.append((_stat.st_mtime, _stat.st_size, _path))
+    total = sum(_size for _, _size, _ in files)
+    if total <= max_bytes:
+        return
+    for _, _size, _path in sorted(files):
+        if total <= 0.9*max_bytes:
+            break
+        if _path == keep:
+            continue
+        try:
+            os.remove(_path)
+        except OSError:
+            continue
+        total -= _size
+
+
+def library_key(nu_expt, slit_parameters, settings_models,
+                settings_conditions):
+    return settings_key(np.asarray(nu_expt, dtype=float), slit_parameters,
+                        fit_config_key(settings_models, settings_conditions))
+
+
+def _library_spectra(fit_args, temperatures):
+    fit_expt, params = setup_fit(*fit_args)
+    values = {_param[0]: _param[1] for _param in params
+              if _param[0] != 'temperature'}
+    return expt_synth_batch(fit_expt, temperatures, **values)
+
+
+def _compute(fit_args, temperatures, workers):
+    # small chunks so that progress is reported (and cancellation checked)
+    # regularly even when computing serially
+    chunks = np.array_split(temperatures,
+                            max(workers, int(np.ceil(len(temperatures)/8))))
+    chunks = [_chunk for _chunk in chunks if _chunk.size]
+    results = []
+
+    def _collect(_chunk, _spectra):
+        results.append((_chunk, _spectra))
+        done = sum(len(_t) for _t, _ in results)
+        if jobs.report_progress(message="Building library: "
+                                f"{done}/{len(temperatures)} spectra"):
+            raise jobs.JobCancelled
+
+    if workers <= 1:
+        for _chunk in chunks:
+            _collect(_chunk, _library_spectra(fit_args, _chunk))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_library_spectra, fit_args, _chunk): _chunk
+                       for _chunk in chunks}
+            try:
+                for _future in as_completed(futures):
+                    _collect(futures[_future], _future.result())
+            except jobs.JobCancelled:
+                for _future in futures:
+                    _future.cancel()
+                raise
+    return (np.concatenate([_t for _t, _ in results]),
+            np.concatenate([_s for _, _s in results]))
+
+
+# load the library for this configuration (from memory or disk), build it or
+# refine it where needed
+def get_library(nu_expt, slit_parameters, settings_models,
+                settings_conditions, temperatures=LIBRARY_TEMPERATURES,
+                tol=LIBRARY_TOL, workers=LIBRARY_WORKERS, max_rounds=4):
+    key = library_key(nu_expt, slit_parameters, settings_models,
+                      settings_conditions)
+    library = _LIBRARIES.get(key) or SpectralLibrary.load(key)
+    # spectral axis as used by CarsFit (reference spectrum is arbitrary)
+    fit_args = (np.asarray(nu_expt, dtype=float),
+                np.ones(len(nu_expt)), dict(slit_parameters),
+                settings_models, settings_conditions)
+    changed = False
+    if library is None:
+        library = SpectralLibrary(key, nu_expt, *_compute(
+            fit_args, np.asarray(temperatures, dtype=float), workers))
+        changed = True
+    for _ in range(max_rounds):
+        new_temperatures = library.refinement(tol=tol)
+        if not new_temperatures.size:
+            break
+        library.add(*_compute(fit_args, new_temperatures, workers))
+        changed = True
+    if changed:
+        library.save()
+    else:
+        library.touch()
+    _LIBRARIES.put(key, library)
+    return library
+
+
+# same output as utils.run_fit, but from a table lookup
+def run_library_fit(nu_expt, spect_expt, slit_parameters, settings_models,
+                    settings_conditions, **kwargs):
+    library = get_library(nu_expt, slit_parameters, settings_models,
+                          settings_conditions)
+    T_fit, residual = library.fit(spect_expt)
+    signal_expt = np.clip(np.nan_to_num(np.asarray(spect_expt, dtype=float)),
+                          0, None)
+    report = "\n".join([
+        "[[Library Fit]]",
+        f"    # library spectra  = {len(library.temperatures)}",
+        f"    # data points      = {len(library.nu)}",
+        f"    residual (chi-sq)  = {residual[0]:.6g}",
+        "[[Variables]]",
+        f"    temperature:  {T_fit[0]:.5f} (interpolated)",
+    ])
+    return {
+        'nu': library.nu,
+        'signal_expt': signal_expt/signal_expt.max(),
+        'best_fit': library.spectrum(T_fit[0]),
+        'T_fit': float(T_fit[0]),
+        'dT': None,
+        'report': report
+    }
+
+
+# vectorized fit of all shots of a batch (one signal per row), in blocks so
+# that memory-mapped signals are never read at once
+def run_library_batch(shots, nu_expt, spect_expt, slit_parameters,
+                      settings_models, settings_conditions, block_size=4096,
+                      **kwargs):
+    library = get_library(nu_expt, slit_parameters, settings_models,
+                          settings_conditions)
+    results = []
+    for _start in range(0, len(shots), block_size):
+        _time = time.perf_counter()
+        T_fit, _ = library.fit(spect_expt[_start:_start + block_size])
+        latency = (time.perf_counter() - _time)/len(T_fit)
+        results.extend(
+            {'shot': int(_shot), 'T_fit': float(_T), 'dT': None,
+             'latency': latency}
+            for _shot, _T in zip(shots[_start:_start + block_size], T_fit))
+        if jobs.report_progress(message=f"Fitted {len(results)}/"
+                                f"{len(shots)} shots"):
+            raise jobs.JobCancelled
+    return results
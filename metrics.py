@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import bisect
+import functools
+import threading
+
+import flask
+from dash.exceptions import PreventUpdate
+
+from cache import (CACHE_DIR, SPECTRUM_CACHE, FIT_CACHE, SHARED_CACHE,
+                   DISK_CACHE)
+from store import ARRAY_STORE
+
+# one file of metrics per process, merged by /metrics
+METRICS_DIR = CACHE_DIR / "metrics"
+# set to 0 to disable the instrumentation and the /metrics route
+METRICS_ENABLED = os.environ.get("CARSPY_METRICS", "1") != "0"
+# minimum time (in s) between two writes of the metrics of a process
+METRICS_FLUSH = float(os.environ.get("CARSPY_METRICS_FLUSH", 5))
+# upper bounds of the histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                    30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+# histograms recorded per callback: (name, buckets, help text)
+HISTOGRAMS = (
+    ("duration_seconds", DURATION_BUCKETS, "Wall time of the callback"),
+    ("cpu_seconds", DURATION_BUCKETS,
+     "CPU time of the thread running the callback"),
+    ("request_bytes", SIZE_BUCKETS, "Size of the callback request body"),
+    ("response_bytes", SIZE_BUCKETS, "Size of the callback response body"),
+)
+COUNTERS = (
+    ("errors_total", "Callbacks that raised an exception"),
+    ("prevented_total", "Callbacks that raised PreventUpdate"),
+)
+CACHES = {"spectrum": SPECTRUM_CACHE, "fit": FIT_CACHE, "shared": SHARED_CACHE,
+          "disk": DISK_CACHE, "store": ARRAY_STORE}
+
+
+class Histogram():
+    """Bucket counts (not cumulative) and sum of observed values."""
+
+    def __init__(self, buckets, counts=None, total=0.0):
+        self.buckets = tuple(buckets)
+        # the last bucket collects values above the largest bound
+        self.counts = list(counts or [0]*(len(self.buckets) + 1))
+        self.sum = total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        self.counts = [_a + _b for _a, _b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """Linear interpolation within the bucket (as Prometheus does)."""
+        count = self.count
+        if not count:
+            return None
+        rank = q*count
+        cumulative = 0
+        for _i, _n in enumerate(self.counts):
+            if cumulative + _n >= rank and _n:
+                if _i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[_i - 1] if _i else 0
+                return lower + (self.buckets[_i] - lower)*(
+                    rank - cumulative)/_n
+            cumulative += _n
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {"counts": self.counts, "sum": self.sum}
+
+
+class CallbackMetrics():
+    """Metrics of the callbacks served by this process."""
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._callbacks = {}
+        self._lock = threading.Lock()
+        self._flushed = 0
+
+    def _new(self):
+        data = {_name: Histogram(_buckets)
+                for _name, _buckets, _ in HISTOGRAMS}
+        data.update({_name: 0 for _name, _ in COUNTERS})
+        return data
+
+    def observe(self, label, outcome=None, **values):
+        with self._lock:
+            data = self._callbacks.setdefault(label, self._new())
+            for _name, _value in values.items():
+                data[_name].observe(_value)
+            if outcome is not None:
+                data[outcome] += 1
+        self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            callbacks = {
+                _label: {_k: _v.to_dict() if isinstance(_v, Histogram)
+                         else _v for _k, _v in _data.items()}
+                for _label, _data in self._callbacks.items()}
+        return {"pid": os.getpid(), "time": time.time(),
+                "callbacks": callbacks,
+                "caches": {_name: _cache.stats()
+                           for _name, _cache in CACHES.items()}}
+
+    def flush(self, force=False):
+        _now = time.monotonic()
+        if not force and _now - self._flushed < self.flush_interval:
+            return
+        self._flushed = _now
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.directory / f"{os.getpid()}.json"
+        _tmp = path.with_suffix(".tmp")
+        with open(_tmp, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(_tmp, path)
+
+
+METRICS = CallbackMetrics()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect():
+    """Merge the metrics of all (live) processes writing to METRICS_DIR."""
+    snapshots = {os.getpid(): METRICS.snapshot()}
+    if METRICS_DIR.exists():
+        for _path in METRICS_DIR.glob("*.json"):
+            try:
+                pid = int(_path.stem)
+                if pid in snapshots:
+                    continue
+                if not _alive(pid):
+                    _path.unlink()
+                    continue
+                with open(_path) as f:
+                    snapshots[pid] = json.load(f)
+            except (ValueError, OSError):
+                continue
+    callbacks, caches = {}, {}
+    for _snapshot in snapshots.values():
+        for _label, _data in _snapshot["callbacks"].items():
+            merged = callbacks.setdefault(_label, METRICS._new())
+            for _name, _buckets, _ in HISTOGRAMS:
+                merged[_name].merge(Histogram(
+                    _buckets, _data[_name]["counts"], _data[_name]["sum"]))
+            for _name, _ in COUNTERS:
+                merged[_name] += _data[_name]
+        for _name, _stats in _snapshot["caches"].items():
+            merged = caches.setdefault(_name, {})
+            for _key, _value in _stats.items():
+                if _stats.get("shared") and _key in ("items", "nbytes"):
+                    # the same directory seen by every process
+                    merged[_key] = max(merged.get(_key, 0), _value)
+                else:
+                    merged[_key] = merged.get(_key, 0) + _value
+    for _stats in caches.values():
+        _total = _stats.get("hits", 0) + _stats.get("misses", 0)
+        if "hit_rate" in _stats:
+            _stats["hit_rate"] = _stats["hits"]/_total if _total else 0.0
+    return {"processes": len(snapshots), "callbacks": callbacks,
+            "caches": caches}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _bound(value):
+    return "+Inf" if value is None else repr(float(value))
+
+
+def render_prometheus(merged):
+    lines = ["# HELP carspy_processes Processes reporting metrics",
+             "# TYPE carspy_processes gauge",
+             f"carspy_processes {merged['processes']}"]
+    callbacks = sorted(merged["callbacks"].items())
+    for _name, _, _help in HISTOGRAMS:
+        metric = f"carspy_callback_{_name}"
+        lines += [f"# HELP {metric} {_help}.",
+                  f"# TYPE {metric} histogram"]
+        for _label, _data in callbacks:
+            hist = _data[_name]
+            label = f'callback="{_escape(_label)}"'
+            cumulative = 0
+            for _le, _n in zip(hist.buckets + (None,), hist.counts):
+                cumulative += _n
+                lines.append(f'{metric}_bucket{{{label},le="{_bound(_le)}"}}'
+                             f" {cumulative}")
+            lines += [f"{metric}_sum{{{label}}} {hist.sum!r}",
+                      f"{metric}_count{{{label}}} {hist.count}"]
+    for _name, _help in COUNTERS:
+        metric = f"carspy_callback_{_name}"
+        lines += [f"# HELP {metric} {_help}.", f"# TYPE {metric} counter"]
+        lines += [f'{metric}{{callback="{_escape(_label)}"}} {_data[_name]}'
+                  for _label, _data in callbacks]
+    caches = sorted(merged["caches"].items())
+    for _key, _type in (("hits", "counter"), ("misses", "counter"),
+                        ("evictions", "counter"), ("items", "gauge"),
+                        ("nbytes", "gauge")):
+        metric = f"carspy_cache_{_key}"
+        if _type == "counter":
+            metric += "_total"
+        lines += [f"# HELP {metric} Cache {_key} (all processes).",
+                  f"# TYPE {metric} {_type}"]
+        lines += [f'{metric}{{cache="{_name}"}} {_stats[_key]}'
+                  for _name, _stats in caches if _key in _stats]
+    return "\n".join(lines) + "\n"
+
+
+def summary(merged):
+    """One row per callback for the admin panel."""
+    rows = []
+    for _label, _data in sorted(merged["callbacks"].items()):
+        wall, cpu = _data["duration_seconds"], _data["cpu_seconds"]
+        calls = wall.count
+        if not calls:
+            continue
+        rows.append({
+            "callback": _label,
+            "calls": calls,
+            "errors": _data["errors_total"],
+            "prevented": _data["prevented_total"],
+            "wall_mean": wall.sum/calls,
+            "wall_p95": wall.quantile(0.95),
+            "cpu_mean": cpu.sum/calls,
+            "wall_total": wall.sum,
+            "request_mean": _data["request_bytes"].sum/calls,
+            "response_mean": _data["response_bytes"].sum/calls,
+        })
+    return sorted(rows, key=lambda _r: -_r["wall_total"])
+
+
+def _instrument(func, label):
+    @functools.wraps(func)
+    def _timed(*args, **kwargs):
+        _wall, _cpu = time.perf_counter(), time.thread_time()
+        response, outcome = None, None
+        try:
+            response = func(*args, **kwargs)
+            return response
+        except PreventUpdate:
+            outcome = "prevented_total"
+            raise
+        except Exception:
+            outcome = "errors_total"
+            raise
+        finally:
+            # the response is the JSON string sent to the browser
+            METRICS.observe(
+                label, outcome,
+                duration_seconds=time.perf_counter() - _wall,
+                cpu_seconds=time.thread_time() - _cpu,
+                request_bytes=flask.request.content_length or 0,
+                response_bytes=len(response) if response else 0)
+    _timed.instrumented = True
+    return _timed
+
+
+def callback_label(func):
+    original = getattr(func, "__wrapped__", func)
+    return f"{original.__module__}.{original.__name__}"
+
+
+def instrument_callbacks(app):
+    """Wrap all server-side callbacks registered so far.
+
+    Callbacks are labelled "<module>.<function>", the modal toggles of the
+    navbar (one function for several outputs) share a label.
+    """
+    if not METRICS_ENABLED:
+        return
+    for _entry in app.callback_map.values():
+        func = _entry.get("callback")
+        if func is None or getattr(func, "instrumented", False):
+            continue
+        _entry["callback"] = _instrument(func, callback_label(func))
+
+
+def register_metrics_route(server):
+    if not METRICS_ENABLED:
+        return
+
+    @server.route("/metrics")
+    def metrics():
+        return flask.Response(render_prometheus(collect()),
+                              mimetype="text/plain; version=0.0.4")
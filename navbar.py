@@ -7,6 +7,8 @@ import dash_bootstrap_components as dbc
 from app import app
 from tab_synthesize import tab_synth
 from tab_fit import tab_fit
+from tab_batch import tab_batch
+from tab_admin import tab_admin, ADMIN_ENABLED
 
 
 # callback for collapsing menu
@@ -86,6 +88,10 @@ def tab_content(active_tab):
         return tab_synth
     elif active_tab == "nav-tab-fit":
         return tab_fit
+    elif active_tab == "nav-tab-batch":
+        return tab_batch
+    elif active_tab == "nav-tab-admin" and ADMIN_ENABLED:
+        return tab_admin
 
 
 # load the markdown file
@@ -249,7 +255,26 @@ navbar_tabs = dbc.Container(
                     "border-width": "0px 0px 2px 0px",
                     },
             ),
-        ],
+            dbc.Tab(
+                tab_id="nav-tab-batch",
+                label="Batch Fit",
+                activeLabelClassName="border-primary font-weight-bold",
+                active_label_style={
+                    "background-color": "rgb(240,240,240)",
+                    "border-width": "0px 0px 2px 0px",
+                    },
+            ),
+        ] + ([
+            dbc.Tab(
+                tab_id="nav-tab-admin",
+                label="Admin",
+                activeLabelClassName="border-primary font-weight-bold",
+                active_label_style={
+                    "background-color": "rgb(240,240,240)",
+                    "border-width": "0px 0px 2px 0px",
+                    },
+            ),
+        ] if ADMIN_ENABLED else []),
         id="nav-tabs",
         active_tab="nav-tab-synthesize",
         className="pt-2"
@@ -0,0 +1,190 @@
+import io
+import os
+import re
+import html
+import json
+import time
+import uuid
+import pstats
+import random
+import cProfile
+import functools
+import threading
+
+import flask
+
+from cache import CACHE_DIR
+from metrics import callback_label
+
+# one .prof file (pstats) and one .json file (metadata) per profiled request
+PROFILE_DIR = CACHE_DIR / "profiles"
+# set to 1 to allow profiling, nothing is hooked into the server otherwise
+PROFILING_ENABLED = os.environ.get("CARSPY_PROFILING", "0") == "1"
+# fraction of requests profiled without being asked for
+PROFILE_SAMPLE_RATE = float(os.environ.get("CARSPY_PROFILE_SAMPLE", 0))
+# number of profiles kept, the oldest ones are removed
+PROFILE_MAX_FILES = int(os.environ.get("CARSPY_PROFILE_MAX_FILES", 200))
+# a request is profiled if it has this header, the query flag ?profile=1 or
+# the cookie (set by loading the page with ?profile=1, cleared by ?profile=0)
+PROFILE_HEADER = "X-Carspy-Profile"
+PROFILE_COOKIE = "carspy_profile"
+# number of functions in the text summary of a profile
+PROFILE_TOP = 40
+
+_NAME = re.compile(r"^[\w.-]+$")
+# name of the profile recorded by the current request thread, used to profile
+# the jobs it submits as well
+_local = threading.local()
+
+
+def _requested():
+    return (flask.request.headers.get(PROFILE_HEADER, "0") == "1"
+            or flask.request.args.get("profile") == "1"
+            or flask.request.cookies.get(PROFILE_COOKIE) == "1"
+            or random.random() < PROFILE_SAMPLE_RATE)
+
+
+def _request_label(app):
+    if flask.request.path.endswith("_dash-update-component"):
+        body = flask.request.get_json(silent=True) or {}
+        entry = app.callback_map.get(body.get("output"), {})
+        if "callback" in entry:
+            return callback_label(entry["callback"])
+    return flask.request.path.strip("/").replace("/", ".") or "index"
+
+
+def _new_name(label):
+    label = re.sub(r"[^\w.-]", "_", label)[:80]
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{uuid.uuid4().hex[:6]}"
+
+
+def _save(profiler, name, label, duration, **meta):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(PROFILE_DIR / f"{name}.prof")
+    with open(PROFILE_DIR / f"{name}.json", "w") as f:
+        json.dump(dict(meta, name=name, label=label, duration=duration,
+                       time=time.time(), pid=os.getpid()), f)
+    _remove_old_profiles()
+
+
+def _remove_old_profiles():
+    profiles = sorted(PROFILE_DIR.glob("*.json"),
+                      key=lambda _p: _p.stat().st_mtime)
+    for _path in profiles[:max(0, len(profiles) - PROFILE_MAX_FILES)]:
+        for _suffix in (".json", ".prof"):
+            try:
+                os.remove(_path.with_suffix(_suffix))
+            except OSError:
+                pass
+
+
+# executed in the worker process
+def run_profiled(name, label, func, *args, **kwargs):
+    profiler = cProfile.Profile()
+    _start = time.perf_counter()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        _save(profiler, name, label, time.perf_counter() - _start, job=True)
+
+
+def profile_job(func):
+    """Profile a job in the worker if the request submitting it is profiled.
+
+    Called by jobs.submit, returns func unchanged otherwise.
+    """
+    parent = getattr(_local, "name", None)
+    if parent is None:
+        return func
+    _local.jobs += 1
+    name = f"{parent}-job{_local.jobs}"
+    label = f"{_local.label} (job)"
+    return functools.partial(run_profiled, name, label, func)
+
+
+def register_profiling(app):
+    if not PROFILING_ENABLED:
+        return
+    server = app.server
+
+    @server.before_request
+    def _start_profile():
+        if flask.request.path.startswith("/profiles") or not _requested():
+            return
+        label = _request_label(app)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is active in this process
+            return
+        flask.g.profile = (profiler, label, time.perf_counter())
+        _local.name, _local.label, _local.jobs = _new_name(label), label, 0
+
+    @server.after_request
+    def _set_cookie(response):
+        flag = flask.request.args.get("profile")
+        if flag == "1":
+            response.set_cookie(PROFILE_COOKIE, "1", samesite="Lax")
+        elif flag == "0":
+            response.delete_cookie(PROFILE_COOKIE)
+        return response
+
+    @server.teardown_request
+    def _stop_profile(exc):
+        profile = flask.g.pop("profile", None)
+        if profile is None:
+            return
+        profiler, label, _start = profile
+        profiler.disable()
+        _save(profiler, _local.name, label, time.perf_counter() - _start,
+              path=flask.request.path, status="error" if exc else "ok")
+        _local.name = None
+
+    @server.route("/profiles")
+    def list_profiles():
+        profiles = []
+        for _path in PROFILE_DIR.glob("*.json"):
+            try:
+                with open(_path) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        profiles.sort(key=lambda _p: -_p["time"])
+        rows = "".join(
+            "<tr><td>{}</td><td>{}</td><td>{:.3f}</td><td>{}</td>"
+            "<td><a href='profiles/{}.txt'>summary</a> "
+            "<a href='profiles/{}.prof'>pstats</a></td></tr>".format(
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                              time.localtime(_p["time"])),
+                html.escape(_p["label"]), _p["duration"], _p["pid"],
+                _p["name"], _p["name"])
+            for _p in profiles)
+        return (
+            "<!DOCTYPE html><html><head><title>CARSpy profiles</title>"
+            "<style>body{font-family:sans-serif}td,th{padding:2px 8px;"
+            "text-align:left}</style></head><body><h3>Profiles</h3>"
+            "<p>Open the pstats files with e.g. <code>snakeviz</code> or "
+            "turn them into flame graphs with <code>flameprof</code>.</p>"
+            "<table><tr><th>Time</th><th>Callback / route</th>"
+            "<th>Duration [s]</th><th>PID</th><th></th></tr>"
+            f"{rows}</table></body></html>")
+
+    @server.route("/profiles/<name>.prof")
+    def download_profile(name):
+        if not _NAME.match(name):
+            flask.abort(404)
+        return flask.send_from_directory(PROFILE_DIR, f"{name}.prof",
+                                         as_attachment=True)
+
+    @server.route("/profiles/<name>.txt")
+    def profile_summary(name):
+        path = PROFILE_DIR / f"{name}.prof"
+        if not _NAME.match(name) or not path.exists():
+            flask.abort(404)
+        stream = io.StringIO()
+        stats = pstats.Stats(str(path), stream=stream)
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        return flask.Response(stream.getvalue(), mimetype="text/plain")
@@ -0,0 +1,347 @@
+"""Number of sampling points picked by the synthesis for num_sample="auto".
+
+The error of the synthesis on a uniform grid, relative to the peak of the
+signal, is measured against a much finer grid (convergence runs): the signal
+is interpolated linearly (as it is plotted) onto the fine grid, so lines
+falling between the sampling points count. The ends of the range, where the
+pump convolution is cut off on any grid, are left out. The runs cover
+pressures, temperatures and pump line widths over the ranges of the app, for
+both convolution methods, with and without Doppler broadening; each error is
+the largest over both pump line shapes and both Raman susceptibility models.
+The errors and the cost of the synthesis per sampling point are kept in a
+model file, from which the smallest grid meeting a tolerance (with a margin)
+is looked up.
+
+Rebuild the model (takes a few minutes) after changing the synthesis:
+
+    python sampling.py
+
+Compare the error of the picked grids with a fine grid for CHECK_CONDITIONS
+and random conditions:
+
+    python sampling.py --check 20
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+from pathlib import Path
+
+import numpy as np
+
+MODEL_PATH = Path(__file__).parent / "_data/sampling_model.json"
+# largest error of num_sample="auto", relative to the peak of the signal
+AUTO_TOLERANCE = float(os.environ.get("CARSPY_AUTO_TOLERANCE", 1e-3))
+# the grid is looked up for the tolerance divided by this, for conditions in
+# between those of the model
+AUTO_MARGIN = 2.
+# bounds of the number of sampling points picked, at most the largest (odd)
+# number within the range of the slider (15000)
+AUTO_MIN_SAMPLE = 1001
+AUTO_MAX_SAMPLE = int(os.environ.get("CARSPY_AUTO_MAX_SAMPLE", 14999))
+# conditions of the convergence runs, the model is interpolated in between
+MODEL_PRESSURES = (0.5, 1, 2, 5, 10, 20)
+MODEL_TEMPERATURES = (300, 800, 1500, 2200, 3000)
+MODEL_PUMP_LW = (0.02, 0.05, 0.15, 0.5, 1.5, 5)
+MODEL_CONVOL = ("Yuratich", "Kataoka")
+MODEL_DOPPLER = (False, True)
+MODEL_PUMP_LS = ("Gaussian", "Lorentzian")
+MODEL_CHI_RS = ("isolated", "G-matrix")
+MODEL_RANGE = (2262, 2345)
+# the reference grid has this many points per width of the narrowest line
+REFERENCE_POINTS = 8
+# the grids compared are every k-th point of the reference grid; its number
+# of intervals is a multiple of 2*768, so that all of them have an odd
+# number of points
+SUBSAMPLING = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64, 96, 128, 192, 256)
+REFERENCE_MULTIPLE = 1536
+# pump line widths (FWHM) at each end of the range left out of the errors
+EDGE_WIDTHS = 2
+# the error of the linearly interpolated signal shrinks with the square of
+# the spacing once the lines are resolved, used below the grids compared
+CONVERGENCE_ORDER = 2
+# grids timed for the cost model
+COST_SAMPLES = (2500, 5000, 10000, 20000)
+# conditions always checked (P, T, pump_lw), the narrowest pump line at
+# the corners of the model
+CHECK_CONDITIONS = ((1, 300, 0.02), (0.5, 300, 0.02), (20, 300, 0.02),
+                    (0.5, 3000, 0.02), (1, 300, 1.0), (20, 3000, 5))
+
+
+def _synth_mode(convol, doppler_effect, chi_rs="isolated", pump_ls="Gaussian"):
+    return {'pump_ls': pump_ls, 'chi_rs': chi_rs, 'convol': convol,
+            'doppler_effect': doppler_effect, 'chem_eq': False}
+
+
+def _model_key(convol, doppler_effect):
+    convol = "Kataoka" if convol in ("Kataoka", "K") else "Yuratich"
+    return f"{convol}-{'doppler' if doppler_effect else 'no_doppler'}"
+
+
+def grid_error(cars, temperature, pump_lw, mode, nu_ref, chi_ref, step,
+               reference=None):
+    """Error of the grid nu_ref[::step], interpolated onto nu_ref."""
+    from utils import convolve_chi
+    if reference is None:
+        reference = convolve_chi(cars, nu_ref, chi_ref.copy(), [temperature],
+                                 mode, pump_lw)[0]
+    # each (discrete) convolution scales the signal with 1/spacing
+    power = 1 + 2*mode['doppler_effect']
+    spect = convolve_chi(cars, nu_ref[::step], chi_ref[:, ::step].copy(),
+                         [temperature], mode, pump_lw)[0]*step**power
+    inside = ((nu_ref >= nu_ref[0] + EDGE_WIDTHS*pump_lw)
+              & (nu_ref <= nu_ref[-1] - EDGE_WIDTHS*pump_lw))
+    return np.abs(np.interp(nu_ref, nu_ref[::step], spect)
+                  - reference)[inside].max()/np.abs(reference).max()
+
+
+def convergence_errors(cars, temperature, pump_lws, convol, doppler_effect,
+                       nu_ref, chi_refs):
+    """Errors of the grids nu_ref[::k] for all k in SUBSAMPLING.
+
+    chi_refs holds the susceptibility of each model on nu_ref, the largest
+    error of all models and pump line shapes is kept.
+    """
+    from utils import convolve_chi
+    errors = []
+    for _pump_lw in pump_lws:
+        worst = np.zeros(len(SUBSAMPLING))
+        for _chi_rs, _chi_ref in chi_refs.items():
+            for _pump_ls in MODEL_PUMP_LS:
+                mode = _synth_mode(convol, doppler_effect, _chi_rs, _pump_ls)
+                reference = convolve_chi(cars, nu_ref, _chi_ref.copy(),
+                                         [temperature], mode, _pump_lw)[0]
+                worst = np.maximum(worst, [
+                    grid_error(cars, temperature, _pump_lw, mode, nu_ref,
+                               _chi_ref, _k, reference)
+                    for _k in SUBSAMPLING])
+        errors.append([float("{:.2g}".format(_error)) for _error in worst])
+    return errors
+
+
+def reference_grid(cars, temperature, nu_start, nu_end, pump_lw):
+    from utils import line_positions
+    _, widths = line_positions(cars, temperature, (0,))
+    narrowest = min(widths.min(), pump_lw,
+                    cars.ls_factors.doppler_lw(temperature))
+    intervals = (nu_end - nu_start)*REFERENCE_POINTS/narrowest
+    intervals = int(np.ceil(intervals/REFERENCE_MULTIPLE))*REFERENCE_MULTIPLE
+    return np.linspace(nu_start, nu_end, intervals + 1)
+
+
+def reference_chi(cars, temperature, nu_s, chi_rs="isolated"):
+    if chi_rs == "G-matrix":
+        chi_rs = cars.chi_rs_gmat(nu_s, temperature)
+    else:
+        chi_rs = cars.chi_rs_isolated(nu_s, temperature)
+    x_mol = cars.init_comp[cars.ls_factors.species]
+    return ((x_mol*cars.num_dens(temperature)*chi_rs
+             + cars.chi_nrs_est(temperature)*1e-18)*1e15)[None]
+
+
+def _time_synthesis(chi_rs):
+    from carspy import CarsSpectrum
+    from utils import DEFAULT_SETTINGS_CONDITIONS, signal_as_batch
+    mode = _synth_mode("Yuratich", False, chi_rs)
+    times = []
+    cars = CarsSpectrum(pressure=DEFAULT_SETTINGS_CONDITIONS["pressure"],
+                        init_comp=dict(DEFAULT_SETTINGS_CONDITIONS["comp"]),
+                        chi_set="SET 3")
+    for _num_sample in COST_SAMPLES:
+        nu = np.linspace(*MODEL_RANGE, _num_sample)
+        _start = time.perf_counter()
+        signal_as_batch(cars, nu, [DEFAULT_SETTINGS_CONDITIONS[
+            "temperature"]], mode, pump_lw=1.0)
+        times.append(time.perf_counter() - _start)
+    slope, intercept = np.polyfit(COST_SAMPLES, times, 1)
+    return [max(intercept, 0.0), slope]
+
+
+def build_model(log=print):
+    from carspy import CarsSpectrum
+    from utils import INIT_COMP
+    spacing, errors = [], {}
+    for _i, _pressure in enumerate(MODEL_PRESSURES):
+        spacing.append([])
+        cars = CarsSpectrum(pressure=_pressure, init_comp=dict(INIT_COMP),
+                            chi_set="SET 3")
+        for _j, _temperature in enumerate(MODEL_TEMPERATURES):
+            nu_ref = reference_grid(cars, _temperature, *MODEL_RANGE,
+                                    min(MODEL_PUMP_LW))
+            chi_refs = {_chi_rs: reference_chi(cars, _temperature, nu_ref,
+                                               _chi_rs)
+                        for _chi_rs in MODEL_CHI_RS}
+            spacing[_i].append(nu_ref[1] - nu_ref[0])
+            for _convol in MODEL_CONVOL:
+                for _doppler in MODEL_DOPPLER:
+                    table = errors.setdefault(
+                        _model_key(_convol, _doppler),
+                        [[None]*len(MODEL_TEMPERATURES)
+                         for _ in MODEL_PRESSURES])
+                    table[_i][_j] = convergence_errors(
+                        cars, _temperature, MODEL_PUMP_LW, _convol,
+                        _doppler, nu_ref, chi_refs)
+            log(f"P = {_pressure} bar, T = {_temperature} K: "
+                f"{len(nu_ref)} points")
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "range": MODEL_RANGE,
+        "pressures": MODEL_PRESSURES,
+        "temperatures": MODEL_TEMPERATURES,
+        "pump_lw": MODEL_PUMP_LW,
+        "subsampling": SUBSAMPLING,
+        "spacing": spacing,
+        "errors": errors,
+        # seconds per synthesis: intercept + slope*num_sample
+        "cost": {_chi_rs: _time_synthesis(_chi_rs)
+                 for _chi_rs in ("isolated", "G-matrix")},
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def load_model(path=MODEL_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _bracket(values, value, log=False):
+    values = np.asarray(values, dtype=float)
+    if log:
+        values, value = np.log(values), np.log(value)
+    upper = int(np.clip(np.searchsorted(values, value), 0, len(values) - 1))
+    return sorted({max(upper - 1, 0) if value < values[upper] else upper,
+                   upper})
+
+
+def _largest_spacing(spacings, errors, tolerance):
+    # errors grow with the spacing (the first grid is the reference itself),
+    # the largest spacing within the tolerance is interpolated (log-log) up
+    # to the next one above it, or extrapolated below the finest grid
+    # compared
+    spacings = spacings[1:]
+    errors = np.maximum.accumulate(np.maximum(errors[1:], 1e-300))
+    within = int(np.sum(errors <= tolerance))
+    if within == 0:
+        return spacings[0]*(tolerance/errors[0])**(1/CONVERGENCE_ORDER)
+    if within == len(errors):
+        return spacings[-1]
+    return float(np.exp(np.interp(
+        np.log(tolerance), np.log(errors[within-1:within+1]),
+        np.log(spacings[within-1:within+1]))))
+
+
+def required_spacing(pressure, temperature, pump_lw, convol='Y',
+                     doppler_effect=False, tolerance=AUTO_TOLERANCE):
+    """Largest spacing of a uniform grid with an error within tolerance.
+
+    The most demanding of the neighbouring conditions of the model is used,
+    and of all wider pump lines, so that the spacing never grows towards
+    narrower pump lines.
+    """
+    model = load_model()
+    table = model["errors"][_model_key(convol, doppler_effect)]
+    subsampling = np.asarray(model["subsampling"])
+    narrowest = _bracket(model["pump_lw"], pump_lw, log=True)[0]
+    spacing = np.inf
+    for _i in _bracket(model["pressures"], pressure, log=True):
+        for _j in _bracket(model["temperatures"], temperature):
+            for _k in range(narrowest, len(model["pump_lw"])):
+                spacing = min(spacing, _largest_spacing(
+                    model["spacing"][_i][_j]*subsampling, table[_i][_j][_k],
+                    tolerance))
+    return spacing
+
+
+def auto_num_sample(pressure, temperature, pump_lw, nu_start, nu_end,
+                    convol='Y', doppler_effect=False, grid='uniform',
+                    tolerance=AUTO_TOLERANCE, max_sample=AUTO_MAX_SAMPLE):
+    """Smallest (odd) number of sampling points meeting the tolerance.
+
+    The adaptive grid resolves the lines by itself, its sampling points only
+    need to resolve the pump line the signal is convolved with. The number
+    is capped at `max_sample` (None for no cap).
+    """
+    if grid == 'adaptive':
+        from utils import ADAPTIVE_CONVOL_SPACING
+        spacing = ADAPTIVE_CONVOL_SPACING*pump_lw
+    else:
+        spacing = required_spacing(pressure, temperature, pump_lw, convol,
+                                   doppler_effect, tolerance/AUTO_MARGIN)
+    num_sample = int(np.ceil((nu_end - nu_start)/spacing)) + 1
+    # odd, so that the lines convolved with are centered on a grid point
+    num_sample += 1 - num_sample % 2
+    return int(np.clip(num_sample, AUTO_MIN_SAMPLE, max_sample))
+
+
+def estimated_cost(num_sample, chi_rs='isolated'):
+    """Estimated time of the synthesis in seconds."""
+    intercept, slope = load_model()["cost"][chi_rs]
+    return intercept + slope*num_sample
+
+
+def check(count, tolerance=AUTO_TOLERANCE, seed=0):
+    from carspy import CarsSpectrum
+    from utils import INIT_COMP
+    rng = np.random.default_rng(seed)
+    conditions = list(CHECK_CONDITIONS)
+    for _ in range(count):
+        conditions.append((
+            float(np.round(np.exp(rng.uniform(*np.log([0.5, 20]))), 1)),
+            float(rng.integers(300, 3001)),
+            float(np.round(np.exp(rng.uniform(*np.log([0.02, 5]))), 2))))
+    rows = []
+    for pressure, temperature, pump_lw in conditions:
+        convol = str(rng.choice(MODEL_CONVOL))
+        doppler_effect = bool(rng.integers(2))
+        pump_ls = str(rng.choice(MODEL_PUMP_LS))
+        chi_rs = str(rng.choice(MODEL_CHI_RS))
+        num_sample = auto_num_sample(pressure, temperature, pump_lw,
+                                     *MODEL_RANGE, convol, doppler_effect,
+                                     tolerance=tolerance, max_sample=None)
+        cars = CarsSpectrum(pressure=pressure, init_comp=dict(INIT_COMP),
+                            chi_set="SET 3")
+        # a reference grid containing the picked one, at least four
+        # times finer
+        nu_fine = reference_grid(cars, temperature, *MODEL_RANGE,
+                                 pump_lw)
+        step = max(4, int(np.ceil((MODEL_RANGE[1] - MODEL_RANGE[0])
+                                  / (num_sample - 1)
+                                  / (nu_fine[1] - nu_fine[0]))))
+        nu_ref = np.linspace(*MODEL_RANGE, (num_sample - 1)*step + 1)
+        error = grid_error(
+            cars, temperature, pump_lw,
+            _synth_mode(convol, doppler_effect, chi_rs, pump_ls), nu_ref,
+            reference_chi(cars, temperature, nu_ref, chi_rs), step)
+        rows.append(error)
+        print(f"P = {pressure:5.1f} bar  T = {temperature:6.0f} K  "
+              f"pump_lw = {pump_lw:4.2f}  {convol:8s}  "
+              f"{'doppler   ' if doppler_effect else 'no doppler'}  "
+              f"{pump_ls:10s}  {chi_rs:8s}  "
+              f"{num_sample:6d} points  error {error:.1e}")
+    return max(rows) <= tolerance
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-o", "--output", type=Path, default=MODEL_PATH,
+                        help="file the model is written to (JSON)")
+    parser.add_argument("--check", type=int, metavar="N", default=0,
+                        help="check the model for N random conditions "
+                        "instead of building it")
+    parser.add_argument("--tolerance", type=float, default=AUTO_TOLERANCE,
+                        help="tolerance checked")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        return 0 if check(args.check, args.tolerance) else 1
+    model = build_model()
+    with open(args.output, "w") as f:
+        json.dump(model, f, separators=(",", ":"))
+    print(f"Model written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
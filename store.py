@@ -0,0 +1,102 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+from cache import LRUCache, SHARED_CACHE, settings_key
+
+# idle time (in s) after which a session's arrays are dropped
+STORE_TTL = float(os.environ.get("CARSPY_STORE_TTL", 3600))
+# number of array sets kept per session (current and a few previous ones)
+STORE_MAX_ITEMS = int(os.environ.get("CARSPY_STORE_ITEMS", 8))
+# memory budget of all sessions together (in MB), every page load opens a
+# new session, so the least recently used arrays are dropped beyond it
+STORE_MAX_MB = float(os.environ.get("CARSPY_STORE_MB", 256))
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def content_key(value):
+    return settings_key(value)[:16]
+
+
+class ArrayStore():
+    """Session-scoped server-side storage of arrays referenced by key.
+
+    The dcc.Store components only hold the short content key, the arrays
+    themselves never travel to the browser. Sessions idle for longer than
+    `ttl` seconds are evicted, each session keeps at most `max_items` entries
+    and all sessions together at most `max_bytes` (least recently used
+    first). Pinned entries (e.g. the defaults) are shared by all sessions and
+    never expire. Entries are also written to the cache shared by all
+    workers, so a key issued by one worker can be resolved by the others.
+    """
+
+    def __init__(self, ttl=3600, max_items=8, max_bytes=None):
+        self.ttl = ttl
+        self.max_items = max_items
+        # (session_id, key) -> arrays, the budget of all sessions
+        self._entries = LRUCache(max_bytes=max_bytes)
+        # session_id -> (last access, keys in the order of use)
+        self._sessions = {}
+        self._pinned = {}
+        self._lock = threading.Lock()
+
+    def _touch(self, session_id, key=None):
+        _now = time.monotonic()
+        with self._lock:
+            # lazily drop expired sessions
+            for _id in [_id for _id, (_t, _) in self._sessions.items()
+                        if _now - _t > self.ttl]:
+                for _key in self._sessions.pop(_id)[1]:
+                    self._entries.pop((_id, _key))
+            _, _keys = self._sessions.pop(session_id, (_now, OrderedDict()))
+            self._sessions[session_id] = (_now, _keys)
+            if key is None:
+                return
+            _keys[key] = None
+            _keys.move_to_end(key)
+            while len(_keys) > self.max_items:
+                _key, _ = _keys.popitem(last=False)
+                self._entries.pop((session_id, _key))
+
+    def put(self, session_id, value):
+        key = content_key(value)
+        if key not in self._pinned:
+            self._touch(session_id, key)
+            self._entries.put((session_id, key), value)
+            SHARED_CACHE.put("store-" + key, value)
+        return key
+
+    def pin(self, value):
+        key = content_key(value)
+        self._pinned[key] = value
+        return key
+
+    def get(self, session_id, key, default=None):
+        if key is None:
+            return default
+        if key in self._pinned:
+            return self._pinned[key]
+        value = self._entries.get((session_id, key))
+        if value is None:
+            value = SHARED_CACHE.get("store-" + key)
+            if value is None:
+                self._touch(session_id)
+                return default
+            self._entries.put((session_id, key), value)
+        self._touch(session_id, key)
+        return value
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self):
+        return dict(self._entries.stats(), sessions=len(self._sessions))
+
+
+ARRAY_STORE = ArrayStore(ttl=STORE_TTL, max_items=STORE_MAX_ITEMS,
+                         max_bytes=int(STORE_MAX_MB*2**20))
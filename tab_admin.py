@@ -0,0 +1,123 @@
+import os
+import dash_core_components as dcc
+import dash_html_components as html
+import dash_table
+from dash.dependencies import Input, Output
+import dash_bootstrap_components as dbc
+
+from app import app
+from metrics import collect, summary
+
+# the admin tab is only added to the navbar if CARSPY_ADMIN=1
+ADMIN_ENABLED = os.environ.get("CARSPY_ADMIN", "0") == "1"
+ADMIN_REFRESH = 5000
+
+
+def _size(nbytes):
+    for _unit in ("B", "kB", "MB"):
+        if nbytes < 1024:
+            return f"{nbytes:.0f} {_unit}"
+        nbytes /= 1024
+    return f"{nbytes:.0f} GB"
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds*1e3, 1)
+
+
+@app.callback(
+    [
+        Output("admin-callbacks", "data"),
+        Output("admin-caches", "data"),
+        Output("admin-info", "children"),
+    ],
+    Input("admin-poll", "n_intervals"),
+)
+def update_admin(n_intervals):
+    merged = collect()
+    rows = [
+        {"callback": _r["callback"], "calls": _r["calls"],
+         "errors": _r["errors"], "prevented": _r["prevented"],
+         "wall_mean": _ms(_r["wall_mean"]), "wall_p95": _ms(_r["wall_p95"]),
+         "cpu_mean": _ms(_r["cpu_mean"]),
+         "wall_total": round(_r["wall_total"], 1),
+         "request_mean": _size(_r["request_mean"]),
+         "response_mean": _size(_r["response_mean"])}
+        for _r in summary(merged)]
+    caches = [
+        {"cache": _name, "items": _stats.get("items"),
+         "size": _size(_stats["nbytes"]) if "nbytes" in _stats else None,
+         "hits": _stats.get("hits"), "misses": _stats.get("misses"),
+         "hit_rate": (f"{_stats['hit_rate']:.0%}" if "hit_rate" in _stats
+                      else None),
+         "evictions": _stats.get("evictions")}
+        for _name, _stats in sorted(merged["caches"].items())]
+    info = (f"{merged['processes']} process(es) reporting, refreshed every "
+            f"{ADMIN_REFRESH//1000} s. Prometheus metrics: /metrics")
+    return rows, caches, info
+
+
+card_admin = dbc.Col(
+    dbc.Card(
+        [
+            dbc.CardHeader("Callbacks",
+                           style={"background-color": "#e9ecef"}),
+            dbc.CardBody(
+                [
+                    html.Small(id="admin-info", className="text-muted"),
+                    dash_table.DataTable(
+                        id="admin-callbacks",
+                        columns=[
+                            {"name": "Callback", "id": "callback"},
+                            {"name": "Calls", "id": "calls"},
+                            {"name": "Errors", "id": "errors"},
+                            {"name": "Prevented", "id": "prevented"},
+                            {"name": "Wall [ms]", "id": "wall_mean"},
+                            {"name": "Wall 95% [ms]", "id": "wall_p95"},
+                            {"name": "CPU [ms]", "id": "cpu_mean"},
+                            {"name": "Total [s]", "id": "wall_total"},
+                            {"name": "Request", "id": "request_mean"},
+                            {"name": "Response", "id": "response_mean"},
+                        ],
+                        sort_action="native",
+                        style_cell={"font-size": "0.8em"},
+                        style_cell_conditional=[
+                            {"if": {"column_id": "callback"},
+                             "textAlign": "left"},
+                        ],
+                        style_table={"margin-top": "0.5rem",
+                                     "overflowX": "auto"},
+                    ),
+                    html.H6("Caches", className="mt-3"),
+                    dash_table.DataTable(
+                        id="admin-caches",
+                        columns=[
+                            {"name": "Cache", "id": "cache"},
+                            {"name": "Items", "id": "items"},
+                            {"name": "Size", "id": "size"},
+                            {"name": "Hits", "id": "hits"},
+                            {"name": "Misses", "id": "misses"},
+                            {"name": "Hit rate", "id": "hit_rate"},
+                            {"name": "Evictions", "id": "evictions"},
+                        ],
+                        style_cell={"font-size": "0.8em"},
+                    ),
+                    dcc.Interval(
+                        id="admin-poll",
+                        interval=ADMIN_REFRESH,
+                    ),
+                ]
+            ),
+        ],
+        className="border-0"
+    ),
+    xs=12,
+    className="tab-col mb-2",
+)
+
+tab_admin = dbc.Row(
+    [
+        card_admin
+    ],
+    className="mb-1",
+)
@@ -0,0 +1,282 @@
+import time
+import dash_core_components as dcc
+import dash_html_components as html
+import dash_table
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
+import dash_bootstrap_components as dbc
+import numpy as np
+
+import jobs
+from app import app
+from cache import LRUCache
+from uploads import (UPLOAD_HINT, make_upload, read_handle, fit_upload_shot,
+                     fit_upload_library)
+from utils import plot_histogram
+
+BATCH_TABLE_ROWS = 8
+
+# results of the batches polled by this process, extended with the newly
+# finished jobs on each poll
+_BATCH_RESULTS = LRUCache(max_items=8)
+
+
+def batch_stats(batch, results, total):
+    if not results:
+        return "Waiting for the first results..."
+    _end = batch["finished"] if batch["status"] in jobs.FINISHED \
+        else time.time()
+    throughput = len(results)/max(_end - batch["started"], 1e-9)
+    latency = np.array([_r["latency"] for _r in results])
+    T_fit = np.array([_r["T_fit"] for _r in results])
+    failed = batch["counts"].get("failed", 0)
+    return [
+        html.P(f"{len(results)}/{total} shots fitted"
+               + (f", {failed} failed" if failed else ""), className="mb-0"),
+        html.P(f"Throughput: {throughput:.3g} shots/s", className="mb-0"),
+        html.P("Latency per shot: {:.3g} s (median), {:.3g} s (95%)".format(
+            np.median(latency), np.percentile(latency, 95)),
+            className="mb-0"),
+        html.P(f"T = {T_fit.mean():.0f} ± {T_fit.std():.0f} K",
+               className="mb-0"),
+    ]
+
+
+# only the handle of the uploaded (memory-mapped) shots is kept
+@app.callback(
+    Output("memory-batch-data", "data"),
+    Input("batch-upload-handle", "value"),
+)
+def upload_batch(value):
+    data = read_handle(value)
+    if data is None:
+        raise PreventUpdate
+    return data
+
+
+@app.callback(
+    Output("batch-info", "children"),
+    Output("start-batch-button", "disabled"),
+    Input("memory-batch-data", "data"),
+)
+def update_batch_info(data):
+    if not data:
+        return "No data uploaded", True
+    if "error" in data:
+        return html.Span(f"{data['filename']}: {data['error']}",
+                         className="text-danger"), True
+    return (f"{data['filename']}: {data['shots']} shots, "
+            f"{data['points']} points each"), False
+
+
+# submit one job per shot (least-squares) or one vectorized job (library),
+# the jobs read the shots from the upload themselves
+@app.callback(
+    Output("memory-batch-job", "data"),
+    Input("start-batch-button", "n_clicks"),
+    State("memory-batch-data", "data"),
+    State("memory-settings-slit", "data"),
+    State("memory-settings-models", "data"),
+    State("memory-settings-conditions", "data"),
+    State("memory-settings-solver", "data"),
+)
+def start_batch(n_clicks, data, slit_parameters, settings_models,
+                settings_conditions, settings_solver):
+    if not (n_clicks and data and "handle" in data):
+        raise PreventUpdate
+    fit_args = (slit_parameters, settings_models, settings_conditions)
+    if settings_solver["method"] == "library":
+        batch_id = jobs.submit_batch(fit_upload_library,
+                                     [(data["handle"], *fit_args)])
+    else:
+        batch_id = jobs.submit_batch(
+            fit_upload_shot,
+            [(data["handle"], _shot, *fit_args)
+             for _shot in range(data["shots"])],
+            settings_solver=settings_solver)
+    return {"id": batch_id, "shots": data["shots"], "submitted": time.time(),
+            "timeout": jobs.POLL_TIMEOUT}
+
+
+# keep polling only while the batch is running
+app.clientside_callback(
+    ClientsideFunction(namespace="carspy", function_name="toggle_poll"),
+    Output("batch-poll", "disabled"),
+    Input("memory-batch-job", "data"),
+    Input("memory-batch-progress", "data"),
+    Input("batch-poll", "n_intervals"),
+)
+
+
+# stream the finished shots into the histogram and the table
+@app.callback(
+    [
+        Output("memory-batch-progress", "data"),
+        Output("batch-histogram", "figure"),
+        Output("batch-table", "data"),
+        Output("batch-table", "page_count"),
+        Output("batch-stats", "children"),
+    ],
+    Input("batch-poll", "n_intervals"),
+    Input("batch-table", "page_current"),
+    State("memory-batch-job", "data"),
+)
+def poll_batch(n_intervals, page, job):
+    if not job:
+        raise PreventUpdate
+    batch = jobs.batch_status(job["id"])
+    loaded = _BATCH_RESULTS.get(job["id"])
+    if loaded is None:
+        loaded = {"ids": frozenset(), "results": ()}
+    results = loaded["results"]
+    finished = sum(batch["counts"].get(_s, 0) for _s in jobs.FINISHED)
+    if finished > len(loaded["ids"]):
+        _ids, _results, _ = jobs.batch_results(job["id"], loaded["ids"])
+        results = loaded["results"] + tuple(_results)
+        _BATCH_RESULTS.put(job["id"], {"ids": loaded["ids"] | set(_ids),
+                                       "results": results})
+    # most recent results first
+    page = page or 0
+    rows = results[::-1][page*BATCH_TABLE_ROWS:(page + 1)*BATCH_TABLE_ROWS]
+    rows = [{"shot": _r["shot"], "T_fit": round(_r["T_fit"], 1),
+             "dT": None if _r["dT"] is None else round(_r["dT"], 1),
+             "latency": float(f"{_r['latency']:.3g}")} for _r in rows]
+    if batch["status"] == "unknown":
+        batch["status"] = "failed"
+    elif (batch["status"] not in jobs.FINISHED
+          and time.time() - job["submitted"] > job["timeout"]):
+        # give up polling, cancel the shots that have not finished yet
+        jobs.cancel(job["id"])
+        batch["status"] = "failed"
+    progress = {"id": job["id"], "status": batch["status"]}
+    return (progress, plot_histogram([_r["T_fit"] for _r in results]), rows,
+            max(1, int(np.ceil(len(results)/BATCH_TABLE_ROWS))),
+            batch_stats(batch, results, job["shots"]))
+
+
+# stop all shots of the batch that have not finished yet
+@app.callback(
+    Output("memory-batch-cancel", "data"),
+    Input("cancel-batch-button", "n_clicks"),
+    State("memory-batch-job", "data"),
+)
+def cancel_batch(n_clicks, job):
+    if not (n_clicks and job):
+        raise PreventUpdate
+    jobs.cancel(job["id"])
+    return job["id"]
+
+
+@app.callback(
+    [
+        Output("batch-status", "children"),
+        Output("cancel-batch-button", "disabled"),
+    ],
+    Input("memory-batch-job", "data"),
+    Input("memory-batch-progress", "data"),
+)
+def update_batch_status(job, progress):
+    if not job:
+        return "Start batch", True
+    if not (progress and progress["id"] == job["id"]):
+        return "Fitting...", False
+    if progress["status"] in jobs.FINISHED:
+        return "Start batch", True
+    return "Fitting...", progress["status"] == "cancelling"
+
+
+# upload and batch controls
+card_batch_setting = dbc.Col(
+    dbc.Card(
+        [
+            dbc.CardHeader("Batch Data",
+                           style={"background-color": "#e9ecef"}),
+            dbc.CardBody(
+                [
+                    make_upload("batch-upload"),
+                    html.Small(
+                        UPLOAD_HINT + " Shots are fitted with the current "
+                        "fit settings.",
+                        className="text-muted"
+                    ),
+                    html.Div(id="batch-info", className="mt-2 mb-2"),
+                    dbc.Button(
+                        [
+                            dbc.Spinner(html.Div("Start batch",
+                                                 id="batch-status"),
+                                        size="sm")
+                        ],
+                        id="start-batch-button", n_clicks=0,
+                        color="primary",
+                        disabled=True
+                    ),
+                    dbc.Button(
+                        "Cancel",
+                        id="cancel-batch-button", n_clicks=0,
+                        className="ml-2",
+                        color="secondary",
+                        disabled=True
+                    ),
+                    html.Div(
+                        id="batch-stats",
+                        className="mt-2 p-2 small",
+                        style={"background": "#e5ecf6"}
+                    ),
+                    dcc.Interval(
+                        id="batch-poll",
+                        interval=1000,
+                        disabled=True
+                    ),
+                ]
+            ),
+        ],
+        style={"height": "540px"},
+        className="border-0"
+    ),
+    xs=12,
+    md=5,
+    className="tab-col mb-2",
+)
+
+# histogram and table of the fitted temperatures
+card_batch_results = dbc.Col(
+    dbc.Card(
+        [
+            dbc.CardHeader("Results",
+                           style={"background-color": "#e9ecef"}),
+            dbc.CardBody(
+                [
+                    dcc.Graph(id="batch-histogram",
+                              figure=plot_histogram([])),
+                    dash_table.DataTable(
+                        id="batch-table",
+                        columns=[
+                            {"name": "Shot", "id": "shot"},
+                            {"name": "T [K]", "id": "T_fit"},
+                            {"name": "dT [K]", "id": "dT"},
+                            {"name": "Latency [s]", "id": "latency"},
+                        ],
+                        page_current=0,
+                        page_size=BATCH_TABLE_ROWS,
+                        page_action="custom",
+                        style_cell={"font-size": "0.8em"},
+                        style_table={"margin-top": "0.5rem"},
+                    ),
+                ]
+            ),
+        ],
+        style={"height": "540px"},
+        className="border-0"
+    ),
+    xs=12,
+    md=7,
+    className="tab-col mb-2"
+)
+
+tab_batch = dbc.Row(
+    [
+        card_batch_setting,
+        card_batch_results
+    ],
+    className="mb-1",
+)
@@ -1,13 +1,23 @@
+import time
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+import dash
+from dash import no_update
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
+import jobs
 from app import app
+from library import run_library_fit
+from store import ARRAY_STORE
+from uploads import UPLOAD_HINT, make_upload, read_handle, load_shot
 from utils import (DEFAULT_SETTINGS_SLIT, DEFAULT_SETTINGS_FIT,
-                   downsample_synth, plot_fitting,
-                   plot_placeholder, plot_slit, least_sqrt_fit, unpack_lmfit,
+                   FREE_PARAMETERS, downsample_synth, plot_fitting,
+                   plot_placeholder, plot_slit, run_fit, cached_fit,
+                   remember_fit, warm_start,
                    add_fit_result)
-from tab_synthesize import synth_mode_select, synth_inputs, input_slider
+from tab_synthesize import (synth_mode_select, synth_inputs, input_slider,
+                            load_synth_spectrum)
 
 
 # slit function settings tab
@@ -51,7 +61,44 @@ def make_tab_slit(sigma, k, a_sigma, a_k, sigma_L_l, sigma_L_h, slit):
 
 
 # fit settings tab
-def make_tab_fit(sample_length, noise_level, offset):
+# fitting method and switches for the optional fitting strategies
+def make_solver_options(settings_solver):
+    options = [
+        synth_mode_select("Fit method", "solver-method-addon",
+                          "solver-method",
+                          ["least-squares", "library"],
+                          "Least-square fit, or table lookup in a "
+                          "precomputed spectral library",
+                          settings_solver["method"]),
+        dbc.Checklist(
+            options=[
+                {"label": "Coarse T scan", "value": "coarse_scan"},
+            ],
+            value=[_key for _key, _value in settings_solver.items()
+                   if _value is True],
+            id="solver-options",
+            switch=True,
+            inline=True,
+            className="mb-1"
+        ),
+        dbc.InputGroupAddon("Free parameters", id="solver-free-addon",
+                            addon_type="prepend"),
+        dbc.Tooltip("Fitted together with the temperature, the Jacobian is "
+                    "evaluated in parallel", target="solver-free-addon",
+                    placement="bottom"),
+        dbc.Checklist(
+            options=[{"label": _label, "value": _name}
+                     for _name, (_label, _, _) in FREE_PARAMETERS.items()],
+            value=settings_solver.get("free", []),
+            id="solver-free",
+            inline=True,
+            className="mb-2 small"
+        ),
+    ]
+    return options
+
+
+def make_tab_fit(sample_length, noise_level, offset, settings_solver):
     tab_fit = [
         input_slider("Sample length",
                      "sample_length", sample_length, 60, 240, 20),
@@ -73,6 +120,7 @@ def make_tab_fit(sample_length, noise_level, offset):
             ],
             className="mt-2 mb-2"
         ),
+        *make_solver_options(settings_solver),
         dbc.Button(
             [
                dbc.Spinner(html.Div("Start fit", id="fitting-status"),
@@ -89,17 +137,64 @@ def make_tab_fit(sample_length, noise_level, offset):
             className="ml-2",
             color="primary"
         ),
+        dbc.Button(
+            "Cancel",
+            id="cancel-fit-button", n_clicks=0,
+            className="ml-2",
+            color="secondary",
+            disabled=True
+        ),
+        html.Span(
+            id="fit-progress",
+            className="ml-2 small text-muted"
+        ),
         html.Div(
             id="report",
             className="mt-2 border-0",
             style={"overflow": "auto",
-                   "height": "280px",
+                   "height": "180px",
                    "background": "#e5ecf6"}
         )
     ]
     return tab_fit
 
 
+# measured data tab
+def upload_info(upload):
+    if not upload:
+        return "Fitting the synthetic signal"
+    if "error" in upload:
+        return html.Span(f"{upload['filename']}: {upload['error']}",
+                         className="text-danger")
+    return (f"{upload['filename']}: {upload['shots']} shots, "
+            f"{upload['points']} points each")
+
+
+def make_tab_data(upload):
+    tab_data = [
+        make_upload("fit-upload"),
+        html.Small(UPLOAD_HINT, className="text-muted"),
+        html.Div(upload_info(upload), id="fit-upload-info",
+                 className="mt-2 mb-2"),
+        dbc.InputGroup(
+            [
+                dbc.InputGroupAddon("Shot", addon_type="prepend",
+                                    className="col-6 px-0"),
+                dbc.Input(id="upload-shot", type="number", min=0, step=1,
+                          value=(upload or {}).get("shot", 0),
+                          debounce=True, className="col-6"),
+            ],
+            className="mb-2"
+        ),
+        dbc.Button(
+            "Use synthetic signal",
+            id="clear-upload-button", n_clicks=0,
+            color="primary"
+        ),
+    ]
+    return tab_data
+
+
 # original signal tab
 def make_tab_origin():
     tab_origin = [
@@ -201,9 +296,12 @@ def disable_slit_input(value):
         Input("memory-settings-slit", "data"),
         Input("memory-synth-spectrum", "data"),
     ],
+    State("session-id", "data"),
+    State("memory-settings-conditions", "data"),
+    State("memory-settings-models", "data"),
 )
-def update_slit_func(parameters, spect_memo):
-    nu, _ = spect_memo
+def update_slit_func(parameters, spect_key, session_id, data_1, data_2):
+    nu, _ = load_synth_spectrum(session_id, spect_key, data_1, data_2)
     return plot_slit(nu, parameters)
 
 
@@ -224,6 +322,23 @@ def update_memory_fit(sample_length, noise_level, offset, data):
     return data
 
 
+# update solver settings
+@app.callback(
+    Output("memory-settings-solver", "data"),
+    Input("solver-options", "value"),
+    Input("solver-method", "value"),
+    Input("solver-free", "value"),
+    State("memory-settings-solver", "data"),
+)
+def update_memory_solver(options, method, free, data):
+    data["method"] = method
+    data["free"] = free
+    for _key, _value in data.items():
+        if isinstance(_value, bool):
+            data[_key] = _key in options
+    return data
+
+
 # reset slit settings
 @app.callback(
     [
@@ -304,13 +419,54 @@ def re_zero_fit(active_tab):
     Output("fit-settings-card", "children"),
     Input("fit-settings", "active_tab"),
     State("memory-settings-fit", "data"),
-    State("memory-settings-slit", "data")
+    State("memory-settings-slit", "data"),
+    State("memory-settings-solver", "data"),
+    State("memory-upload", "data"),
 )
-def fit_settings_tab_content(active_tab, data_1, data_2):
+def fit_settings_tab_content(active_tab, data_1, data_2, data_3, data_4):
     if active_tab == "fit-settings-1":
-        return make_tab_fit(**data_1)
+        return make_tab_fit(**data_1, settings_solver=data_3)
     if active_tab == "fit-settings-2":
         return make_tab_slit(**data_2)
+    if active_tab == "fit-settings-3":
+        return make_tab_data(data_4)
+
+
+# select an uploaded shot (only its handle is stored) or go back to the
+# synthetic signal
+@app.callback(
+    Output("memory-upload", "data"),
+    Input("fit-upload-handle", "value"),
+    Input("upload-shot", "value"),
+    Input("clear-upload-button", "n_clicks"),
+    State("memory-upload", "data"),
+)
+def update_memory_upload(value, shot, n_clicks, data):
+    trigger = dash.callback_context.triggered[0]["prop_id"]
+    if trigger == "clear-upload-button.n_clicks" and n_clicks:
+        return None
+    if trigger == "fit-upload-handle.value" and value:
+        return dict(read_handle(value), shot=0)
+    if trigger == "upload-shot.value" and data and "handle" in data:
+        shot = int(shot or 0)
+        if 0 <= shot < data["shots"] and shot != data["shot"]:
+            return dict(data, shot=shot)
+    raise PreventUpdate
+
+
+@app.callback(
+    [
+        Output("fit-upload-info", "children"),
+        Output("upload-shot", "max"),
+        Output("upload-shot", "disabled"),
+        Output("clear-upload-button", "disabled"),
+    ],
+    Input("memory-upload", "data"),
+)
+def update_upload_info(upload):
+    shots = (upload or {}).get("shots", 1)
+    return (upload_info(upload), shots - 1, "handle" not in (upload or {}),
+            not upload)
 
 
 # create fit signal
@@ -321,32 +477,99 @@ def fit_settings_tab_content(active_tab, data_1, data_2):
         Input("memory-synth-spectrum", "data"),
         Input("memory-settings-fit", "data"),
         Input("memory-settings-models", "data"),
+        Input("memory-upload", "data"),
     ],
+    State("session-id", "data"),
+    State("memory-settings-conditions", "data"),
 )
-def update_fit_signal(slit_parameters, spect_memo, fit_settings, data_1,
-                      ):
-    nu, spect = spect_memo
+def update_fit_signal(slit_parameters, spect_key, fit_settings, data_1,
+                      upload, session_id, data_2):
+    data = make_fit_signal(session_id, spect_key, slit_parameters,
+                           fit_settings, data_2, data_1, upload)
+    return ARRAY_STORE.put(session_id, data)
+
+
+# the selected shot of an upload, otherwise the downsampled synthetic signal
+def make_fit_signal(session_id, spect_key, slit_parameters, fit_settings,
+                    settings_conditions, settings_models, upload=None):
+    if upload and "handle" in upload:
+        nu_expt, spect_expt = load_shot(upload["handle"], upload["shot"])
+        return [nu_expt, spect_expt, [nu_expt.min(), nu_expt.max()]]
+    nu, spect = load_synth_spectrum(session_id, spect_key,
+                                    settings_conditions, settings_models)
     nu_expt, spect_expt, x_range = downsample_synth(
-        nu, spect, data_1['nu_start'], data_1['nu_end'], **fit_settings,
-        slit_parameters=slit_parameters)
+        nu, spect, settings_models['nu_start'], settings_models['nu_end'],
+        **fit_settings, slit_parameters=dict(slit_parameters))
     return [nu_expt, spect_expt, x_range]
 
 
-# plot fit signal
+# look up the fit signal by its key, recreate it if the key has expired
+def load_fit_signal(session_id, signal_key, spect_key, slit_parameters,
+                    fit_settings, settings_conditions, settings_models,
+                    upload=None):
+    data = ARRAY_STORE.get(session_id, signal_key)
+    if data is None:
+        data = make_fit_signal(session_id, spect_key, slit_parameters,
+                               fit_settings, settings_conditions,
+                               settings_models, upload)
+    return data
+
+
+# plot fit signal (and the fit if available)
 @app.callback(
-    Output("fit-signal", "figure"),
+    Output("memory-fit-figure", "data"),
     [
         Input("memory-fit-signal", "data"),
+        Input("memory-fit-report", "data"),
+    ],
+    State("session-id", "data"),
+    State("memory-synth-spectrum", "data"),
+    State("memory-settings-slit", "data"),
+    State("memory-settings-fit", "data"),
+    State("memory-settings-conditions", "data"),
+    State("memory-settings-models", "data"),
+    State("memory-upload", "data"),
+)
+def update_fit_graph(signal_key, fit_memo, session_id, spect_key,
+                     slit_parameters, fit_settings, data_1, data_2, upload):
+    data = load_fit_signal(session_id, signal_key, spect_key,
+                           slit_parameters, fit_settings, data_1, data_2,
+                           upload)
+    fig = plot_fitting(*data)
+    if not (fit_memo and fit_memo['key']):
+        return fig
+    fit_arrays = load_fit_arrays(session_id, fit_memo)
+    if fit_arrays is None:
+        fig.add_annotation(text="The fit result has expired, run the fit "
+                           "again to show it", showarrow=False,
+                           xref="paper", yref="paper", x=0.5, y=1)
+        return fig
+    return add_fit_result(fig, fit_arrays['nu'], fit_arrays['best_fit'])
+
+
+# look up the fitted arrays by their key, reload them from the finished job
+# if the key has expired (or was stored by another worker)
+def load_fit_arrays(session_id, fit_memo):
+    fit_arrays = ARRAY_STORE.get(session_id, fit_memo['key'])
+    if fit_arrays is None and fit_memo.get('job'):
+        job_status = jobs.status(fit_memo['job'])
+        if job_status["status"] == "done":
+            fit_arrays = {_key: job_status["result"][_key]
+                          for _key in ('nu', 'signal_expt', 'best_fit')}
+            ARRAY_STORE.put(session_id, fit_arrays)
+    return fit_arrays
+
+
+# line style and fit visibility are changed in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace="carspy", function_name="set_fit_style"),
+    Output("fit-signal", "figure"),
+    [
+        Input("memory-fit-figure", "data"),
         Input("change-line-style", "value"),
+        Input("show-fit-button", "value"),
     ],
-    Input("show-fit-button", "value"),
-    State("memory-fit-report", "data"),
 )
-def update_fit_graph(data, mode, show_click, fit_memo):
-    fig = plot_fitting(*data, mode=mode)
-    if show_click:
-        fig = add_fit_result(fig, fit_memo['nu'], fit_memo['best_fit'])
-    return fig
 
 
 # createa graph tabs
@@ -361,30 +584,145 @@ def update_fit_spectrum(active_tab):
         return make_tab_fitting()
 
 
-# perform a fit
+# submit a fit to the background workers
 @app.callback(
-    [
-        Output("fitting-status", "children"),
-        Output("memory-fit-report", "data"),
-    ],
+    Output("memory-fit-job", "data"),
     Input("start-fit-button", "n_clicks"),
     State("memory-fit-signal", "data"),
     State("memory-settings-slit", "data"),
     State("memory-settings-models", "data"),
     State("memory-settings-conditions", "data"),
+    State("session-id", "data"),
+    State("memory-synth-spectrum", "data"),
+    State("memory-settings-fit", "data"),
+    State("memory-settings-solver", "data"),
+    State("memory-upload", "data"),
+)
+def update_fit(n_clicks, signal_key, slit_parameters, settings_models,
+               settings_conditions, session_id, spect_key, fit_settings,
+               settings_solver, upload):
+    if not n_clicks:
+        raise PreventUpdate
+    data = load_fit_signal(session_id, signal_key, spect_key,
+                           slit_parameters, fit_settings,
+                           settings_conditions, settings_models, upload)
+    fit_args = (data[0], data[1], slit_parameters, settings_models,
+                settings_conditions)
+    # identical fits are answered from the cache, similar ones warm-started
+    result = cached_fit(*fit_args, settings_solver=settings_solver)
+    if result is not None:
+        return {"id": jobs.complete(result), "submitted": time.time(),
+                "timeout": jobs.POLL_TIMEOUT}
+    if settings_solver["method"] == "library":
+        job_id = jobs.submit(run_library_fit, *fit_args)
+    else:
+        init_values = warm_start(*fit_args,
+                                 free=settings_solver.get("free", ()))
+        job_id = jobs.submit(run_fit, *fit_args, init_values=init_values,
+                             settings_solver=settings_solver)
+    return {"id": job_id, "signal": signal_key, "slit": slit_parameters,
+            "models": settings_models, "conditions": settings_conditions,
+            "solver": settings_solver, "submitted": time.time(),
+            "timeout": jobs.POLL_TIMEOUT}
+
+
+# keep polling only while a fit is running
+app.clientside_callback(
+    ClientsideFunction(namespace="carspy", function_name="toggle_poll"),
+    Output("fit-poll", "disabled"),
+    Input("memory-fit-job", "data"),
+    Input("memory-fit-progress", "data"),
+    Input("fit-poll", "n_intervals"),
 )
-def update_fit(n_clicks, data, slit_parameters, settings_models,
-               settings_conditions):
-    fit_result = []
-    if n_clicks:
-        fit_result = least_sqrt_fit(
-                        data[0],
-                        data[1],
-                        slit_parameters,
-                        settings_models,
-                        settings_conditions)
-        fit_result = unpack_lmfit(fit_result)
-    return "Start fit", fit_result
+
+
+# check on the running fit and collect its result
+@app.callback(
+    [
+        Output("memory-fit-progress", "data"),
+        Output("memory-fit-report", "data"),
+    ],
+    Input("fit-poll", "n_intervals"),
+    State("memory-fit-job", "data"),
+    State("session-id", "data"),
+)
+def poll_fit(n_intervals, job, session_id):
+    if not job:
+        raise PreventUpdate
+    job_status = jobs.status(job["id"])
+    if job_status["status"] == "unknown":
+        job_status.update(status="failed", error="Fit job not found")
+    elif (job_status["status"] not in jobs.FINISHED
+          and time.time() - job["submitted"] > job["timeout"]):
+        # give up polling, the fit would be collected by nobody
+        jobs.cancel(job["id"])
+        job_status.update(status="failed", error="No result after {:.0f} s, "
+                          "the fit was cancelled".format(job["timeout"]))
+    progress = dict(job_status.get("progress", {}), id=job["id"],
+                    status=job_status["status"])
+    if job_status["status"] == "done":
+        result = job_status["result"]
+        data = ARRAY_STORE.get(session_id, job.get("signal"))
+        if data is not None:
+            remember_fit(data[0], data[1], job["slit"], job["models"],
+                         job["conditions"], result,
+                         settings_solver=job["solver"])
+        return progress, store_fit_report(session_id, dict(result),
+                                          job["id"])
+    if job_status["status"] == "failed":
+        return progress, {"key": None, "T_fit": None, "dT": None,
+                          "report": "Fit failed:\n" + job_status["error"]}
+    return progress, no_update
+
+
+# stop the running fit
+@app.callback(
+    Output("memory-fit-cancel", "data"),
+    Input("cancel-fit-button", "n_clicks"),
+    State("memory-fit-job", "data"),
+)
+def cancel_fit(n_clicks, job):
+    if not (n_clicks and job):
+        raise PreventUpdate
+    jobs.cancel(job["id"])
+    return job["id"]
+
+
+# keep the fitted arrays server-side, only the report goes to the browser
+def store_fit_report(session_id, fit_result, job_id=None):
+    arrays = {_key: fit_result.pop(_key)
+              for _key in ('nu', 'signal_expt', 'best_fit')}
+    fit_result['key'] = ARRAY_STORE.put(session_id, arrays)
+    fit_result['job'] = job_id
+    return fit_result
+
+
+# show the fitting status on the buttons
+@app.callback(
+    [
+        Output("fitting-status", "children"),
+        Output("fit-progress", "children"),
+        Output("cancel-fit-button", "disabled"),
+    ],
+    Input("memory-fit-job", "data"),
+    Input("memory-fit-progress", "data"),
+)
+def update_fitting_status(job, progress):
+    if not job:
+        return "Start fit", "", True
+    if not (progress and progress["id"] == job["id"]):
+        return "Fitting...", "Queued", False
+    if progress["status"] in jobs.FINISHED:
+        return "Start fit", "Fit " + progress["status"], True
+    if progress["status"] == "cancelling":
+        return "Fitting...", "Cancelling", True
+    if "message" in progress:
+        return "Fitting...", progress["message"], False
+    if "iteration" not in progress:
+        return "Fitting...", progress["status"].capitalize(), False
+    return "Fitting...", "Iteration {}: T = {:.0f} K, |r| = {:.3g}".format(
+        progress["iteration"], progress["temperature"],
+        progress["residual"]), False
 
 
 # update show-fit-button
@@ -403,14 +741,14 @@ def update_show_fit_button(data):
         return _switch, [], None
 
 
-# update show-report-button
+# update show-report-button, a report is available once a fit has finished
 @app.callback(
     Output("print-report-button", "disabled"),
-    Input("start-fit-button", "n_clicks"),
-    Input("fitting-status", "children")
+    Input("fitting-status", "children"),
+    Input("memory-fit-report", "data")
 )
-def change_button_status(n_clicks, fitting_status):
-    if n_clicks and fitting_status == "Start fit":
+def change_button_status(fitting_status, data):
+    if fitting_status == "Start fit" and data and data.get("report"):
         return False
     else:
         return True
@@ -423,11 +761,12 @@ def change_button_status(n_clicks, fitting_status):
     State("memory-fit-report", "data")
 )
 def show_report(n_clicks, data):
-    report = ["Fitting results will be shown here"]
-    if n_clicks and report:
-        report = [html.P(_row, className="mb-0")
-                  for _row in data["report"].split("\n")]
-    return report
+    if not n_clicks:
+        return ["Fitting results will be shown here"]
+    if not (data and data.get("report")):
+        return no_update
+    return [html.P(_row, className="mb-0")
+            for _row in data["report"].split("\n")]
 
 
 # settings panels
@@ -441,6 +780,8 @@ card_setting = dbc.Col(
                                 tab_id="fit-settings-1"),
                         dbc.Tab(label="Slit Function",
                                 tab_id="fit-settings-2"),
+                        dbc.Tab(label="Measured Data",
+                                tab_id="fit-settings-3"),
                     ],
                     id="fit-settings",
                     card=True,
@@ -1,11 +1,15 @@
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import dash_bootstrap_components as dbc
 
 from app import app
+from store import ARRAY_STORE
 from utils import (plot_cars, plot_placeholder, synthesize_cars,
-                   DEFAULT_SETTINGS_MODELS, DEFAULT_SETTINGS_CONDITIONS)
+                   DEFAULT_SETTINGS_MODELS, DEFAULT_SETTINGS_CONDITIONS,
+                   SETTINGS_RANGES, SETTINGS_OPTIONS)
+from sampling import (AUTO_TOLERANCE, AUTO_MAX_SAMPLE, auto_num_sample,
+                      estimated_cost)
 
 
 def synth_mode_select(name, id_addon, id_select, options, tooltiptext,
@@ -64,9 +68,9 @@ def make_tab_conditions(P, T, x_N2, x_Ar, x_H2, x_O2,
                         x_CO2, x_CO, x_H2O, x_CH4):
     tab_conditions = [
         input_slider("Gas pressure [Bar]", "P-input",
-                     P, 0.5, 20, 0.5),
+                     P, *SETTINGS_RANGES["pressure"]),
         input_slider("Gas temperature [K]", "T-input",
-                     T, 300, 3000, 1),
+                     T, *SETTINGS_RANGES["temperature"]),
         dbc.InputGroupAddon("Gas composition", addon_type="prepend",
                             className="mt-3"),
         dbc.Row(
@@ -103,12 +107,13 @@ def make_tab_conditions(P, T, x_N2, x_Ar, x_H2, x_O2,
 
 # models-tab
 def make_tab_models(nu_start, nu_end, pump_ls, chi_rs, convol, doppler_effect,
-                    pump_lw, num_sample):
+                    pump_lw, num_sample, grid):
+    nu_min, nu_max, nu_step = SETTINGS_RANGES["nu_start"]
     range_slider = dbc.FormGroup(
         [
             dbc.InputGroupAddon("Spectral Range [1/cm]"),
-            dcc.RangeSlider(id="spectral-range", min=2200, max=2400, step=2,
-                            value=[nu_start, nu_end],
+            dcc.RangeSlider(id="spectral-range", min=nu_min, max=nu_max,
+                            step=nu_step, value=[nu_start, nu_end],
                             allowCross=False,
                             className="mt-1",
                             tooltip={"always_visible": True,
@@ -123,25 +128,46 @@ def make_tab_models(nu_start, nu_end, pump_ls, chi_rs, convol, doppler_effect,
                           "Choose a species", "N2"),
         synth_mode_select("pump_ls", "pump_ls-addon",
                           "pump_ls-select",
-                          ["Gaussian", "Lorentzian"],
+                          SETTINGS_OPTIONS["pump_ls"],
                           "Choose a pump laser lineshape", pump_ls),
         synth_mode_select("chi_rs", "chi_rs-addon",
                           "chi_rs-select",
-                          ["G-matrix", "isolated"],
+                          SETTINGS_OPTIONS["chi_rs"],
                           "Choose a CARS model", chi_rs),
         synth_mode_select("convol", "convol-addon",
                           "convol-select",
-                          ["Kataoka", "Yuratich"],
+                          SETTINGS_OPTIONS["convol"],
                           "Choose a convolution method", convol),
         synth_mode_select("doppler_effect", "doppler-addon",
                           "doppler-select",
-                          ["enable", "disable"],
+                          SETTINGS_OPTIONS["doppler_effect"],
                           "Enable to consider Doppler broadening",
                           doppler_effect),
+        synth_mode_select("grid", "grid-addon",
+                          "grid-select",
+                          SETTINGS_OPTIONS["grid"],
+                          "Adaptive: compute the lines on a grid dense near "
+                          "the line positions only, then resample onto the "
+                          "sampling points", grid),
         input_slider("Pump laser linewdith [1/cm]",
-                     "pump_lw-input", pump_lw, 0.02, 5, 0.02),
+                     "pump_lw-input", pump_lw, *SETTINGS_RANGES["pump_lw"]),
         input_slider("Number of sampling points",
-                     "num_sample-input", num_sample, 2500, 15000, 2500),
+                     "num_sample-input",
+                     DEFAULT_SETTINGS_MODELS["num_sample"]
+                     if num_sample == "auto" else num_sample,
+                     *SETTINGS_RANGES["num_sample"]),
+        dbc.Checklist(
+            options=[{"label": "auto", "value": "auto"}],
+            value=["auto"] if num_sample == "auto" else [],
+            id="num_sample-auto",
+            switch=True,
+            inline=True,
+        ),
+        html.Small(id="num_sample-info", className="text-muted"),
+        dbc.Tooltip("Smallest number of sampling points with an error "
+                    f"below {AUTO_TOLERANCE:.1%} of the peak for the current "
+                    "conditions and models", target="num_sample-auto",
+                    placement="bottom"),
         range_slider
     ]
 
@@ -167,7 +193,8 @@ def tab_content(active_tab, data_1, data_2):
         return make_tab_models(data_2["nu_start"], data_2["nu_end"],
                                data_2["pump_ls"], data_2["chi_rs"],
                                data_2["convol"], data_2["doppler_effect"],
-                               data_2["pump_lw"], data_2["num_sample"])
+                               data_2["pump_lw"], data_2["num_sample"],
+                               data_2.get("grid", "uniform"))
 
 
 # reset the reset button n_clicks to 0 when switching between settings tabs
@@ -250,11 +277,13 @@ def reset_conditions(n, data):
         Input('pump_lw-input', 'value'),
         Input('spectral-range', 'value'),
         Input('num_sample-input', 'value'),
+        Input('num_sample-auto', 'value'),
+        Input('grid-select', 'value'),
     ],
     State("memory-settings-models", "data"),
 )
 def update_memory_models(pump_ls, chi_rs, convol, doppler_effect, pump_lw,
-                         spectral_range, num_sample, data):
+                         spectral_range, num_sample, auto, grid, data):
     data["nu_start"] = spectral_range[0]
     data["nu_end"] = spectral_range[1]
     data["pump_ls"] = pump_ls
@@ -262,7 +291,8 @@ def update_memory_models(pump_ls, chi_rs, convol, doppler_effect, pump_lw,
     data["convol"] = convol
     data["doppler_effect"] = doppler_effect
     data["pump_lw"] = pump_lw
-    data["num_sample"] = num_sample
+    data["num_sample"] = "auto" if auto else num_sample
+    data["grid"] = grid
 
     return data
 
@@ -277,6 +307,8 @@ def update_memory_models(pump_ls, chi_rs, convol, doppler_effect, pump_lw,
         Output('pump_lw-input', 'value'),
         Output('spectral-range', 'value'),
         Output('num_sample-input', 'value'),
+        Output('num_sample-auto', 'value'),
+        Output('grid-select', 'value'),
     ],
     Input('reset-button', 'n_clicks'),
     State("memory-settings-models", "data"),
@@ -284,42 +316,97 @@ def update_memory_models(pump_ls, chi_rs, convol, doppler_effect, pump_lw,
 def reset_models(n, data):
     if n > 0:
         data = DEFAULT_SETTINGS_MODELS
+    auto = data["num_sample"] == "auto"
     _settings = [data["pump_ls"], data["chi_rs"], data["convol"],
                  data["doppler_effect"], data["pump_lw"],
                  [data["nu_start"], data["nu_end"]],
-                 data["num_sample"]]
+                 DEFAULT_SETTINGS_MODELS["num_sample"] if auto
+                 else data["num_sample"],
+                 ["auto"] if auto else [], data.get("grid", "uniform")]
     return _settings
 
 
-# create and save spectrum data in memory
+# the slider is only used without auto, which shows the number it picks
 @app.callback(
-    Output("memory-synth-spectrum", "data"),
     [
-        Input("memory-settings-conditions", "data"),
-        Input("memory-settings-models", "data"),
+        Output("num_sample-input", "disabled"),
+        Output("num_sample-info", "children"),
     ],
+    Input("memory-settings-models", "data"),
+    Input("memory-settings-conditions", "data"),
 )
-def update_synth_spectrum(data_1, data_2):
+def update_num_sample_info(data_2, data_1):
+    if data_2["num_sample"] != "auto":
+        return False, None
+    needed = auto_num_sample(
+        data_1["pressure"], data_1["temperature"], data_2["pump_lw"],
+        data_2["nu_start"], data_2["nu_end"], data_2["convol"],
+        data_2["doppler_effect"] == "enable", data_2.get("grid", "uniform"),
+        max_sample=None)
+    num_sample = min(needed, AUTO_MAX_SAMPLE)
+    cost = estimated_cost(num_sample, data_2["chi_rs"])
+    info = f"auto: {num_sample} points (about {cost:.2f} s)"
+    if needed > num_sample:
+        info += (f", capped: {needed} would be needed for an error below "
+                 f"{AUTO_TOLERANCE:.1%}")
+    return True, info
+
+
+def synth_spectrum(data_1, data_2):
+    data_2 = dict(data_2)
     if data_2["doppler_effect"] == "enable":
         data_2["doppler_effect"] = True
     else:
         data_2["doppler_effect"] = False
-    nu, spect = synthesize_cars(**data_1, **data_2)
-    return [nu, spect]
+    return synthesize_cars(**data_1, **data_2)
+
+
+# look up the spectrum by its key, recompute it if the key has expired (or
+# was issued by another worker)
+def load_synth_spectrum(session_id, spect_key, data_1, data_2):
+    spect_memo = ARRAY_STORE.get(session_id, spect_key)
+    if spect_memo is None:
+        spect_memo = synth_spectrum(data_1, data_2)
+    return spect_memo
+
+
+# create and save spectrum data in memory
+@app.callback(
+    Output("memory-synth-spectrum", "data"),
+    [
+        Input("memory-settings-conditions", "data"),
+        Input("memory-settings-models", "data"),
+    ],
+    State("session-id", "data"),
+)
+def update_synth_spectrum(data_1, data_2, session_id):
+    nu, spect = synth_spectrum(data_1, data_2)
+    return ARRAY_STORE.put(session_id, (nu, spect))
 
 
 # plot spectrum from data stored in memory
 @app.callback(
+    Output("memory-synth-figure", "data"),
+    Input("memory-synth-spectrum", "data"),
+    State("session-id", "data"),
+    State("memory-settings-conditions", "data"),
+    State("memory-settings-models", "data"),
+)
+def update_synth_plot(spect_key, session_id, data_1, data_2):
+    nu, spect = load_synth_spectrum(session_id, spect_key, data_1, data_2)
+    figure = plot_cars(nu, spect)
+    return figure
+
+
+# switching between linear and log scale is done in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace="carspy", function_name="set_y_scale"),
     Output("synth-signal", "figure"),
     [
-        Input("memory-synth-spectrum", "data"),
+        Input("memory-synth-figure", "data"),
         Input("change-y-scale", "value")
     ],
 )
-def update_synth_plot(spect_memo, y_scale):
-    nu, spect = spect_memo
-    figure = plot_cars(nu, spect, y_scale)
-    return figure
 
 
 # setting panels
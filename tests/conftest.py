@@ -0,0 +1,15 @@
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+# the caches, uploads and job database of the tests are kept apart from
+# those of the app, the modules read these when imported
+_TMP_DIR = tempfile.mkdtemp(prefix="carspy-dash-tests-")
+os.environ["CARSPY_CACHE_DIR"] = os.path.join(_TMP_DIR, "cache")
+os.environ["CARSPY_SHARED_CACHE_DIR"] = os.path.join(_TMP_DIR, "shared")
+atexit.register(shutil.rmtree, _TMP_DIR, ignore_errors=True)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
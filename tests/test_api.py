@@ -0,0 +1,77 @@
+import time
+
+import numpy as np
+import pytest
+
+import index
+
+SYNTHESIS = {"num_sample": 2500, "nu_start": 2280, "nu_end": 2320}
+
+
+@pytest.fixture(scope="module")
+def client():
+    return index.app.server.test_client()
+
+
+def _poll(client, url, timeout=120):
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get(url)
+        if response.status_code != 202 or time.monotonic() > deadline:
+            return response
+        time.sleep(0.2)
+
+
+def test_synthesize_returns_a_job_url(client):
+    response = client.post("/api/synthesize", json=SYNTHESIS)
+    assert response.status_code == 202
+    body = response.get_json()
+    assert body["status"] in ("queued", "running")
+    assert body["total"] == 1
+    assert response.headers["Location"].endswith(body["url"])
+    assert body["url"] == f"/api/jobs/{body['id']}"
+
+    response = _poll(client, body["url"])
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["status"] == "done"
+    result, = body["results"]
+    assert result["index"] == 0 and "error" not in result
+    assert len(result["nu"]) == len(result["signal"]) == 2500
+    assert np.isfinite(result["signal"]).all()
+
+
+def test_synthesize_batch(client):
+    response = client.post("/api/synthesize", json={
+        "batch": [SYNTHESIS, dict(SYNTHESIS, temperature=1000)],
+        "arrays": False})
+    response = _poll(client, response.headers["Location"])
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [_r["index"] for _r in results] == [0, 1]
+    assert all(set(_r) == {"index"} for _r in results)
+
+
+@pytest.mark.parametrize("body", [
+    dict(SYNTHESIS, temperature=10),
+    dict(SYNTHESIS, chi_rs="unknown"),
+    dict(SYNTHESIS, nu_start=2320, nu_end=2280),
+    dict(SYNTHESIS, unknown=1),
+    dict(SYNTHESIS, wait="later"),
+])
+def test_synthesize_rejects_invalid_settings(client, body):
+    response = client.post("/api/synthesize", json=body)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_fit_needs_a_spectrum(client):
+    response = client.post("/api/fit", json={"nu": [1, 2, 3]})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("method", ["GET", "DELETE"])
+def test_unknown_job(client, method):
+    response = client.open("/api/jobs/unknown", method=method)
+    assert response.status_code == 404
+    assert response.get_json()["status"] == "unknown"
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from cache import settings_key, write_mapped, read_mapped
+
+CONDITIONS = {"pressure": 1, "temperature": 1750.0,
+              "comp": {"N2": 0.79, "O2": 0.21}}
+
+
+def test_settings_key_is_stable():
+    # keys of the disk and shared caches must not change between runs
+    assert settings_key(CONDITIONS, "isolated", num_sample=5000) \
+        == "6393a8c979b9fd1383303ef0252bd9ba19c388da"
+
+
+def test_settings_key_ignores_order_and_number_types():
+    reordered = {"comp": {"O2": 0.21, "N2": 0.79},
+                 "temperature": np.float64(1750), "pressure": 1.0}
+    assert settings_key(reordered, "isolated", num_sample=np.int64(5000)) \
+        == settings_key(CONDITIONS, "isolated", num_sample=5000)
+
+
+def test_settings_key_rounds_floats():
+    almost = dict(CONDITIONS, temperature=1750.0 + 1e-12)
+    assert settings_key(almost) == settings_key(CONDITIONS)
+
+
+def test_settings_key_distinguishes_settings():
+    keys = {settings_key(CONDITIONS),
+            settings_key(dict(CONDITIONS, temperature=1751)),
+            settings_key(dict(CONDITIONS, comp={"N2": 1})),
+            settings_key(CONDITIONS, "isolated"),
+            settings_key(CONDITIONS, chi_rs="isolated"),
+            settings_key(CONDITIONS, np.arange(3.)),
+            settings_key(CONDITIONS, np.arange(1, 4.))}
+    assert len(keys) == 7
+
+
+def test_mapped_round_trip(tmp_path):
+    value = {
+        "nu": np.linspace(2250, 2350, 1001),
+        "spect": np.arange(12, dtype=np.complex128).reshape(3, 4),
+        "counts": (np.arange(5, dtype=np.int32), 3, "text"),
+        "items": [np.float32(1.5), None, True, {"nested": np.ones(1)}],
+    }
+    path = tmp_path / "value.bin"
+    size = write_mapped(path, value)
+    assert path.stat().st_size == size
+
+    result = read_mapped(path)
+    assert set(result) == set(value)
+    for _name in ("nu", "spect"):
+        assert result[_name].dtype == value[_name].dtype
+        np.testing.assert_array_equal(result[_name], value[_name])
+        assert not result[_name].flags.writeable
+    counts, number, text = result["counts"]
+    assert counts.dtype == np.int32
+    np.testing.assert_array_equal(counts, np.arange(5))
+    assert (number, text) == (3, "text")
+    assert result["items"][:3] == [1.5, None, True]
+    np.testing.assert_array_equal(result["items"][3]["nested"], np.ones(1))
+
+
+def test_read_mapped_rejects_other_files(tmp_path):
+    empty = tmp_path / "empty.bin"
+    empty.touch()
+    other = tmp_path / "other.bin"
+    other.write_bytes(b"not a cache file")
+    for _path in (empty, other):
+        with pytest.raises(ValueError):
+            read_mapped(_path)
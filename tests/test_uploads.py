@@ -0,0 +1,69 @@
+import io
+
+import numpy as np
+import pytest
+
+from uploads import spill, load_upload, h5py
+
+NU = np.linspace(2250, 2350, 50)
+SIGNALS = np.random.default_rng(0).random((3, 50))
+ROWS = np.vstack([NU, SIGNALS])
+
+
+def _written(write):
+    buffer = io.BytesIO()
+    write(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def _hdf5(buffer):
+    with h5py.File(buffer, "w") as f:
+        f["nu"] = NU
+        f["signals"] = SIGNALS
+
+
+FORMATS = {
+    "shots.csv": lambda b: np.savetxt(b, ROWS.T, delimiter=","),
+    "shots.txt": lambda b: np.savetxt(b, ROWS.T),
+    "shots.npy": lambda b: np.save(b, ROWS),
+    "shots.npz": lambda b: np.savez(b, nu=NU, signals=SIGNALS),
+    "rows.npz": lambda b: np.savez(b, ROWS),
+    "shots.h5": _hdf5,
+    "shots.hdf5": _hdf5,
+}
+
+
+@pytest.mark.parametrize("filename", FORMATS)
+def test_load_upload(filename):
+    if filename.endswith(("h5", "hdf5")) and h5py is None:
+        pytest.skip("h5py is not installed")
+    nu, signals = load_upload(spill(_written(FORMATS[filename]), filename))
+    np.testing.assert_allclose(nu, NU)
+    np.testing.assert_allclose(signals, SIGNALS)
+
+
+def test_load_upload_single_shot():
+    handle = spill(_written(lambda b: np.savez(b, nu=NU, signals=NU**2)),
+                   "shot.npz")
+    nu, signals = load_upload(handle)
+    assert signals.shape == (1, len(NU))
+    np.testing.assert_allclose(signals[0], NU**2)
+
+
+def test_load_upload_rejects_mismatched_shots():
+    handle = spill(_written(lambda b: np.savez(b, nu=NU,
+                                               signals=SIGNALS[:, 1:])),
+                   "shots.npz")
+    with pytest.raises(ValueError):
+        load_upload(handle)
+
+
+def test_spill_rejects_other_formats():
+    with pytest.raises(ValueError):
+        spill(io.BytesIO(b"1,2"), "shots.xlsx")
+
+
+def test_load_upload_rejects_invalid_handles():
+    with pytest.raises(ValueError):
+        load_upload("../../etc")
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from utils import convolve_same, DIRECT_CONVOL_MAX
+
+
+def _gaussian(length, width):
+    x = np.arange(length) - (length - 1)/2
+    return np.exp(-(x/width)**2)
+
+
+@pytest.mark.parametrize("spect_length, kernel_length", [
+    (100, 11),      # direct sum
+    (100, 10),      # even kernel
+    (20000, 101),   # overlap-add
+    (20000, 8001),  # FFT
+    (11, 100),      # kernel longer than the signal
+])
+def test_convolve_same_matches_numpy(spect_length, kernel_length):
+    rng = np.random.default_rng(0)
+    spect = rng.random(spect_length)
+    kernel = _gaussian(kernel_length, kernel_length/6)
+    expected = np.convolve(spect, kernel, mode="same")
+    np.testing.assert_allclose(convolve_same(spect, kernel), expected,
+                               rtol=1e-9, atol=1e-9*np.abs(expected).max())
+
+
+def test_convolve_same_trims_the_kernel():
+    # a kernel with long zero tails, cut off asymmetrically
+    rng = np.random.default_rng(1)
+    spect = rng.random(5000)
+    kernel = np.zeros(2001)
+    kernel[900:1050] = _gaussian(150, 20)
+    assert len(spect)*len(kernel) > DIRECT_CONVOL_MAX
+    np.testing.assert_allclose(convolve_same(spect, kernel),
+                               np.convolve(spect, kernel, mode="same"),
+                               rtol=1e-9, atol=1e-9)
+
+
+def test_convolve_same_rows_and_complex():
+    rng = np.random.default_rng(2)
+    spect = rng.random((3, 4000)) + 1j*rng.random((3, 4000))
+    kernel = _gaussian(301, 40)
+    result = convolve_same(spect, kernel)
+    assert result.shape == spect.shape
+    for _row, _spect in zip(result, spect):
+        np.testing.assert_allclose(_row, np.convolve(_spect, kernel, "same"),
+                                   rtol=1e-9, atol=1e-9)
+
+
+def test_convolve_same_zero_kernel():
+    result = convolve_same(np.ones(50), np.zeros(7))
+    np.testing.assert_array_equal(result, np.zeros(50))
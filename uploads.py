@@ -0,0 +1,356 @@
+import io
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import zipfile
+
+import numpy as np
+from numpy.lib import format as npy_format
+from flask import request, jsonify
+import dash_core_components as dcc
+import dash_html_components as html
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from app import app
+from cache import CACHE_DIR
+from library import run_library_batch
+from utils import fit_shot
+
+# uploaded data, one directory of memory-mapped arrays per upload
+UPLOAD_DIR = CACHE_DIR / "uploads"
+UPLOAD_FORMATS = (".csv", ".txt", ".npy", ".npz", ".h5", ".hdf5")
+UPLOAD_HINT = (".npy: wavenumbers in the first row, one shot per following "
+               "row; .csv: wavenumbers in the first column, one shot per "
+               "following column; .npz/.h5: arrays 'nu' and 'signals' (a "
+               ".npz with a single array is read like a .npy).")
+# uploads are removed after this many seconds
+UPLOAD_MAX_AGE = float(os.environ.get("CARSPY_UPLOAD_MAX_AGE", 24*3600))
+# largest upload (and largest total size of the arrays in an archive)
+UPLOAD_MAX_MB = float(os.environ.get("CARSPY_UPLOAD_MAX_MB", 2048))
+# bytes copied at a time
+CHUNK_SIZE = 2**20
+# lines (or HDF5 rows) converted at a time
+CHUNK_LINES = 8192
+
+_HANDLE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UploadTooLarge(ValueError):
+
+    def __init__(self, max_bytes):
+        super().__init__(f"uploads are limited to {max_bytes/2**20:g} MB")
+
+
+def _upload_path(handle):
+    if not _HANDLE.match(str(handle)):
+        raise ValueError("invalid upload handle")
+    return UPLOAD_DIR / handle
+
+
+# file of an array in the directory of an upload, names come from the
+# uploaded file and must not point outside of it
+def _array_path(directory, name):
+    directory = directory.resolve()
+    path = (directory / f"{name}.dat").resolve()
+    if path.parent != directory:
+        raise ValueError(f"invalid array name {name!r}")
+    return path
+
+
+# request body that stops being read once more than max_bytes came in, also
+# when no (or a wrong) Content-Length was sent
+class _LimitedStream(io.RawIOBase):
+
+    def __init__(self, stream, max_bytes):
+        self._stream = stream
+        self.max_bytes = max_bytes
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(min(len(buffer),
+                                     self.max_bytes - self.count + 1))
+        self.count += len(data)
+        if self.count > self.max_bytes:
+            raise UploadTooLarge(self.max_bytes)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# copy the body of a .npy stream to a raw file, only the header is parsed
+def _spill_npy(stream, path):
+    version = npy_format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_1_0(stream)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_2_0(stream)
+    else:
+        raise ValueError(f"unsupported .npy version {version}")
+    if dtype.hasobject:
+        raise ValueError("object arrays are not supported")
+    with open(path, "wb") as f:
+        shutil.copyfileobj(stream, f, CHUNK_SIZE)
+    if os.path.getsize(path) < int(np.prod(shape))*dtype.itemsize:
+        raise ValueError("truncated .npy file")
+    return {"dtype": dtype.str, "shape": list(shape),
+            "order": "F" if fortran_order else "C"}
+
+
+# parse a delimited text stream chunk by chunk into a raw float64 file
+def _spill_text(stream, path):
+    text = io.TextIOWrapper(stream, encoding="utf-8", errors="replace")
+    rows, columns, delimiter = 0, None, None
+
+    def _flush(f, lines):
+        nonlocal rows, columns
+        block = np.loadtxt(lines, delimiter=delimiter, ndmin=2)
+        if columns is None:
+            columns = block.shape[1]
+        elif block.shape[1] != columns:
+            raise ValueError("rows have different numbers of columns")
+        f.write(np.ascontiguousarray(block, dtype="<f8").tobytes())
+        rows += len(block)
+
+    with open(path, "wb") as f:
+        lines = []
+        for _line in text:
+            _line = _line.strip()
+            if not _line or _line.startswith("#"):
+                continue
+            if delimiter is None:
+                delimiter = next((_d for _d in (",", ";", "\t")
+                                  if _d in _line), " ")
+                try:
+                    [float(_v) for _v in _line.split(delimiter) if _v]
+                except ValueError:
+                    # header line
+                    continue
+            if delimiter == " ":
+                _line = " ".join(_line.split())
+            lines.append(_line)
+            if len(lines) == CHUNK_LINES:
+                _flush(f, lines)
+                lines = []
+        if lines:
+            _flush(f, lines)
+    if not rows:
+        raise ValueError("no data found")
+    return {"dtype": "<f8", "shape": [rows, columns], "order": "C"}
+
+
+# datasets are copied in blocks of rows
+def _spill_hdf5(path, directory, max_bytes):
+    if h5py is None:
+        raise ValueError("h5py is required to read HDF5 files")
+    arrays = {}
+    with h5py.File(path, "r") as data:
+        # datasets may be compressed
+        if sum(data[_name].size*data[_name].dtype.itemsize
+               for _name in ("nu", "signals")) > max_bytes:
+            raise UploadTooLarge(max_bytes)
+        for _name in ("nu", "signals"):
+            dataset = data[_name]
+            dtype = np.dtype(dataset.dtype).newbyteorder("<")
+            with open(_array_path(directory, _name), "wb") as f:
+                for _start in range(0, max(dataset.shape[0], 1),
+                                    CHUNK_LINES):
+                    f.write(np.ascontiguousarray(
+                        dataset[_start:_start + CHUNK_LINES],
+                        dtype=dtype).tobytes())
+            arrays[_name] = {"dtype": dtype.str, "shape": list(dataset.shape),
+                             "order": "C"}
+    return arrays
+
+
+def _remove_old_uploads():
+    if not UPLOAD_DIR.exists():
+        return
+    for _path in UPLOAD_DIR.iterdir():
+        try:
+            if time.time() - _path.stat().st_mtime > UPLOAD_MAX_AGE:
+                shutil.rmtree(_path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+# arrays of an .npz archive that are read: 'nu' and 'signals' or a single
+# array (stored as 'data'), no other member names are used for files
+def _npz_members(archive, max_bytes):
+    members = {_info.filename[:-len(".npy")]: _info
+               for _info in archive.infolist()
+               if _info.filename.endswith(".npy")}
+    if "nu" in members and "signals" in members:
+        members = {_name: members[_name] for _name in ("nu", "signals")}
+    elif len(members) == 1:
+        members = {"data": next(iter(members.values()))}
+    else:
+        raise ValueError("expected arrays 'nu' and 'signals' or a single "
+                         "array")
+    # the sizes are checked again while the members are read
+    if sum(_info.file_size for _info in members.values()) > max_bytes:
+        raise UploadTooLarge(max_bytes)
+    return members
+
+
+# parse an uploaded file (a binary stream) into memory-mapped arrays on disk,
+# returns the handle
+def spill(stream, filename, max_bytes=int(UPLOAD_MAX_MB*2**20)):
+    suffix = os.path.splitext(filename)[1].lower()
+    if suffix not in UPLOAD_FORMATS:
+        raise ValueError("unsupported file type")
+    stream = io.BufferedReader(_LimitedStream(stream, max_bytes), CHUNK_SIZE)
+    _remove_old_uploads()
+    handle = uuid.uuid4().hex
+    directory = UPLOAD_DIR / (handle + ".tmp")
+    os.makedirs(directory)
+    try:
+        if suffix == ".npy":
+            arrays = {"data": _spill_npy(stream, directory / "data.dat")}
+        elif suffix in (".csv", ".txt"):
+            arrays = {"data": _spill_text(stream, directory / "data.dat")}
+        else:
+            # archives need random access, keep a copy until converted
+            _archive = directory / ("upload" + suffix)
+            with open(_archive, "wb") as f:
+                shutil.copyfileobj(stream, f, CHUNK_SIZE)
+            if suffix == ".npz":
+                arrays = {}
+                with zipfile.ZipFile(_archive) as archive:
+                    for _name, _info in _npz_members(archive,
+                                                     max_bytes).items():
+                        with archive.open(_info) as _stream:
+                            arrays[_name] = _spill_npy(
+                                _stream, _array_path(directory, _name))
+            else:
+                arrays = _spill_hdf5(_archive, directory, max_bytes)
+            os.remove(_archive)
+        with open(directory / "meta.json", "w") as f:
+            json.dump({"filename": filename, "arrays": arrays}, f)
+        os.replace(directory, _upload_path(handle))
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return handle
+
+
+def open_array(handle, name):
+    path = _upload_path(handle)
+    with open(path / "meta.json") as f:
+        meta = json.load(f)["arrays"][name]
+    return np.memmap(_array_path(path, name), dtype=np.dtype(meta["dtype"]),
+                     mode="r", shape=tuple(meta["shape"]),
+                     order=meta["order"])
+
+
+# wavenumber axis and shots (one per row) of an upload, without reading the
+# data into memory
+def load_upload(handle):
+    path = _upload_path(handle)
+    with open(path / "meta.json") as f:
+        meta = json.load(f)
+    if "nu" in meta["arrays"] and "signals" in meta["arrays"]:
+        nu = open_array(handle, "nu")
+        signals = open_array(handle, "signals")
+        if signals.ndim == 1:
+            signals = signals[None, :]
+    else:
+        data = open_array(handle, next(iter(meta["arrays"])))
+        if data.ndim != 2:
+            raise ValueError("expected a 2D array or arrays 'nu' and "
+                             "'signals'")
+        if os.path.splitext(meta["filename"])[1].lower() in (".csv",
+                                                             ".txt"):
+            # wavenumbers in the first column, one shot per following column
+            nu, signals = data[:, 0], data[:, 1:].T
+        else:
+            # binary arrays (.npy, .npz with a single array): wavenumbers in
+            # the first row, one shot per following row
+            nu, signals = data[0], data[1:]
+    if nu.ndim != 1 or signals.ndim != 2 or signals.shape[1] != len(nu) \
+            or not len(signals):
+        raise ValueError("shots do not match the wavenumber axis")
+    return nu, signals
+
+
+# the only information about an upload that is sent to the browser
+def describe(handle):
+    nu, signals = load_upload(handle)
+    with open(_upload_path(handle) / "meta.json") as f:
+        filename = json.load(f)["filename"]
+    return {"handle": handle, "filename": filename, "shots": len(signals),
+            "points": len(nu)}
+
+
+# single shot as plain arrays
+def load_shot(handle, shot=0):
+    nu, signals = load_upload(handle)
+    return np.array(nu, dtype=float), np.array(signals[shot], dtype=float)
+
+
+# batch jobs open the upload themselves, so no data is queued or pickled
+def fit_upload_shot(handle, shot, slit_parameters, settings_models,
+                    settings_conditions, settings_solver=None):
+    nu, signal = load_shot(handle, shot)
+    return fit_shot(shot, nu, signal, slit_parameters, settings_models,
+                    settings_conditions, settings_solver=settings_solver)
+
+
+def fit_upload_library(handle, slit_parameters, settings_models,
+                       settings_conditions, **kwargs):
+    nu, signals = load_upload(handle)
+    return run_library_batch(np.arange(len(signals)),
+                             np.array(nu, dtype=float), signals,
+                             slit_parameters, settings_models,
+                             settings_conditions)
+
+
+# the request body is streamed to disk instead of being read into memory, up
+# to UPLOAD_MAX_MB
+@app.server.route("/upload", methods=["POST"])
+def upload():
+    filename = os.path.basename(request.args.get("filename", ""))
+    max_bytes = int(UPLOAD_MAX_MB*2**20)
+    try:
+        if (request.content_length or 0) > max_bytes:
+            raise UploadTooLarge(max_bytes)
+        return jsonify(describe(spill(request.stream, filename, max_bytes)))
+    except UploadTooLarge as e:
+        return jsonify({"filename": filename, "error": str(e)}), 413
+    except Exception as e:
+        return jsonify({"filename": filename, "error": str(e)}), 400
+
+
+# drop zone handled by assets/upload.js, which posts the file to /upload and
+# writes the JSON response into the hidden input "<upload_id>-handle"
+def make_upload(upload_id, formats=UPLOAD_FORMATS):
+    return html.Div(
+        [
+            html.Div("Drag and drop or click to select a file",
+                     className="carspy-upload-label"),
+            dcc.Input(id=f"{upload_id}-handle", type="text",
+                      style={"display": "none"}),
+        ],
+        id=upload_id,
+        className="carspy-upload p-3 text-center",
+        style={"border": "1px dashed #adb5bd", "border-radius": "5px",
+               "cursor": "pointer"},
+        **{"data-accept": ",".join(formats)}
+    )
+
+
+# parse the value of the hidden input
+def read_handle(value):
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return {"filename": "", "error": "invalid server response"}
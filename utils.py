@@ -1,11 +1,16 @@
+import os
+import time
+import pickle
+import importlib
 from pathlib import Path
-from carspy import CarsSpectrum, CarsFit
-from carspy.utils import pkl_load, downsample
-from carspy.convol_fcn import asym_Gaussian, asym_Voigt
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-from lmfit.printfuncs import fit_report
 import plotly.graph_objects as go
 
+import jobs
+from cache import (SPECTRUM_CACHE, FIT_CACHE, SHARED_CACHE,
+                   DISK_CACHE, LRUCache, settings_key)
+
 INIT_COMP = {'N2': 0.79,
              'Ar': 0.0,
              'CO2': 0,
@@ -29,7 +34,26 @@ DEFAULT_SETTINGS_MODELS = {
     "pump_ls": "Gaussian",
     "chi_rs": "isolated",
     "convol": "Yuratich",
-    "doppler_effect": "disable"
+    "doppler_effect": "disable",
+    "grid": "uniform"
+}
+
+# ranges of the synthesis settings (min, max, step of the sliders) and the
+# options of the model selects, requests to the API are checked against them
+SETTINGS_RANGES = {
+    "pressure": (0.5, 20, 0.5),
+    "temperature": (300, 3000, 1),
+    "pump_lw": (0.02, 5, 0.02),
+    "num_sample": (2500, 15000, 2500),
+    "nu_start": (2200, 2400, 2),
+    "nu_end": (2200, 2400, 2),
+}
+SETTINGS_OPTIONS = {
+    "pump_ls": ["Gaussian", "Lorentzian"],
+    "chi_rs": ["G-matrix", "isolated"],
+    "convol": ["Kataoka", "Yuratich"],
+    "doppler_effect": ["enable", "disable"],
+    "grid": ["uniform", "adaptive"],
 }
 
 DEFAULT_SETTINGS_SLIT = {
@@ -48,28 +72,148 @@ DEFAULT_SETTINGS_FIT = {
     "offset": 0.0
 }
 
+DEFAULT_SETTINGS_SOLVER = {
+    "method": "least-squares",
+    "coarse_scan": False,
+    "free": [],
+}
+
+# parameters that can be fitted besides temperature: (label, min, max)
+FREE_PARAMETERS = {
+    'x_mol': ("x_mol", 0.01, 1),
+    'nu_shift': ("nu_shift", -5, 5),
+    'nu_stretch': ("nu_stretch", 0.9, 1.1),
+    'pump_lw': ("pump_lw", 0.01, 5),
+    'param1': ("sigma", 0.01, 10),
+    'param2': ("k", 0.01, 10),
+    'param3': ("a_sigma", -2, 2),
+    'param4': ("a_k", -2, 2),
+    'param5': ("sigma_L_l", 0.001, 5),
+    'param6': ("sigma_L_h", 0.001, 5),
+}
+
+# processes a single fit may use: each of the jobs.JOB_WORKERS fit processes
+# gets its share of the cores for its own pools
+FIT_PROCESSES = max(1, (os.cpu_count() or 1)//jobs.JOB_WORKERS)
+# coarse temperature grid (and its parallelism) for the optional global
+# search before the local least-square fit
+SCAN_TEMPERATURES = np.linspace(250, 3000, 23)
+SCAN_WORKERS = int(os.environ.get("CARSPY_SCAN_WORKERS", FIT_PROCESSES))
+# refinement factor of the coarse scan, it only has to locate the start of the
+# local fit to within one grid step (at 10 the minimum of the default signal
+# moves by three steps, at 30 it matches the full resolution)
+SCAN_REF_FAC = 30
+# refinement factor of the least-square fits
+FIT_REF_FAC = 80
+# largest distance (RMS difference of the normalized signals plus the slit
+# parameter differences) of a cached fit used to warm-start a new one
+WARM_START_TOL = 0.05
+# fits per model configuration kept for warm starts (shared by all workers)
+WARM_START_ITEMS = 32
+# processes (the fit process included) evaluating the Jacobian columns of
+# multi-parameter fits; with fewer than varied parameters the columns would
+# be serialized, lmfit then computes the Jacobian itself
+JACOBIAN_WORKERS = int(os.environ.get("CARSPY_JACOBIAN_WORKERS",
+                                      FIT_PROCESSES))
+
 SPECT_PATH = Path(__file__).parent / "_data/_DEFAULT_SPECTRUM"
 SIGNAL_PATH = Path(__file__).parent / "_data/_DEFAULT_FIT_SIGNAL"
-DEFAULT_SPECTRUM = pkl_load(SPECT_PATH)
-DEFAULT_FIT_SIGNAL = pkl_load(SIGNAL_PATH)
+
+
+# carspy (which imports lmfit) and scipy.signal are only imported by the
+# functions that need them: importing them takes longer than everything else
+# a web worker imports, and pages showing the default spectrum and fit signal
+# can be served without them (see also preload())
+def _pkl_load(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+DEFAULT_SPECTRUM = _pkl_load(SPECT_PATH)
+DEFAULT_FIT_SIGNAL = _pkl_load(SIGNAL_PATH)
+
+
+def spectrum_key(pressure=1, temperature=1750, pump_lw=1.0, nu_start=2262,
+                 nu_end=2345, num_sample=5000, pump_ls='Gaussian',
+                 chi_rs='isolated', convol='Y', doppler_effect=False,
+                 comp=None, grid='uniform'):
+    if comp is None:
+        comp = INIT_COMP
+    return settings_key(pressure=pressure, temperature=temperature,
+                        pump_lw=pump_lw, nu_start=nu_start, nu_end=nu_end,
+                        num_sample=num_sample, pump_ls=pump_ls, chi_rs=chi_rs,
+                        convol=convol, doppler_effect=doppler_effect,
+                        comp=comp, grid=grid)
 
 
 def synthesize_cars(pressure=1, temperature=1750, pump_lw=1.0,
                     nu_start=2262, nu_end=2345, num_sample=5000,
                     pump_ls='Gaussian', chi_rs='isolated',
-                    convol='Y', doppler_effect=False, comp=None):
+                    convol='Y', doppler_effect=False, comp=None,
+                    grid='uniform'):
+    if comp is None:
+        comp = INIT_COMP
+    if num_sample == 'auto':
+        from sampling import auto_num_sample
+        num_sample = auto_num_sample(pressure, temperature, pump_lw,
+                                     nu_start, nu_end, convol, doppler_effect,
+                                     grid)
+    key = spectrum_key(pressure, temperature, pump_lw, nu_start, nu_end,
+                       num_sample, pump_ls, chi_rs, convol, doppler_effect,
+                       comp, grid)
+    cached = _cached_spectrum(key)
+    if cached is not None:
+        return cached
+
+    nu, spect = _synthesize_cars(pressure, temperature, pump_lw, nu_start,
+                                 nu_end, num_sample, pump_ls, chi_rs, convol,
+                                 doppler_effect, comp, grid)
+    # the settings are kept in the index of the disk cache for warm_up
+    settings = dict(pressure=pressure, temperature=temperature,
+                    pump_lw=pump_lw, nu_start=nu_start, nu_end=nu_end,
+                    num_sample=num_sample, pump_ls=pump_ls, chi_rs=chi_rs,
+                    convol=convol, doppler_effect=doppler_effect, comp=comp,
+                    grid=grid)
+    return _store_spectrum(key, (nu, spect), settings)
+
+
+# look in the cache of this process, then in the one shared by all workers,
+# then in the one kept on disk across restarts
+def _cached_spectrum(key):
+    cached = SPECTRUM_CACHE.get(key)
+    if cached is None:
+        cached = SHARED_CACHE.get(key)
+        if cached is None:
+            cached = DISK_CACHE.get(key)
+            if cached is not None:
+                SHARED_CACHE.put(key, cached)
+        if cached is not None:
+            SPECTRUM_CACHE.put(key, cached)
+    return cached
+
+
+def _store_spectrum(key, value, settings=None):
+    SHARED_CACHE.put(key, value)
+    DISK_CACHE.put(key, value, settings)
+    return SPECTRUM_CACHE.put(key, value)
+
+
+def _synthesize_cars(pressure, temperature, pump_lw, nu_start, nu_end,
+                     num_sample, pump_ls, chi_rs, convol, doppler_effect,
+                     comp, grid='uniform'):
+    from carspy import CarsSpectrum
     synth_mode = {'pump_ls': pump_ls,
                   'chi_rs': chi_rs,
                   'convol': convol,
                   'doppler_effect': doppler_effect,
                   'chem_eq': False}
 
-    if comp is None:
-        comp = INIT_COMP
-
     nu = np.linspace(nu_start, nu_end, num=num_sample)
-    cars = CarsSpectrum(pressure=pressure, init_comp=comp,
+    cars = CarsSpectrum(pressure=pressure, init_comp=dict(comp),
                         chi_set="SET 3")
+    if grid == 'adaptive':
+        return nu, signal_as_adaptive(cars, nu, temperature, synth_mode,
+                                      pump_lw=pump_lw)
     _, spect = cars.signal_as(temperature=temperature,
                               nu_s=nu,
                               synth_mode=synth_mode,
@@ -78,19 +222,262 @@ def synthesize_cars(pressure=1, temperature=1750, pump_lw=1.0,
     return nu, spect
 
 
+# many temperatures (and pressures) of one model configuration at once,
+# returns nu and an (n_T, num_sample) array
+def synthesize_cars_batch(temperatures, pressures=None, pump_lw=1.0,
+                          nu_start=2262, nu_end=2345, num_sample=5000,
+                          pump_ls='Gaussian', chi_rs='isolated',
+                          convol='Y', doppler_effect=False, comp=None):
+    if comp is None:
+        comp = INIT_COMP
+    temperatures = np.atleast_1d(np.asarray(temperatures, dtype=float))
+    pressures = np.broadcast_to(np.asarray(
+        1 if pressures is None else pressures, dtype=float),
+        temperatures.shape)
+    key = settings_key(temperatures=temperatures, pressures=pressures,
+                       pump_lw=pump_lw, nu_start=nu_start, nu_end=nu_end,
+                       num_sample=num_sample, pump_ls=pump_ls, chi_rs=chi_rs,
+                       convol=convol, doppler_effect=doppler_effect,
+                       comp=comp)
+    cached = _cached_spectrum(key)
+    if cached is not None:
+        return cached
+
+    from carspy import CarsSpectrum
+    synth_mode = {'pump_ls': pump_ls,
+                  'chi_rs': chi_rs,
+                  'convol': convol,
+                  'doppler_effect': doppler_effect,
+                  'chem_eq': False}
+    nu = np.linspace(nu_start, nu_end, num=num_sample)
+    spect = np.empty((len(temperatures), num_sample))
+    for _pressure in np.unique(pressures):
+        rows = np.flatnonzero(pressures == _pressure)
+        cars = CarsSpectrum(pressure=float(_pressure), init_comp=dict(comp),
+                            chi_set="SET 3")
+        spect[rows] = signal_as_batch(cars, nu, temperatures[rows],
+                                      synth_mode, pump_lw=pump_lw)
+    return _store_spectrum(key, (nu, spect))
+
+
+# CarsSpectrum.signal_as for many temperatures: only the susceptibilities are
+# computed per temperature, the pump line is shared and all convolutions are
+# done as one batch
+def signal_as_batch(cars, nu_s, temperatures, synth_mode, pump_lw=None,
+                    x_mol=None, del_Tv=0):
+    if x_mol is None:
+        x_mol = cars.init_comp[cars.ls_factors.species]
+    if synth_mode['chi_rs'] == 'isolated':
+        chi_rs = cars.chi_rs_isolated
+    elif synth_mode['chi_rs'] == 'G-matrix':
+        chi_rs = cars.chi_rs_gmat
+    else:
+        raise ValueError("Unknown method. Only 'isolated' or 'G-matrix' "
+                         "are available")
+
+    chi = np.empty((len(temperatures), len(nu_s)), dtype=complex)
+    for _row, _temperature in enumerate(temperatures):
+        N_species = x_mol*cars.num_dens(_temperature)
+        chi_nrs = cars.chi_nrs_est(_temperature)*1e-18
+        chi[_row] = (N_species*chi_rs(nu_s, _temperature, del_Tv=del_Tv)
+                     + chi_nrs)*1e15
+    return convolve_chi(cars, nu_s, chi, temperatures, synth_mode, pump_lw)
+
+
+# the part of signal_as after the susceptibility: Doppler broadening, then
+# convolution with the pump line (rows of chi are the temperatures)
+def convolve_chi(cars, nu_s, chi, temperatures, synth_mode, pump_lw=None):
+    from carspy.convol_fcn import gaussian_line, lorentz_line
+    if synth_mode['doppler_effect']:
+        for _row, _temperature in enumerate(temperatures):
+            _lw = cars.ls_factors.doppler_lw(_temperature)
+            chi[_row] = convolve_same(
+                chi[_row], gaussian_line(nu_s, (nu_s[0]+nu_s[-1])/2, _lw))
+
+    I_as = np.abs(chi)**2
+    if pump_lw is not None:
+        if synth_mode['pump_ls'] == 'Gaussian':
+            pump = gaussian_line(nu_s, (nu_s[0]+nu_s[-1])/2, pump_lw)
+        elif synth_mode['pump_ls'] == 'Lorentzian':
+            pump = lorentz_line(nu_s, (nu_s[0]+nu_s[-1])/2, pump_lw)
+        if synth_mode['convol'] in ('Yuratich', 'Kataoka', 'Y', 'K'):
+            I_as = convolve_same(I_as, pump)
+        if synth_mode['convol'] in ('Kataoka', 'K'):
+            chi_convol = convolve_same(chi, pump)
+            _corr = nu_s[1] - nu_s[0]
+            I_as = 1/2*(I_as + _corr*np.abs(chi_convol)**2)
+    return I_as
+
+
+# nodes of the adaptive grid per side of a line, spaced as sinh out to
+# ADAPTIVE_REACH line widths (FWHM) from the line center
+ADAPTIVE_LINE_NODES = 12
+ADAPTIVE_REACH = 10
+# spacing of the adaptive grid away from the lines [1/cm]
+ADAPTIVE_SPACING = 0.1
+# largest spacing of the uniform grid of the convolutions, in widths of the
+# narrowest line (Raman, Doppler or pump)
+ADAPTIVE_CONVOL_SPACING = 0.25
+
+
+def line_positions(cars, temperature, branches, vs=3, js=70):
+    """Positions and widths (FWHM) of the Raman lines in chi_rs."""
+    widths = 2*np.abs(np.diag(cars.relax_mat(temperature, js)))
+    positions = np.concatenate([
+        cars.ls_factors.line_pos(_v, np.arange(js), branch=_branch)
+        for _branch in branches for _v in range(vs)])
+    return positions, np.tile(widths, len(branches)*vs)
+
+
+# dense around each line within the range, sparse in between
+def adaptive_grid(nu_start, nu_end, positions, widths):
+    reach = ADAPTIVE_REACH*widths
+    near = (positions > nu_start - reach) & (positions < nu_end + reach)
+    offsets = np.sinh(np.linspace(0, np.arcsinh(ADAPTIVE_REACH),
+                                  ADAPTIVE_LINE_NODES))
+    offsets = np.concatenate([-offsets[:0:-1], offsets])
+    nodes = (positions[near, None] + widths[near, None]*offsets).ravel()
+    nodes = nodes[(nodes > nu_start) & (nodes < nu_end)]
+    background = np.linspace(
+        nu_start, nu_end,
+        int(np.ceil((nu_end - nu_start)/ADAPTIVE_SPACING)) + 1)
+    return np.unique(np.concatenate([background, nodes]))
+
+
+def signal_as_adaptive(cars, nu_s, temperature, synth_mode, pump_lw=None,
+                       x_mol=None, del_Tv=0):
+    """CarsSpectrum.signal_as on the uniform grid nu_s, but with chi_rs only
+    evaluated on an adaptive grid.
+
+    chi is interpolated (cubic spline) from the adaptive grid onto a uniform
+    grid fine enough for the narrowest line, which contains nu_s, and
+    convolved there. The signal is scaled to the spacing of
+    nu_s, i.e. it is what signal_as converges to on a fine uniform grid with
+    the magnitude it has on nu_s.
+    """
+    from scipy.interpolate import CubicSpline
+    if x_mol is None:
+        x_mol = cars.init_comp[cars.ls_factors.species]
+    if synth_mode['chi_rs'] == 'isolated':
+        chi_rs, branches = cars.chi_rs_isolated, (0, 2, -2)
+    elif synth_mode['chi_rs'] == 'G-matrix':
+        chi_rs, branches = cars.chi_rs_gmat, (0,)
+    else:
+        raise ValueError("Unknown method. Only 'isolated' or 'G-matrix' "
+                         "are available")
+
+    nu_start, nu_end = nu_s[0], nu_s[-1]
+    positions, widths = line_positions(cars, temperature, branches)
+    nodes = adaptive_grid(nu_start, nu_end, positions, widths)
+    N_species = x_mol*cars.num_dens(temperature)
+    chi_nrs = cars.chi_nrs_est(temperature)*1e-18
+    chi = (N_species*chi_rs(nodes, temperature, del_Tv=del_Tv)
+           + chi_nrs)*1e15
+
+    narrowest = [widths.min()]
+    if pump_lw is not None:
+        narrowest.append(pump_lw)
+    if synth_mode['doppler_effect']:
+        narrowest.append(cars.ls_factors.doppler_lw(temperature))
+    # nu_s is every step-th point of the grid of the convolutions, which has
+    # an odd number of points so that the lines convolved with are centered
+    step = int(np.ceil((nu_s[1] - nu_s[0])
+                       / (ADAPTIVE_CONVOL_SPACING*min(narrowest))))
+    step += (len(nu_s) - 1)*step % 2
+    nu_convol = np.linspace(nu_start, nu_end, (len(nu_s) - 1)*step + 1)
+    chi = CubicSpline(nodes, chi)(nu_convol)[None]
+    I_as = convolve_chi(cars, nu_convol, chi, [temperature], synth_mode,
+                        pump_lw)[0]
+
+    # each (discrete) convolution scales the signal with 1/spacing
+    power = int(pump_lw is not None) + 2*bool(synth_mode['doppler_effect'])
+    return I_as[::step]/step**power
+
+
+# the default spectrum is what the synthesize tab computes with the default
+# settings, so the first page load is a cache hit
+SPECTRUM_CACHE.put(
+    spectrum_key(**DEFAULT_SETTINGS_CONDITIONS,
+                 **dict(DEFAULT_SETTINGS_MODELS, doppler_effect=False)),
+    DEFAULT_SPECTRUM)
+
+
+# import the deferred dependencies; called in the gunicorn master (see
+# gunicorn.conf.py), so that the forked workers share them copy-on-write
+def preload():
+    for _module in ("carspy", "lmfit.printfuncs", "scipy.signal"):
+        importlib.import_module(_module)
+
+
+# number of the most requested spectra loaded (or recomputed if they were
+# evicted) by warm_up at boot, 0 disables it
+WARM_UP_ITEMS = int(os.environ.get("CARSPY_WARM_UP", 32))
+
+
+def warm_up(n=WARM_UP_ITEMS):
+    """Pre-populate the shared cache from the disk cache.
+
+    The n most requested spectra (counted across restarts) are loaded into
+    the shared cache, those evicted in the meantime are recomputed.
+    """
+    DISK_CACHE.prune()
+    loaded = 0
+    for _key, _settings, _stored in DISK_CACHE.most_requested(n):
+        if _stored and SHARED_CACHE.get(_key) is not None:
+            continue
+        cached = DISK_CACHE.get(_key, count=False) if _stored else None
+        if cached is not None:
+            SHARED_CACHE.put(_key, cached)
+        else:
+            synthesize_cars(**_settings)
+        loaded += 1
+    return loaded
+
+
+# width of the graphs in pixels (upper estimate), one min/max pair is kept per
+# pixel column when decimating long traces
+GRAPH_WIDTH_PX = 1000
+
+
+# keep the minimum and maximum of each bin so that no peak (or dip) is lost
+def decimate_minmax(x, y, n_bins=GRAPH_WIDTH_PX):
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    if len(y) <= 2*n_bins:
+        return x, y
+    width = int(np.ceil(len(y)/n_bins))
+    n_bins = int(np.ceil(len(y)/width))
+    bins = np.full(n_bins*width, np.nan)
+    bins[:len(y)] = y
+    bins = bins.reshape(n_bins, width)
+    offset = np.arange(n_bins)*width
+    idx = np.unique(np.concatenate([
+        [0, len(y) - 1],
+        offset + np.nanargmin(bins, axis=1),
+        offset + np.nanargmax(bins, axis=1)]))
+    return x[idx], y[idx]
+
+
+# decimated traces are small enough for SVG rendering, the decimation is done
+# once for the full range (zooming in does not add points back)
+def make_trace(x, y, max_points=2*GRAPH_WIDTH_PX, **kwargs):
+    if max_points is not None:
+        x, y = decimate_minmax(x, y, max_points//2)
+    return go.Scatter(x=x, y=y, hoverinfo='skip', **kwargs)
+
+
 def plot_cars(nu=None, spect=None, y_scale="Linear"):
     if nu is None and spect is None:
         nu, spect = synthesize_cars()
     nu = np.array(nu)
     spect = np.array(spect)
     fig = go.Figure()
-    fig.add_trace(go.Scatter(
-        x=nu, y=spect/spect.max(),
+    fig.add_trace(make_trace(
+        nu, spect/spect.max(),
         mode='lines',
         name="CARS Signal",
     ))
 
-    fig.update_traces(hoverinfo='skip', selector=dict(type='scatter'))
     fig.update_layout(height=400,
                       margin={'l': 10, 'b': 10, 'r': 10, 't': 10},
                       xaxis_title="Wavenumber [1/cm]",
@@ -102,6 +489,7 @@ def plot_cars(nu=None, spect=None, y_scale="Linear"):
 
 
 def slit_profile(nu, parameters):
+    from carspy.convol_fcn import asym_Gaussian, asym_Voigt
     lineshape = parameters["slit"]
     parameters.pop("slit")
     if lineshape == "sGaussian":
@@ -118,12 +506,11 @@ def slit_profile(nu, parameters):
 def plot_slit(nu, parameters):
     spect = slit_profile(nu, parameters)
     fig = go.Figure()
-    fig.add_trace(go.Scatter(
-        x=nu, y=spect/spect.max(),
+    fig.add_trace(make_trace(
+        nu, spect/spect.max(),
         mode='lines',
     ))
 
-    fig.update_traces(hoverinfo='skip', selector=dict(type='scatter'))
     fig.update_layout(height=280,
                       margin={'l': 10, 'b': 10, 'r': 10, 't': 10},
                       xaxis_title="Wavenumber [1/cm]",
@@ -132,6 +519,24 @@ def plot_slit(nu, parameters):
     return fig
 
 
+def plot_histogram(temperatures, n_bins=40, height=260):
+    fig = go.Figure()
+    if len(temperatures):
+        counts, edges = np.histogram(temperatures, bins=n_bins)
+        fig.add_trace(go.Bar(
+            x=(edges[:-1] + edges[1:])/2, y=counts,
+            width=np.diff(edges),
+            hovertemplate="%{x:.0f} K: %{y}<extra></extra>",
+        ))
+
+    fig.update_layout(height=height,
+                      margin={'l': 10, 'b': 10, 'r': 10, 't': 10},
+                      xaxis_title="Temperature [K]",
+                      yaxis_title="Shots [-]")
+
+    return fig
+
+
 def plot_placeholder(height=400):
     fig = go.Figure()
     fig.add_trace(go.Scatter(
@@ -148,13 +553,51 @@ def plot_placeholder(height=400):
     return fig
 
 
+# below this many multiply-adds the direct convolution is faster than FFT
+DIRECT_CONVOL_MAX = 2e5
+
+
+# equivalent to np.convolve(spect, kernel, 'same'), but with the kernel
+# trimmed to where it is non-negligible and convolved via FFT (or overlap-add
+# for short kernels) when that is faster than the direct sum; 2d (real or
+# complex) input is convolved row by row in one go
+def convolve_same(spect, kernel, rtol=1e-12):
+    spect = np.asarray(spect)
+    spect = spect.astype(np.result_type(spect, float), copy=False)
+    kernel = np.asarray(kernel, dtype=float)
+    length = max(spect.shape[-1], len(kernel))
+    start = (min(spect.shape[-1], len(kernel)) - 1)//2
+    support = np.flatnonzero(np.abs(kernel) > np.abs(kernel).max()*rtol)
+    if support.size == 0:
+        return np.zeros(spect.shape[:-1] + (length,), dtype=spect.dtype)
+    kernel = kernel[support[0]:support[-1]+1]
+
+    if spect.ndim == 1 and len(kernel)*len(spect) <= DIRECT_CONVOL_MAX:
+        full = np.convolve(spect, kernel, 'full')
+    else:
+        from scipy.signal import fftconvolve, oaconvolve
+        kernel = kernel.reshape((1,)*(spect.ndim - 1) + (-1,))
+        if kernel.shape[-1] < spect.shape[-1]//8:
+            full = oaconvolve(spect, kernel, 'full', axes=-1)
+        else:
+            full = fftconvolve(spect, kernel, 'full', axes=-1)
+
+    # undo the shift introduced by dropping the leading part of the kernel
+    idx = np.arange(length) + start - support[0]
+    valid = (idx >= 0) & (idx < full.shape[-1])
+    spect_conv = np.zeros(spect.shape[:-1] + (length,), dtype=full.dtype)
+    spect_conv[..., valid] = full[..., idx[valid]]
+    return spect_conv
+
+
 def downsample_synth(nu, spect, nu_start, nu_end, sample_length, noise_level,
                      offset, slit_parameters):
+    from carspy.utils import downsample
     np.random.seed(42)
     noise = np.random.rand(sample_length)
     slit_fcn = slit_profile(nu, slit_parameters)
     nu_expt = np.linspace(nu_start+2, nu_end-2, num=sample_length)
-    spect_conv = np.convolve(spect, slit_fcn, 'same')
+    spect_conv = convolve_same(spect, slit_fcn)
     spect_expt = (downsample(nu_expt, nu, spect_conv) + noise*noise_level
                   - offset)
     x_range = [nu_start, nu_end]
@@ -164,13 +607,12 @@ def downsample_synth(nu, spect, nu_start, nu_end, sample_length, noise_level,
 
 def plot_fitting(nu_expt, spect_expt, x_range, mode="markers"):
     fig = go.Figure()
-    fig.add_trace(go.Scatter(
-        x=np.array(nu_expt), y=np.array(spect_expt)/np.array(spect_expt).max(),
+    fig.add_trace(make_trace(
+        nu_expt, np.array(spect_expt)/np.array(spect_expt).max(),
         mode=mode,
         name="CARS Signal",
     ))
 
-    fig.update_traces(hoverinfo='skip', selector=dict(type='scatter'))
     fig.update_layout(height=400,
                       margin={'l': 10, 'b': 10, 'r': 10, 't': 10},
                       xaxis_title="Wavenumber [1/cm]",
@@ -180,16 +622,18 @@ def plot_fitting(nu_expt, spect_expt, x_range, mode="markers"):
 
 
 def add_fit_result(fig, nu, spect):
-    fig.add_trace(go.Scatter(
-        x=np.array(nu), y=np.array(spect)/np.array(spect).max(),
+    fig.add_trace(make_trace(
+        nu, np.array(spect)/np.array(spect).max(),
         mode="lines",
         name="Best Fit"
     ))
     return fig
 
 
-def least_sqrt_fit(nu_expt, spect_expt, slit_parameters, settings_models,
-                   settings_conditions):
+def setup_fit(nu_expt, spect_expt, slit_parameters, settings_models,
+              settings_conditions, init_temperature=1500, free=(),
+              ref_fac=FIT_REF_FAC, init_values=None):
+    from carspy import CarsFit
     modes = {
         'power_factor': 0,
         'downsample': 'local_mean',
@@ -204,12 +648,12 @@ def least_sqrt_fit(nu_expt, spect_expt, slit_parameters, settings_models,
 
     init_comp = settings_conditions['comp']
     fit_expt = CarsFit(np.array(spect_expt), np.array(nu_expt),
-                       fit_mode=modes, ref_fac=80,
+                       fit_mode=modes, ref_fac=ref_fac,
                        pressure=settings_conditions['pressure'],
                        init_comp=init_comp)
     fit_expt.preprocess()
     params = (
-        ('temperature', 1500, True, 250, 3000),
+        ('temperature', init_temperature, True, 250, 3000),
         ('del_Tv', 0, False),
         ('x_mol', init_comp['N2'], False),
         ('nu_shift', 0, False),
@@ -222,25 +666,368 @@ def least_sqrt_fit(nu_expt, spect_expt, slit_parameters, settings_models,
         ('param5', slit_parameters['sigma_L_l'], False),
         ('param6', slit_parameters['sigma_L_h'], False)
     )
+    params = tuple(
+        (_param[0], _param[1], True, *FREE_PARAMETERS[_param[0]][1:])
+        if _param[0] in free else _param for _param in params)
+    if init_values:
+        params = tuple((_param[0], init_values.get(_param[0], _param[1]),
+                        *_param[2:]) for _param in params)
+    return fit_expt, params
+
 
-    fit_expt.ls_fit(add_params=params, show_fit=False)
+# CarsFit.cars_expt_synth for many temperatures, returns an
+# (n_T, len(fit_expt.nu)) array
+def expt_synth_batch(fit_expt, temperatures, x_mol, del_Tv, nu_shift,
+                     nu_stretch, pump_lw, param1, param2, param3, param4,
+                     param5, param6):
+    from carspy.utils import downsample
+    from carspy.convol_fcn import asym_Gaussian, asym_Voigt
+    nu_expt = fit_expt.nu*nu_stretch + nu_shift
+    _del_nu = nu_expt[1] - nu_expt[0]
+    _nu_expt_pad = np.pad(nu_expt, (5, 5), 'reflect', reflect_type='odd')
+    nu_f = np.arange(start=_nu_expt_pad[0], stop=_nu_expt_pad[-1],
+                     step=_del_nu/fit_expt.ref_fac)
+    if fit_expt.fit_mode['slit'] == 'sGaussian':
+        nu_slit = asym_Gaussian(w=nu_f, w0=(nu_f[0]+nu_f[-1])/2,
+                                sigma=param1, k=param2, a_sigma=param3,
+                                a_k=param4, offset=0)
+    elif fit_expt.fit_mode['slit'] == 'sVoigt':
+        nu_slit = asym_Voigt(w=nu_f, w0=(nu_f[0]+nu_f[-1])/2,
+                             sigma=param1, k=param2, a_sigma=param3,
+                             a_k=param4, sigma_L_l=param5, sigma_L_h=param6,
+                             offset=0)
+    I_as = signal_as_batch(fit_expt.spec_synth, nu_f, temperatures,
+                           fit_expt.synth_mode, pump_lw=pump_lw, x_mol=x_mol,
+                           del_Tv=del_Tv)
+    I_as = convolve_same(I_as, nu_slit)
+    # downsample works along the first axis
+    I_as_down = downsample(nu_expt, nu_f, I_as.T,
+                           mode=fit_expt.fit_mode['downsample']).T**(
+                               0.5**fit_expt.fit_mode['power_factor'])
+    return np.nan_to_num(I_as_down/I_as_down.max(axis=1, keepdims=True))
+
+
+def least_sqrt_fit(nu_expt, spect_expt, slit_parameters, settings_models,
+                   settings_conditions, iter_cb=None, init_temperature=1500,
+                   free=(), jacobian_workers=JACOBIAN_WORKERS,
+                   ref_fac=FIT_REF_FAC, init_values=None):
+    fit_expt, params = setup_fit(nu_expt, spect_expt, slit_parameters,
+                                 settings_models, settings_conditions,
+                                 init_temperature, free, ref_fac, init_values)
+    fit_kws = {}
+    if free and jacobian_workers > len(free):
+        fit_args = (np.asarray(nu_expt), np.asarray(spect_expt),
+                    dict(slit_parameters), settings_models,
+                    settings_conditions)
+        jacobian = ParallelJacobian(fit_args, ref_fac=ref_fac,
+                                    iter_cb=iter_cb)
+        fit_kws['Dfun'] = jacobian
+        iter_cb = jacobian.iter_cb
+    fit_expt.ls_fit(add_params=params, show_fit=False, iter_cb=iter_cb,
+                    fit_kws=fit_kws)
     return fit_expt.fit_result
 
 
+# CarsFit instances of the fits evaluated by this process
+_FIT_SETUPS = LRUCache(max_items=4)
+_jacobian_pool = None
+_jacobian_pool_size = 0
+
+
+def _model_values(fit_args, parameter_sets, ref_fac=FIT_REF_FAC):
+    key = settings_key(fit_args, ref_fac)
+    fit_expt = _FIT_SETUPS.get(key)
+    if fit_expt is None:
+        fit_expt = _FIT_SETUPS.put(key, setup_fit(*fit_args,
+                                                  ref_fac=ref_fac)[0])
+    return [fit_expt.cars_expt_synth(fit_expt.nu, **_values)
+            for _values in parameter_sets]
+
+
+# pool of at least `workers` processes for the Jacobian columns
+def _jacobian_executor(workers):
+    global _jacobian_pool, _jacobian_pool_size
+    if _jacobian_pool_size < workers:
+        if _jacobian_pool is not None:
+            _jacobian_pool.shutdown()
+        _jacobian_pool = ProcessPoolExecutor(max_workers=workers)
+        _jacobian_pool_size = workers
+    return _jacobian_pool
+
+
+class ParallelJacobian():
+    """Forward-difference Jacobian of the residual for lmfit's Dfun.
+
+    The residual ``(data - model)*weights`` at the current parameters is the
+    one lmfit has just evaluated (recorded by `iter_cb`, which is passed to
+    lmfit in place of the given callback), so only the shifted parameter
+    sets are evaluated, one per varied parameter and all at once: the first
+    in this process, the others across a process pool.
+    """
+
+    def __init__(self, fit_args, rel_step=1e-5, ref_fac=FIT_REF_FAC,
+                 iter_cb=None):
+        self.fit_args = fit_args
+        self.rel_step = rel_step
+        self.ref_fac = ref_fac
+        self._iter_cb = iter_cb
+        self._last = (None, None)
+
+    def iter_cb(self, params, iteration, resid, *args, **kws):
+        self._last = (params.valuesdict(), np.array(resid))
+        if self._iter_cb is not None:
+            return self._iter_cb(params, iteration, resid, *args, **kws)
+
+    def _residuals(self, parameter_sets, data, weights):
+        futures = []
+        if len(parameter_sets) > 1:
+            _pool = _jacobian_executor(len(parameter_sets) - 1)
+            futures = [_pool.submit(_model_values, self.fit_args, [_values],
+                                    self.ref_fac)
+                       for _values in parameter_sets[1:]]
+        models = _model_values(self.fit_args, parameter_sets[:1],
+                               self.ref_fac)
+        models += [_future.result()[0] for _future in futures]
+        return [(data - _model)*(1 if weights is None else weights)
+                for _model in models]
+
+    def __call__(self, params, data, weights, **kws):
+        values = params.valuesdict()
+        names = [_name for _name, _param in params.items() if _param.vary]
+        steps = []
+        parameter_sets = []
+        for _name in names:
+            _step = self.rel_step*max(abs(values[_name]), 1)
+            if values[_name] + _step > params[_name].max:
+                _step = -_step
+            steps.append(_step)
+            parameter_sets.append(dict(values, **{_name: values[_name]
+                                                  + _step}))
+        last_values, resid = self._last
+        if last_values != values:
+            # not evaluated by lmfit just before (e.g. a rejected step)
+            parameter_sets.insert(0, values)
+        residuals = self._residuals(parameter_sets, data, weights)
+        if last_values != values:
+            resid = residuals.pop(0)
+        return np.column_stack([(_resid - resid)/_step for _resid, _step
+                                in zip(residuals, steps)])
+
+
+# sum of squared residuals for each of the given temperatures, all other
+# parameters kept at their initial values
+def _scan_residuals(fit_args, temperatures, ref_fac=SCAN_REF_FAC):
+    fit_expt, params = setup_fit(*fit_args, ref_fac=ref_fac)
+    values = {_param[0]: _param[1] for _param in params
+              if _param[0] != 'temperature'}
+    models = expt_synth_batch(fit_expt, temperatures, **values)
+    return np.sum((models - np.nan_to_num(fit_expt.spec_cars))**2, axis=1)
+
+
+_scan_pool = None
+
+
+# coarse global search for the starting temperature of the local fit, the
+# grid is split into chunks across a process pool; progress is reported (and
+# cancellation checked) after each chunk
+def temperature_scan(nu_expt, spect_expt, slit_parameters, settings_models,
+                     settings_conditions, temperatures=SCAN_TEMPERATURES,
+                     workers=SCAN_WORKERS, ref_fac=SCAN_REF_FAC):
+    global _scan_pool
+    fit_args = (np.asarray(nu_expt), np.asarray(spect_expt),
+                dict(slit_parameters), settings_models, settings_conditions)
+    temperatures = np.asarray(temperatures, dtype=float)
+    chunks = np.array_split(temperatures,
+                            max(workers, int(np.ceil(len(temperatures)/8))))
+    chunks = [_chunk for _chunk in chunks if _chunk.size]
+    results = []
+
+    def _collect(_chunk, _residuals):
+        results.append((_chunk, _residuals))
+        done = sum(len(_t) for _t, _ in results)
+        if jobs.report_progress(message="Temperature scan: "
+                                f"{done}/{len(temperatures)}"):
+            raise jobs.JobCancelled
+
+    if workers <= 1:
+        for _chunk in chunks:
+            _collect(_chunk, _scan_residuals(fit_args, _chunk, ref_fac))
+    else:
+        if _scan_pool is None:
+            _scan_pool = ProcessPoolExecutor(max_workers=workers)
+        futures = {_scan_pool.submit(_scan_residuals, fit_args, _chunk,
+                                     ref_fac): _chunk for _chunk in chunks}
+        try:
+            for _future in as_completed(futures):
+                _collect(futures[_future], _future.result())
+        except jobs.JobCancelled:
+            for _future in futures:
+                _future.cancel()
+            raise
+    temperatures = np.concatenate([_t for _t, _ in results])
+    residuals = np.concatenate([_r for _, _r in results])
+    return temperatures[int(np.argmin(residuals))]
+
+
+# lmfit iteration callback, reports to the job table and aborts the fit (by
+# returning True) if the job has been cancelled
+def fit_progress(params, iteration, resid, *args, **kws):
+    return jobs.report_progress(
+        iteration=int(iteration),
+        temperature=float(params['temperature'].value),
+        residual=float(np.sqrt(np.sum(np.square(resid)))))
+
+
+# fit and unpack in one go, used by the background jobs
+def run_fit(nu_expt, spect_expt, slit_parameters, settings_models,
+            settings_conditions, init_temperature=None, settings_solver=None,
+            scan_workers=SCAN_WORKERS, jacobian_workers=JACOBIAN_WORKERS,
+            init_values=None):
+    if settings_solver is None:
+        settings_solver = DEFAULT_SETTINGS_SOLVER
+    init_values = dict(init_values or {})
+    if init_temperature is None:
+        init_temperature = init_values.get('temperature')
+    if settings_solver['coarse_scan']:
+        temperatures = SCAN_TEMPERATURES
+        if init_temperature is not None:
+            temperatures = np.append(temperatures, init_temperature)
+        init_temperature = temperature_scan(
+            nu_expt, spect_expt, slit_parameters, settings_models,
+            settings_conditions, temperatures=temperatures,
+            workers=scan_workers)
+    if init_temperature is None:
+        init_temperature = 1500
+    result = least_sqrt_fit(nu_expt, spect_expt, slit_parameters,
+                            settings_models, settings_conditions,
+                            iter_cb=fit_progress,
+                            init_temperature=init_temperature,
+                            free=settings_solver.get('free', ()),
+                            jacobian_workers=jacobian_workers,
+                            init_values=init_values)
+    if getattr(result, 'aborted', False):
+        raise jobs.JobCancelled
+    return unpack_lmfit(result)
+
+
+# fit one shot of a batch, only the scalar results are kept (the batch already
+# runs on all cores, so the coarse scan is not parallelized again)
+def fit_shot(shot, nu_expt, spect_expt, slit_parameters, settings_models,
+             settings_conditions, settings_solver=None):
+    _start = time.perf_counter()
+    result = run_fit(nu_expt, spect_expt, slit_parameters, settings_models,
+                     settings_conditions, settings_solver=settings_solver,
+                     scan_workers=1, jacobian_workers=1)
+    return [{
+        'shot': int(shot),
+        'T_fit': float(result['T_fit']),
+        'dT': result['dT'],
+        'latency': time.perf_counter() - _start
+    }]
+
+
+# settings that least_sqrt_fit depends on besides signal and slit
+def fit_config_key(settings_models, settings_conditions):
+    return settings_key(
+        {_key: settings_models[_key]
+         for _key in ('pump_ls', 'chi_rs', 'convol', 'doppler_effect')},
+        pressure=settings_conditions['pressure'],
+        comp=settings_conditions['comp'])
+
+
+def fit_key(nu_expt, spect_expt, slit_parameters, settings_models,
+            settings_conditions, settings_solver=None):
+    return settings_key(
+        np.asarray(nu_expt), np.asarray(spect_expt), slit_parameters,
+        fit_config_key(settings_models, settings_conditions),
+        settings_solver or DEFAULT_SETTINGS_SOLVER)
+
+
+def cached_fit(nu_expt, spect_expt, slit_parameters, settings_models,
+               settings_conditions, settings_solver=None):
+    key = fit_key(nu_expt, spect_expt, slit_parameters, settings_models,
+                  settings_conditions, settings_solver)
+    entry = FIT_CACHE.get(key)
+    if entry is None:
+        # fitted by another worker
+        entry = SHARED_CACHE.get("fit-" + key)
+        if entry is None:
+            return None
+        FIT_CACHE.put(key, entry)
+    return dict(entry['result'])
+
+
+# fits whose results can warm-start each other: same model configuration,
+# spectral axis and slit function
+def _warm_start_key(nu_expt, slit_parameters, settings_models,
+                    settings_conditions):
+    return "warm-" + settings_key(
+        fit_config_key(settings_models, settings_conditions),
+        np.asarray(nu_expt, dtype=float), slit_parameters['slit'])
+
+
+def remember_fit(nu_expt, spect_expt, slit_parameters, settings_models,
+                 settings_conditions, result, settings_solver=None):
+    spect_expt = np.asarray(spect_expt, dtype=float)
+    key = fit_key(nu_expt, spect_expt, slit_parameters, settings_models,
+                  settings_conditions, settings_solver)
+    entry = FIT_CACHE.put(key, {'result': dict(result)})
+    SHARED_CACHE.put("fit-" + key, entry)
+    # the list is rewritten as a whole, a fit remembered by another worker at
+    # the same time may be lost (it only misses a warm start)
+    warm_key = _warm_start_key(nu_expt, slit_parameters, settings_models,
+                               settings_conditions)
+    candidates = list(SHARED_CACHE.get(warm_key, []))
+    candidates.append({'signal': spect_expt/spect_expt.max(),
+                       'slit': dict(slit_parameters),
+                       'values': dict(result.get('values') or
+                                      {'temperature': result['T_fit']})})
+    SHARED_CACHE.put(warm_key, candidates[-WARM_START_ITEMS:])
+
+
+# initial values of the temperature and the free parameters taken from the
+# closest remembered fit of the same configuration (and spectral axis), None
+# if no fit is within WARM_START_TOL
+def warm_start(nu_expt, spect_expt, slit_parameters, settings_models,
+               settings_conditions, free=(), tol=WARM_START_TOL):
+    spect_expt = np.asarray(spect_expt, dtype=float)
+    spect_expt = spect_expt/spect_expt.max()
+    candidates = SHARED_CACHE.get(_warm_start_key(
+        nu_expt, slit_parameters, settings_models, settings_conditions), [])
+    init_values, distance = None, tol
+    for _entry in candidates:
+        if _entry['signal'].shape != spect_expt.shape:
+            continue
+        _distance = np.sqrt(np.mean((_entry['signal'] - spect_expt)**2)) + sum(
+            abs(_entry['slit'][_key] - slit_parameters[_key])
+            for _key in slit_parameters if _key != 'slit')
+        if _distance <= distance:
+            init_values = {_name: _value
+                           for _name, _value in _entry['values'].items()
+                           if _name == 'temperature' or _name in free}
+            distance = _distance
+    return init_values
+
+
 def unpack_lmfit(result):
+    from lmfit.printfuncs import fit_report
     nu = result.userkws['nu_expt']
     signal_expt = result.data
     best_fit = result.best_fit
     T_fit = result.params['temperature'].value
     dT = result.params['temperature'].stderr
     report = fit_report(result)
+    # fitted values of all varied parameters, used for warm starts
+    values = {_name: float(_param.value)
+              for _name, _param in result.params.items() if _param.vary}
     return {
         'nu': nu,
         'signal_expt': signal_expt,
         'best_fit': best_fit,
         'T_fit': T_fit,
         'dT': dT,
-        'report': report
+        'report': report,
+        'values': values
     }
 
 